@@ -0,0 +1,225 @@
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import openpyxl
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, the peak memory is not reported there
+    resource = None
+
+
+converter_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "racsel-convert-xlsx-to-fhir.py")
+
+# Function to import the converter script, its file name is not a valid module name.
+# The module is registered under its name, so the build workers of the converter can find its functions
+def load_converter():
+    spec = importlib.util.spec_from_file_location("racsel_convert_xlsx_to_fhir", converter_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+converter = load_converter()
+
+# Constants
+synthetic_local_uri = "http://node-bench.org/terminology"
+default_results_path = "benchmark-results.jsonl"
+default_workdir = os.path.join(tempfile.gettempdir(), "racsel-benchmark")
+
+# Prefix of the RACSEL codes of each domain, as in the template (H1, D1, V1...)
+RACSEL_PREFIXES = "HDVAMP"
+
+# Column headers of each system, as in Subsets_Conectathon_Template.xlsx (the RACSEL term header is the domain)
+HEADERS = {
+    "racsel": "Code",
+    "local": ("Local Code", "Local Term"),
+    "cie10": ("ICD-10 Code", "IC D-10 Term"),
+    "cie11": ("ICD-11 Code", "IC D-11 Term"),
+    "snomed": ("SNOMED Code", "SNOMED Term"),
+    "prequal": ("PrequalCode", "PrequalTerm"),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic workbooks and benchmark each stage of the Excel to FHIR conversion.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="Write a synthetic workbook in the layout of the template")
+    generate.add_argument("output_file", help="The workbook to write")
+    generate.add_argument("--rows", type=parse_count, default=1000, help="Data rows, split between the sheets (1000, 10k, 1M...)")
+    generate.add_argument("--collision-rate", type=float, default=0.0, help="Probability that a cell reuses a code of an earlier row of the sheet (default: 0)")
+    generate.add_argument("--seed", type=int, default=0, help="Random seed, the same seed gives the same workbook")
+
+    run = commands.add_parser("run", help="Benchmark the conversion of synthetic (or given) workbooks")
+    run.add_argument("--rows", type=parse_count, nargs="+", default=[1000, 10000, 100000], help="Row counts of the synthetic workbooks (default: 1k 10k 100k)")
+    run.add_argument("--collision-rate", type=float, nargs="+", default=[0.0], help="Collision rates of the synthetic workbooks (default: 0)")
+    run.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic workbooks")
+    run.add_argument("--workbook", nargs="+", default=[], help="Benchmark these workbooks instead of synthetic ones")
+    run.add_argument("--workdir", default=default_workdir, help=f"Directory for the synthetic workbooks, kept between runs (default: {default_workdir})")
+    run.add_argument("--results", default=default_results_path, help=f"JSON Lines file the results are appended to (default: {default_results_path})")
+    run.add_argument("--compression", choices=converter.COMPRESSION_CHOICES, default="gzip", help="Package compression, as in the converter")
+    run.add_argument("--compact", action="store_true", help="Write the resources as compact JSON, as in the converter")
+    run.add_argument("--max-resource-size", type=int, default=None, help="Split large resources, as in the converter")
+    run.add_argument("--json-encoder", choices=["auto"] + list(converter.JSON_ENCODERS), default="auto", help="JSON encoder of the resources, as in the converter")
+    run.add_argument("--build-jobs", type=int, default=None, help="Processes building the resources, as in the converter (default: number of CPUs)")
+    run.add_argument("--display-policy", choices=list(converter.DISPLAY_POLICIES), default="first", help="Display kept for a code with different displays, as in the converter")
+    run.add_argument("--equivalence", metavar="[SOURCE:TARGET=]VALUE", type=converter.parse_equivalence, action="append", default=None, help="Equivalence of the map targets, as in the converter")
+    run.add_argument("--index", action="store_true", help="Also write and time the lookup index, as in the converter")
+
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        generate_workbook(args.output_file, args.rows, args.collision_rate, args.seed)
+        print(f"Synthetic workbook with {args.rows} rows saved to {args.output_file}")
+        return
+
+    runs = [(workbook, None, None) for workbook in args.workbook]
+    if not runs:
+        os.makedirs(args.workdir, exist_ok=True)
+        for rows in args.rows:
+            for collision_rate in args.collision_rate:
+                workbook = os.path.join(args.workdir, f"synthetic-{rows}-{collision_rate}-{args.seed}.xlsx")
+                if not os.path.exists(workbook):
+                    start = time.perf_counter()
+                    generate_workbook(workbook, rows, collision_rate, args.seed)
+                    print(f"Generated {workbook} in {time.perf_counter() - start:.1f}s")
+                runs.append((workbook, rows, collision_rate))
+
+    options = {
+        "compression": args.compression, "compact": args.compact, "max_resource_size": args.max_resource_size, "json_encoder": args.json_encoder,
+        "build_jobs": args.build_jobs, "display_policy": args.display_policy, "equivalence": dict(args.equivalence or []),
+        "index": args.index,
+    }
+    for workbook, rows, collision_rate in runs:
+        result = run_isolated(workbook, options)
+        result.update({"rows": rows, "collision_rate": collision_rate, "seed": args.seed if rows is not None else None})
+        with open(args.results, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result, sort_keys=True) + "\n")
+        stages = ", ".join(f"{name} {stage['seconds']:.2f}s" for name, stage in result["stages"].items())
+        peak = f"{result['peak_rss_mb']:.0f} MB" if result["peak_rss_mb"] is not None else "n/a"
+        print(f"{os.path.basename(workbook)}: {result['total_seconds']:.2f}s ({stages}), peak RSS {peak}, {result['resources']} resources built by {result['build_workers']} processes")
+
+    print(f"Results appended to {args.results}")
+
+# Function to parse a row count with an optional k or M suffix (10k, 1M)
+def parse_count(value):
+    multipliers = {"k": 1000, "m": 1000000}
+    suffix = value[-1:].lower()
+    if suffix in multipliers:
+        return int(float(value[:-1]) * multipliers[suffix])
+    return int(value)
+
+# Function to create the (code, display) concept number n of a system in a domain, unique per domain and system
+def synthetic_concept(system, domain_index, domain, n):
+    if system == "racsel":
+        code = f"{RACSEL_PREFIXES[domain_index]}{n + 1}"
+    elif system == "local":
+        code = f"L{domain_index}{n:07d}"
+    elif system == "cie10":
+        code = f"{chr(ord('A') + n % 26)}{domain_index}{n // 26:04d}"
+    elif system == "cie11":
+        code = f"X{domain_index}{n:06d}"
+    elif system == "snomed":
+        code = 100000000 + domain_index * 10000000 + n
+    else:
+        code = f"PQ{domain_index}{n:07d}"
+    return code, f"{converter.SYSTEMS[system].label} {domain.label} {n}"
+
+# Function to write a synthetic workbook in the layout of Subsets_Conectathon_Template.xlsx with rows data rows
+# split between the sheets. With probability collision_rate each code cell reuses the concept of an earlier row
+# of the same sheet and system, which gives many-to-one maps (and bigger chained maps when the local code repeats).
+def generate_workbook(path, rows, collision_rate=0.0, seed=0):
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+    for domain_index, domain in enumerate(converter.DOMAINS):
+        sheet = workbook.create_sheet(domain.sheet)
+        width = max(col for cols in domain.columns.values() for col in cols) + 1
+
+        # first row holds the local uri in the first sheet, the third the column headers
+        first_row = [None] * width
+        if domain_index == 0:
+            first_row[1:3] = ["Local Code System", synthetic_local_uri]
+        sheet.append(first_row)
+        sheet.append([None] * width)
+        header = [None] * width
+        for system, (code_col, display_col) in domain.columns.items():
+            header[code_col], header[display_col] = (HEADERS[system], domain.label) if system == "racsel" else HEADERS[system]
+        sheet.append(header)
+
+        count = rows // len(converter.DOMAINS) + (1 if domain_index < rows % len(converter.DOMAINS) else 0)
+        used = {system: [] for system in domain.columns}
+        for n in range(count):
+            row = [None] * width
+            for system, (code_col, display_col) in domain.columns.items():
+                if used[system] and rng.random() < collision_rate:
+                    concept = rng.choice(used[system])
+                else:
+                    concept = synthetic_concept(system, domain_index, domain, n)
+                    used[system].append(concept)
+                row[code_col], row[display_col] = concept
+            sheet.append(row)
+    workbook.save(path)
+
+# Function to get the peak resident memory of this process in MB, None where it is not available
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB on linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+# Function to run the benchmark of a workbook in a fresh process, so the peak memory is the one of that conversion only
+def run_isolated(workbook, options):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_benchmark, workbook, **options).result()
+
+# Function to convert a workbook with convert_to_fhir (without caches), timing each of its stages with a Profiler:
+# ingest (parse the sheets), extract (terms, codes and maps), validate, plan, build (build and serialize the
+# resources), package (compress) and, with index, index. tracemalloc is left off, it would slow the conversion down.
+# Returns the result record.
+def run_benchmark(workbook, compression="gzip", compact=False, max_resource_size=None, json_encoder="auto", build_jobs=None, display_policy="first", equivalence=None, index=False):
+    profiler = converter.Profiler(memory=False)
+    with tempfile.TemporaryDirectory() as output_dir, contextlib.redirect_stdout(io.StringIO()):
+        output_path = os.path.join(output_dir, "racsel_fhir_package" + converter.package_extension(compression))
+        converter.convert_to_fhir(workbook, compression=compression, compact=compact, max_resource_size=max_resource_size, output_path=output_path, profiler=profiler,
+                                  display_policy=display_policy, equivalence=equivalence, json_encoder=json_encoder, build_jobs=build_jobs, index=index)
+        package_bytes = os.path.getsize(output_path)
+
+    stages = {stage["name"]: {"seconds": stage["wall"], "cpu_seconds": stage["cpu"]} for stage in profiler.stages}
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "converter_version": converter.code_version,
+        "python": platform.python_version(),
+        "pandas": converter.pd.__version__,
+        "platform": platform.platform(),
+        "workbook": os.path.basename(workbook),
+        "options": {
+            "compression": compression, "compact": compact, "max_resource_size": max_resource_size, "json_encoder": converter.json_encoder_name(json_encoder),
+            "build_jobs": build_jobs, "display_policy": display_policy, "index": index,
+            "equivalence": {f"{key[0]}:{key[1]}" if key else "default": value for key, value in (equivalence or {}).items()},
+        },
+        "terms": sum(sheet["terms"] for sheet in profiler.sheets.values()),
+        "resources": len(profiler.resources),
+        "build_workers": profiler.build_workers,
+        "package_bytes": package_bytes,
+        "stages": stages,
+        "total_seconds": sum(stage["seconds"] for stage in stages.values()),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+if __name__ == "__main__":
+    main()
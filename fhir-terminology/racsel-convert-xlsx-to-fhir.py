@@ -1,4 +1,4 @@
-import pandas as pd
+import importlib.util
 import json
 import uuid
 import tarfile
@@ -6,6 +6,47 @@ import os
 import tempfile
 import argparse
 import sys
+import hashlib
+import gzip
+import io
+import zlib
+import struct
+import contextlib
+import functools
+import glob
+import itertools
+import multiprocessing
+import re
+import time
+import tracemalloc
+import cProfile
+import pstats
+import math
+import zipfile
+import shutil
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import quote
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from racsel_terminology import write_index
+import racsel_upload
+
+
+# Function to import a module on its first use, so --help and argument errors do not wait for it
+def lazy_import(name):
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named '{name}'")
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# pandas takes seconds to import, it is only loaded when a workbook is processed
+pd = lazy_import("pandas")
 
 
 
@@ -14,46 +55,906 @@ cie10_uri = "http://hl7.org/fhir/sid/icd-10"
 cie11_uri = "http://id.who.int/icd/release/11/mms"
 snomed_uri = "http://snomed.info/sct"
 prequal_uri = "http://smart.who.int/pcmt-vaxprequal/CodeSystem/PreQualProductIDs"
+racsel_uri = "http://racsel.org/connectathon"
+default_local_uri = "http://node-x.org/terminology/default"
 
 temp_dir = tempfile.gettempdir()
+default_cache_dir = os.path.join(temp_dir, "racsel-fhir-cache")
+
+# Timestamp of every package member, fixed so that the same input always gives a byte-identical package
+package_mtime = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+
+# Serialized resources bigger than this are moved from memory to a temporary file until the package is written
+spool_max_size = 8 * 1024 * 1024
+
+# Items of a StreamedArray encoded with one call to the JSON encoder
+stream_batch_size = 1000
+
+# Cells of a sheet XML holding a shared string (<c ... t="s"><v>index</v>), the index is group 2
+shared_string_cell = re.compile(rb'(<(?:\w+:)?c\b[^>]*?\bt="s"[^>]*>\s*<(?:\w+:)?v>)(\d+)(<)')
+
+# Resources per transaction Bundle written with --bundles
+default_bundle_size = 20
+
+# Seconds between the checks of the workbook in --watch mode
+watch_interval = 0.25
+
+# Strings read as missing cells, as pandas read_excel does with its default na_values
+NA_STRINGS = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+
+# Extensions of the per-domain files of a columnar source and their field separator, None for Parquet
+COLUMNAR_FORMATS = {".csv": ",", ".tsv": "\t", ".parquet": None}
+
+# Order of the resource types in the transaction Bundles and NDJSON files, the CodeSystems before the ValueSets
+# and ConceptMaps that use them
+BUNDLE_RESOURCE_TYPES = ["CodeSystem", "ValueSet", "ConceptMap"]
+
+# Compression backends for the output package, only gzip packages can be loaded by Snowstorm
+COMPRESSION_CHOICES = ["gzip", "gzip-mt", "zstd"]
+
+# Code systems of the workbook, in the order used to build and derive the maps between them.
+# uri is None for the local system, its uri is read from the workbook.
+# domain_value_set is the infix of the per-domain ValueSets ("Racsel" gives AntecedentesPersonalesRacselValueSet),
+# None when the domain maps use the global ValueSet. code_system_name is the CodeSystem fragment built from the workbook.
+System = namedtuple("System", ["label", "uri", "value_set_name", "value_set_oid", "domain_value_set", "code_system_name"])
+SYSTEMS = {
+    "racsel": System("RACSEL", racsel_uri, "RACSELValueSet", "racsel-vs", "Racsel", "RACSELCodeSystem"),
+    "local": System("Local", None, "LocalValueSet", "local-vs", "Local", "LocalCodeSystem"),
+    "cie10": System("CIE10", cie10_uri, "CIE10ValueSet", "cie10-vs", None, "icd-10"),
+    "cie11": System("CIE11", cie11_uri, "CIE11ValueSet", "cie11-vs", None, "icd-11"),
+    "snomed": System("SNOMED", snomed_uri, "SNOMEDValueSet", "snomed-vs", "", None),
+    "prequal": System("PreQual", prequal_uri, "PreQualValueSet", "prequal-vs", None, "prequal"),
+}
+
+# One sheet per domain. columns gives the (code, display) column positions of each system in the sheet,
+# data starts at the third row. label is used in the ConceptMap names, name and oid in the ValueSet names and urls.
+Domain = namedtuple("Domain", ["label", "sheet", "name", "oid", "columns"])
+DOMAINS = [
+    Domain("Antecedentes", "Antecedentes Personales ", "AntecedentesPersonales", "antecedentes-personales", {"racsel": (1, 2), "local": (3, 4), "cie10": (5, 6), "snomed": (7, 8)}),
+    Domain("Diagnosticos", "Diagnósticos", "Diagnosticos", "diagnosticos", {"racsel": (1, 2), "local": (3, 4), "cie10": (5, 6), "snomed": (7, 8)}),
+    Domain("Vacunas", "Vacunas", "Vacunas", "vacunas", {"racsel": (1, 2), "local": (3, 4), "cie11": (5, 6), "snomed": (7, 8), "prequal": (9, 10)}),
+    Domain("Alergias", "Alergias", "Alergias", "alergias", {"racsel": (1, 2), "local": (3, 4), "snomed": (7, 8)}),
+    Domain("Medicacion", "Medicación ", "Medicacion", "medicacion", {"racsel": (1, 2), "local": (3, 4), "snomed": (7, 8)}),
+    Domain("Procedimientos", "Procedimientos", "Procedimientos", "procedimientos", {"racsel": (1, 2), "local": (3, 4), "snomed": (7, 8)}),
+]
+
+# Pairs of systems mapped directly from the rows of each sheet, the maps are built in both directions
+# per domain (ValueSet-based) and for all the domains together (CodeSystem-based)
+DIRECT_MAP_PAIRS = [
+    ("local", "racsel"), ("local", "snomed"), ("local", "cie10"), ("local", "cie11"),
+    ("cie10", "snomed"), ("cie11", "snomed"),
+    ("local", "prequal"), ("cie11", "prequal"), ("snomed", "prequal"),
+]
+
+# Pairs of systems with a ValueSet-based ConceptMap between the global ValueSets, built in both directions
+GLOBAL_VALUESET_MAP_PAIRS = [("local", "racsel"), ("local", "snomed"), ("cie10", "snomed"), ("cie11", "snomed")]
+
+# Sheets read from the workbook, in the order they are processed
+SHEET_NAMES = [domain.sheet for domain in DOMAINS]
+
+# Columns of each sheet used by the converter, up to the last column of its domain
+SHEET_WIDTHS = {domain.sheet: max(col for cols in domain.columns.values() for col in cols) + 1 for domain in DOMAINS}
+
+# Workbook validation checks: name -> (severity, description)
+VALIDATION_CHECKS = {
+    "missing-display": ("error", "code without display, the code is left out of the package"),
+    "missing-code": ("error", "display without code, the term is left out of the package"),
+    "numeric-code": ("error", "code read as a number, format the column as text"),
+    "invalid-snomed": ("error", "not a SNOMED CT identifier"),
+    "display-conflict": ("error", "code with different displays"),
+    "repeated-code": ("warning", "code repeated in the sheet, it is mapped from several rows"),
+    "unmapped-row": ("warning", "row without this code, it is left out of the maps"),
+}
+
+# Policies choosing the display of a code found with several displays in the sheets, given its candidate
+# (display, rows) pairs in the order they first appear: the first one, the one of the most rows (ties go to
+# the first) or the longest one
+DISPLAY_POLICIES = {
+    "first": lambda candidates: candidates[0],
+    "most-rows": lambda candidates: max(candidates, key=lambda candidate: candidate[1]),
+    "longest": lambda candidates: max(candidates, key=lambda candidate: len(str(candidate[0]))),
+}
+
+# ConceptMap equivalence codes (FHIR R4 ConceptMapEquivalence), the maps use default_equivalence unless --equivalence
+# sets another value for all of them or for the maps from one system to another
+EQUIVALENCES = ["relatedto", "equivalent", "equal", "wider", "subsumes", "narrower", "specializes", "inexact", "unmatched", "disjoint"]
+default_equivalence = "equivalent"
+
+# Systems every row with codes is expected to have, and the systems whose codes identify a single row of a sheet
+REQUIRED_SYSTEMS = ["racsel", "local", "snomed"]
+ROW_KEY_SYSTEMS = ["racsel", "local"]
+
+# Systems whose codes are numbers (SNOMED CT identifiers), the codes of every other system must be read as text
+NUMERIC_SYSTEMS = ["snomed"]
 
 def main():
     parser = argparse.ArgumentParser(description="Convert Excel terminology data to FHIR package with ValueSet-based concept maps.")
-    parser.add_argument("source_file", help="The source file to process")
+    parser.add_argument("source_file", nargs="+", help="The source file to process (a workbook, or a directory with a CSV, TSV or Parquet file per domain), or several workbooks, directories or glob patterns to convert in batch")
+    parser.add_argument("--output-dir", default=None, help="Directory for the packages (default: the current directory). In batch mode each workbook gives <workbook name>.tgz")
+    parser.add_argument("--jobs", type=int, default=None, help="Workbooks converted in parallel in batch mode (default: number of CPUs)")
+    parser.add_argument("--validate-only", action="store_true", help="Only check the workbooks for defects (codes without display, numeric codes, conflicting displays...), without building any package. Exits with status 1 if there are errors")
+    parser.add_argument("--profile", action="store_true", help="Print the wall time, CPU time and memory of each stage, the sheet counts and the slowest resources (single workbook)")
+    parser.add_argument("--profile-json", metavar="FILE", default=None, help="Write the profile of each stage, resource and sheet as JSON (single workbook)")
+    parser.add_argument("--trace-json", metavar="FILE", default=None, help="Write the stages and resources in Chrome trace format, for chrome://tracing or Perfetto (single workbook)")
+    parser.add_argument("--cprofile", metavar="FILE", default=None, help="Run each stage under cProfile and dump the profile of the slowest stage to FILE in pstats format (single workbook)")
+    parser.add_argument("--merged", action="store_true", help="In batch mode also write racsel_fhir_package_regional.tgz with the resources of every workbook merged by canonical url")
+    parser.add_argument("--cache-dir", default=default_cache_dir, help=f"Directory for the parsed sheet and built resource caches (default: {default_cache_dir})")
+    parser.add_argument("--no-cache", action="store_true", help="Always parse the workbook and build every resource, ignoring and not writing the caches")
+    parser.add_argument("--compression", choices=COMPRESSION_CHOICES, default="gzip", help="Package compression: gzip (default), gzip-mt (multithreaded gzip, same format) or zstd (.tar.zst, requires the zstandard package)")
+    parser.add_argument("--compress-level", type=int, default=9, help="Compression level (gzip 1-9, zstd 1-22, default: 9)")
+    parser.add_argument("--compress-threads", type=int, default=None, help="Threads used by gzip-mt and zstd (default: number of CPUs)")
+    parser.add_argument("--compact", action="store_true", help="Write the resources as compact JSON, without indentation")
+    parser.add_argument("--json-encoder", choices=["auto"] + list(JSON_ENCODERS), default="auto", help="JSON encoder of the resources: json (standard library), orjson (faster, requires the orjson package) or auto, orjson when it is installed (default: auto)")
+    parser.add_argument("--build-jobs", type=int, default=None, help="Processes building and serializing the resources (default: number of CPUs, 1 per workbook in batch mode)")
+    parser.add_argument("--max-resource-size", type=int, default=None, help="Maximum concepts per ValueSet and elements per ConceptMap group, larger ValueSets are split in parts included by a parent ValueSet and larger maps in several groups")
+    parser.add_argument("--display-policy", choices=list(DISPLAY_POLICIES), default="first", help="Display kept for a code found with different displays, in one sheet or across sheets: the first one (default), the one of the most rows or the longest one")
+    parser.add_argument("--equivalence", metavar="[SOURCE:TARGET=]VALUE", type=parse_equivalence, action="append", default=None, help=f"Equivalence of the map targets: a value for every map, or SOURCE:TARGET=VALUE for the maps from one system to another (e.g. cie10:snomed=wider), systems as racsel, local, snomed, cie10, cie11, prequal. Can be repeated (default: {default_equivalence})")
+    parser.add_argument("--index", action="store_true", help="Also write the compiled lookup index (.idx) next to the package, for racsel-enrich-ips.py and PackageIndex")
+    parser.add_argument("--watch", action="store_true", help="Keep running and rebuild the package each time the workbook is saved, parsing only the sheets that changed and building only the resources they affect")
+    parser.add_argument("--upload", metavar="SERVER", default=None, help="Upload the package to the load-package of this Snowstorm (e.g. http://localhost:8080), wait until it is loaded and check it with $validate-code and $translate. In batch mode the regional package of --merged is uploaded, with --watch the delta of each rebuild")
+    parser.add_argument("--upload-sample", type=racsel_upload.parse_sample, default=racsel_upload.default_sample, help=f"ValueSet members and map targets checked after the upload, each, or all (default: {racsel_upload.default_sample})")
+    parser.add_argument("--upload-concurrency", type=int, default=racsel_upload.default_concurrency, help=f"Requests sent at once by the upload checks, and Bundles posted at once by --load-bundles (default: {racsel_upload.default_concurrency})")
+    parser.add_argument("--upload-timeout", type=float, default=racsel_upload.default_timeout, help=f"Seconds allowed for the upload, and for each Bundle of --load-bundles (default: {racsel_upload.default_timeout})")
+    parser.add_argument("--bundles", action="store_true", help="Also write the resources as FHIR transaction Bundles of conditional updates by canonical url, in racsel_fhir_package.bundles, to load them in a FHIR server such as HAPI FHIR")
+    parser.add_argument("--bundle-size", type=int, default=default_bundle_size, help=f"Resources per transaction Bundle (default: {default_bundle_size})")
+    parser.add_argument("--ndjson", action="store_true", help="Also write the resources as NDJSON, one file per resource type in racsel_fhir_package.ndjson, for bulk $import")
+    parser.add_argument("--load-bundles", metavar="SERVER", default=None, help="Post the transaction Bundles (implies --bundles) to this FHIR server, e.g. http://localhost:8080/fhir. In batch mode the Bundles of the regional package of --merged are posted")
+    parser.add_argument("--local-uri", default=None, help=f"Uri of the local code system, instead of cell C1 of the first sheet of the workbook (default for a CSV, TSV or Parquet source: {default_local_uri})")
+    parser.add_argument("--since", metavar="PREVIOUS_PACKAGE", default=None, help="Also write a delta package with only the resources added or changed since a previous package")
 
     args = parser.parse_args()
 
-    print(f"Source file: {args.source_file}")
-    print("Using unified CodeSystems with ValueSet-based concept maps")
+    options = {
+        "cache_dir": None if args.no_cache else args.cache_dir,
+        "compression": args.compression,
+        "compress_level": args.compress_level,
+        "compress_threads": args.compress_threads,
+        "compact": args.compact,
+        "max_resource_size": args.max_resource_size,
+        "index": args.index,
+        "local_uri": args.local_uri,
+        "display_policy": args.display_policy,
+        "equivalence": dict(args.equivalence or []),
+        "bundle_size": args.bundle_size if args.bundles or args.load_bundles else None,
+        "ndjson": args.ndjson,
+        "json_encoder": args.json_encoder,
+        "build_jobs": args.build_jobs,
+    }
 
-    convert_to_fhir(args.source_file)
+    if args.validate_only:
+        workbooks = find_workbooks(args.source_file)
+        errors = 0
+        for workbook in workbooks:
+            defects = validate_workbook(workbook, options["cache_dir"])
+            print_defects(workbook, defects)
+            errors += int((defects["severity"] == "error").sum())
+        sys.exit(1 if errors else 0)
+
+    profiling = args.profile or args.profile_json or args.trace_json or args.cprofile
+    if args.upload and args.compression == "zstd":
+        parser.error("Snowstorm only loads gzip packages, --upload needs --compression gzip or gzip-mt")
+    upload_options = {"sample": args.upload_sample, "concurrency": args.upload_concurrency, "timeout": args.upload_timeout}
+    if args.bundle_size < 1:
+        parser.error("--bundle-size must be at least 1")
+    if args.build_jobs is not None and args.build_jobs < 1:
+        parser.error("--build-jobs must be at least 1")
+    if args.max_resource_size is not None and args.max_resource_size < 1:
+        parser.error("--max-resource-size must be at least 1")
+
+    # a single workbook keeps the racsel_fhir_package name, anything else is a batch
+    if len(args.source_file) == 1 and (os.path.isfile(args.source_file[0]) or columnar_files(args.source_file[0])):
+        if args.merged:
+            parser.error("--merged needs several workbooks")
+        print(f"Source file: {args.source_file[0]}")
+        print("Using unified CodeSystems with ValueSet-based concept maps")
+        output_path = os.path.join(args.output_dir, "racsel_fhir_package" + package_extension(args.compression)) if args.output_dir else None
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+        if args.watch:
+            if profiling or args.since:
+                parser.error("--watch compares each build with the previous one, it can not be used with profiling or --since")
+            if os.path.isdir(args.source_file[0]):
+                parser.error("--watch needs a workbook, not a CSV, TSV or Parquet directory")
+            if args.load_bundles:
+                parser.error("--watch uploads the delta of each rebuild with --upload, it can not be used with --load-bundles")
+            watch_workbook(args.source_file[0], output_path, args.upload, upload_options, **options)
+            return
+        profiler = Profiler(cprofile=bool(args.cprofile)) if profiling else None
+        output_path = convert_to_fhir(args.source_file[0], output_path=output_path, since=args.since, profiler=profiler, **options)
+        if args.profile:
+            profiler.print_summary()
+        if args.profile_json:
+            profiler.write_report(args.profile_json)
+        if args.trace_json:
+            profiler.write_trace(args.trace_json)
+        if args.cprofile:
+            profiler.dump_slowest_stage(args.cprofile)
+        if args.upload and not racsel_upload.upload(output_path, args.upload, **upload_options):
+            sys.exit(1)
+        if args.load_bundles and not racsel_upload.load(bundles_path(output_path, args.compression), args.load_bundles, args.upload_concurrency, args.upload_timeout):
+            sys.exit(1)
+        return
+
+    if profiling:
+        parser.error("profiling is only available when converting a single workbook")
+    if args.watch:
+        parser.error("--watch needs a single workbook")
+    if args.since:
+        parser.error("--since compares with the package of a single workbook, it can not be used in batch mode")
+    if (args.upload or args.load_bundles) and not args.merged:
+        parser.error("in batch mode --upload and --load-bundles load the regional package, use them with --merged")
+    workbooks = find_workbooks(args.source_file)
+    if not workbooks:
+        parser.error(f"no workbooks found in {' '.join(args.source_file)}")
+    print(f"Source files: {', '.join(workbooks)}")
+    print("Using unified CodeSystems with ValueSet-based concept maps")
 
+    failed = convert_batch(workbooks, args.output_dir or ".", args.jobs, args.merged, **options)
+    if failed:
+        sys.exit(f"{len(failed)} of {len(workbooks)} workbooks could not be converted: {', '.join(failed)}")
+    regional_path = os.path.join(args.output_dir or ".", "racsel_fhir_package_regional" + package_extension(args.compression))
+    if args.upload and not racsel_upload.upload(regional_path, args.upload, **upload_options):
+        sys.exit(1)
+    if args.load_bundles and not racsel_upload.load(bundles_path(regional_path, args.compression), args.load_bundles, args.upload_concurrency, args.upload_timeout):
+        sys.exit(1)
+
+# Function to parse an --equivalence value, VALUE or SOURCE:TARGET=VALUE. Returns ((source, target) or None, value)
+def parse_equivalence(text):
+    pair, _, value = text.rpartition("=")
+    if value not in EQUIVALENCES:
+        raise argparse.ArgumentTypeError(f"unknown equivalence '{value}', use one of {', '.join(EQUIVALENCES)}")
+    if not pair:
+        return None, value
+    source, _, target = pair.partition(":")
+    if source not in SYSTEMS or target not in SYSTEMS:
+        raise argparse.ArgumentTypeError(f"'{pair}' is not SOURCE:TARGET with systems among {', '.join(SYSTEMS)}")
+    return (source, target), value
+
+# Function to expand the batch sources (workbooks, directories and glob patterns) into the list of workbooks.
+# Directories give the .xlsx files they contain, or themselves when they hold the per-domain files of a columnar
+# source (see columnar_files). Excel lock files (~$...) are skipped.
+def find_workbooks(sources):
+    workbooks = []
+    for source in sources:
+        if os.path.isdir(source) and columnar_files(source):
+            paths = [os.path.normpath(source)]
+        elif os.path.isdir(source):
+            paths = sorted(glob.glob(os.path.join(source, "*.xlsx")))
+        elif glob.has_magic(source):
+            paths = sorted(glob.glob(source))
+        else:
+            paths = [source]
+        for path in paths:
+            if not os.path.basename(path).startswith("~$") and path not in workbooks:
+                workbooks.append(path)
+    return workbooks
+
+# Function to convert several workbooks in a process pool, one package per workbook named after it in output_dir.
+# With merged, the packages are then combined in racsel_fhir_package_regional (see merge_packages).
+# options are the convert_to_fhir keyword arguments. Returns the workbooks that failed.
+def convert_batch(workbooks, output_dir, jobs=None, merged=False, **options):
+    # the workbooks are already converted in parallel, each one builds its resources in its own process
+    options = {**options, "build_jobs": options.get("build_jobs") or 1}
+    extension = package_extension(options.get("compression", "gzip"))
+    os.makedirs(output_dir, exist_ok=True)
+    output_paths = {}
+    for workbook in workbooks:
+        output_path = os.path.join(output_dir, os.path.splitext(os.path.basename(workbook))[0] + extension)
+        if output_path in output_paths.values():
+            raise ValueError(f"{workbook} would overwrite the package of another workbook with the same name ({output_path})")
+        output_paths[workbook] = output_path
+
+    failed = []
+    workers = min(jobs or os.cpu_count() or 1, len(workbooks))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {workbook: executor.submit(convert_to_fhir, workbook, output_path=output_paths[workbook], **options) for workbook in workbooks}
+        for workbook, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to convert {workbook}: {e}")
+                failed.append(workbook)
+
+    # a regional package without some of the countries would silently drop their codes
+    if merged and not failed:
+        regional_path = os.path.join(output_dir, "racsel_fhir_package_regional" + extension)
+        packages = [(os.path.splitext(os.path.basename(workbook))[0], output_paths[workbook]) for workbook in workbooks]
+        merge_packages(packages, regional_path, options.get("compression", "gzip"), options.get("compress_level", 9), options.get("compress_threads"), options.get("compact", False), options.get("max_resource_size"), options.get("index", False),
+                       options.get("bundle_size"), options.get("ndjson", False))
+        print(f"Regional FHIR package saved to {regional_path}")
+        print(f'Load in Snowstorm with curl --form file=@{regional_path} --form resourceUrls="*" http://localhost/fhir-admin/load-package (or equivalent in windows)')
+    elif merged:
+        print("Regional package not written, some workbooks could not be converted")
+    return failed
+
+
+# Function to read the shared strings of an .xlsx as UTF-8 bytes, in index order
+def read_shared_strings(archive):
+    if "xl/sharedStrings.xml" not in archive.namelist():
+        return []
+    namespace = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+    strings = []
+    with archive.open("xl/sharedStrings.xml") as f:
+        for _, element in ElementTree.iterparse(f):
+            if element.tag == namespace + "si":
+                strings.append("".join(text.text or "" for text in element.iter(namespace + "t")).encode("utf-8"))
+                element.clear()
+    return strings
+
+# Function to get a fingerprint of each sheet of an .xlsx without parsing its rows: the hash of the sheet XML with
+# the index of every shared string cell replaced by the string itself. A text edit rewrites the shared strings
+# (and may renumber them), but only changes the fingerprint of the sheets whose cells changed.
+# Returns {sheet name: fingerprint}, None for a sheet without its XML
+def sheet_fingerprints(file_path):
+    with zipfile.ZipFile(file_path) as archive:
+        workbook = ElementTree.fromstring(archive.read("xl/workbook.xml"))
+        relationships = ElementTree.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+        targets = {relationship.get("Id"): relationship.get("Target") for relationship in relationships}
+        names = set(archive.namelist())
+        strings = read_shared_strings(archive)
+        fingerprints = {}
+        for sheet in workbook.iter("{http://schemas.openxmlformats.org/spreadsheetml/2006/main}sheet"):
+            target = targets.get(sheet.get("{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"), "")
+            path = target[1:] if target.startswith("/") else "xl/" + target
+            if path not in names:
+                fingerprints[sheet.get("name")] = None
+                continue
+            data = archive.read(path)
+            digest = hashlib.sha256()
+            position = 0
+            for match in shared_string_cell.finditer(data):
+                index = int(match.group(2))
+                text = strings[index] if index < len(strings) else match.group(2)
+                digest.update(data[position:match.start(2)])
+                digest.update(b"%d:" % len(text) + text)
+                position = match.end(2)
+            digest.update(data[position:])
+            fingerprints[sheet.get("name")] = digest.hexdigest()
+    return fingerprints
+
+# Function to watch a workbook and rebuild the package each time it is saved, until interrupted.
+# The parsed sheets and the serialized resources stay in memory between builds: a save only parses the sheets
+# whose cells changed (see sheet_fingerprints) and only builds the resources of the domains whose content changed.
+# Each build lists the workbook defects and writes the delta since the previous package, which is uploaded to
+# upload_server when given. options are the convert_to_fhir keyword arguments.
+def watch_workbook(file_path, output_path=None, upload_server=None, upload_options=None, interval=watch_interval, **options):
+    extension = package_extension(options.get("compression", "gzip"))
+    output_path = output_path or "racsel_fhir_package" + extension
+    delta_path = output_path[:-len(extension)] + ".delta" + extension
+    sheets, fingerprints, memory_cache = {}, {}, {}
+    built_stat = None
+    print(f"Watching {file_path}, press Ctrl+C to stop")
+    try:
+        while True:
+            try:
+                stat = os.stat(file_path)
+                current = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                # Excel saves to a temporary file and renames it, the workbook is missing for a moment
+                current = None
+            if current is not None and current != built_stat:
+                # wait until the file stops changing, a save may still be in progress
+                time.sleep(interval)
+                stat = os.stat(file_path) if os.path.exists(file_path) else None
+                if stat is None or (stat.st_mtime_ns, stat.st_size) != current:
+                    continue
+                built_stat = current
+                start = time.perf_counter()
+                try:
+                    new_fingerprints = sheet_fingerprints(file_path)
+                    changed = [name for name in SHEET_NAMES if name not in sheets or new_fingerprints.get(name) != fingerprints.get(name)]
+                    if changed:
+                        sheets.update(read_workbook_sheets(file_path, changed))
+                    print(f"{time.strftime('%H:%M:%S')} {file_path} changed, parsed {len(changed)} of {len(SHEET_NAMES)} sheets")
+                    if os.path.exists(delta_path):
+                        os.remove(delta_path)
+                    convert_to_fhir(file_path, output_path=output_path, since=output_path if os.path.exists(output_path) else None,
+                                    sheets=dict(sheets), memory_cache=memory_cache, list_defects=True, **options)
+                    # only a successful build moves the fingerprints on, after a failure the changed sheets are parsed again
+                    fingerprints = new_fingerprints
+                    print(f"Rebuilt in {time.perf_counter() - start:.2f}s")
+                except Exception as e:
+                    # a workbook saved half-way, with a missing sheet or that the build can not handle must not stop
+                    # the watch, the next save is tried again
+                    print(f"Could not rebuild from {file_path}: {type(e).__name__}: {e}")
+                    continue
+                if upload_server and os.path.exists(delta_path):
+                    try:
+                        racsel_upload.upload(delta_path, upload_server, **(upload_options or {}))
+                    except Exception as e:
+                        # a failed upload must not stop the watch, the next change is uploaded again
+                        print(f"Could not upload {delta_path}: {type(e).__name__}: {e}")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+# Function to compute the content hash of a file, used as the sheet cache key
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Function to convert a cell value as pandas read_excel does: empty cells and NA_STRINGS are missing (NaN)
+# and whole numbers are int, so the codes read as 46635009.0 by Excel are 46635009
+def cell_value(value):
+    if value is None or (type(value) is str and value in NA_STRINGS):
+        return math.nan
+    if type(value) is float and value.is_integer():
+        return int(value)
+    return value
+
+# Function to stream the rows of a read-only openpyxl worksheet as tuples of cell values (see cell_value),
+# reading only its first width columns. Empty rows are kept in place, trailing ones are left out.
+def iter_sheet_rows(worksheet, width):
+    # some writers store a wrong sheet size, the rows are read until the end of the sheet instead
+    worksheet.reset_dimensions()
+    empty_rows = 0
+    for row in worksheet.iter_rows(max_col=width, values_only=True):
+        values = tuple(cell_value(value) for value in row) + (math.nan,) * (width - len(row))
+        if all(value is math.nan for value in values):
+            empty_rows += 1
+            continue
+        for _ in range(empty_rows):
+            yield (math.nan,) * width
+        empty_rows = 0
+        yield values
+
+# Function to read a worksheet into a frame the way pandas read_excel does (first row as column names, cells
+# converted as in cell_value), keeping only the first width columns, the ones the converter uses. The whole
+# sheet is still held in memory as a frame, as the extraction, validation and sheet cache work on frames; reading
+# the rows with openpyxl only avoids the columns the converter does not use and a second copy of the cells:
+# they are kept column by column and each column becomes a Series on its own, without a list of rows.
+def read_sheet(worksheet, width):
+    rows = iter_sheet_rows(worksheet, width)
+    header = next(rows, None)
+    if header is None:
+        return pd.DataFrame()
+    cells = [[] for _ in range(width)]
+    appends = [column.append for column in cells]
+    for row in rows:
+        for append, value in zip(appends, row):
+            append(value)
+    # as in read_excel the frame is as wide as the longest row, without trailing empty columns
+    used = max((i + 1 for i in range(width) if header[i] is not math.nan or any(value is not math.nan for value in cells[i])), default=0)
+    columns, seen = [], {}
+    for i, name in enumerate(header[:used]):
+        name = f"Unnamed: {i}" if name is math.nan else name
+        # repeated column names get a suffix, as in pandas
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+    # each column is added on its own and its cells released, the columns are not copied into a single block
+    frame = pd.DataFrame(index=pd.RangeIndex(len(cells[0])))
+    for i in range(used):
+        frame[i] = pd.Series(cells[i], dtype=None if cells[i] else object)
+        cells[i] = None
+    frame.columns = columns
+    return frame
+
+# Function to parse the sheets of a workbook with the openpyxl read-only reader, each sheet up to the last
+# column of its domain. Returns {sheet name: frame}
+def read_workbook_sheets(file_path, sheet_names=None):
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        sheets = {}
+        for name in sheet_names or SHEET_NAMES:
+            if name not in workbook.sheetnames:
+                raise ValueError(f"Worksheet named '{name}' not found")
+            sheets[name] = read_sheet(workbook[name], SHEET_WIDTHS[name])
+        return sheets
+    finally:
+        workbook.close()
+
+# Function to find the per-domain files of a columnar source: a directory with a .csv, .tsv or .parquet file
+# named after the oid, label or sheet of each domain (antecedentes-personales.csv, Vacunas.parquet...).
+# Returns {sheet name: path}, empty when the path is not such a directory
+def columnar_files(source):
+    if not os.path.isdir(source):
+        return {}
+    sheets = {name.lower(): domain.sheet for domain in DOMAINS for name in (domain.oid, domain.label, domain.sheet.strip())}
+    files = {}
+    for file_name in sorted(os.listdir(source)):
+        stem, extension = os.path.splitext(file_name)
+        sheet = sheets.get(stem.lower())
+        if sheet is None or extension.lower() not in COLUMNAR_FORMATS:
+            continue
+        if sheet in files:
+            raise ValueError(f"{source} has two files for the sheet '{sheet.strip()}': {os.path.basename(files[sheet])} and {file_name}")
+        files[sheet] = os.path.join(source, file_name)
+    return files
+
+# Function to convert a Parquet value to the text a CSV would have: NA_STRINGS are missing (NaN) and numbers
+# are written without the .0 of whole floats, so a code stored as 46635009.0 is "46635009"
+def text_value(value):
+    if type(value) is str:
+        return math.nan if value in NA_STRINGS else value
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+# Function to read a columnar file with every column as text, so codes are never read as numbers and keep
+# their leading zeros. CSV and TSV are read as strings, the typed columns of Parquet are converted with text_value
+def read_columnar_file(path):
+    separator = COLUMNAR_FORMATS[os.path.splitext(path)[1].lower()]
+    if separator is not None:
+        # blank lines are kept so the rows still match the lines of the file
+        return pd.read_csv(path, sep=separator, dtype=str, skip_blank_lines=False)
+    if importlib.util.find_spec("pyarrow") is None and importlib.util.find_spec("fastparquet") is None:
+        raise RuntimeError("reading Parquet files requires the pyarrow package (pip install pyarrow)")
+    data = pd.read_parquet(path)
+    return data.apply(lambda column: column.map(text_value, na_action="ignore").astype(object))
+
+# Function to lay out the columns of a columnar file as the sheet of its domain: the file columns are the template
+# columns from column B on, under two rows standing for the rows above the column names of the sheet, and the local
+# uri is left empty (see --local-uri). Rows are numbered so the row reported by validation (index + 2, see
+# stack_terms) is the line of the file, counting its header as line 1.
+def columnar_sheet(data, width):
+    body = data.iloc[:, :width - 1].astype(object)
+    body.columns = range(1, body.shape[1] + 1)
+    header = pd.DataFrame([[math.nan] * width, [math.nan] + list(data.columns[:width - 1])])
+    sheet = pd.concat([header, body.reindex(columns=range(width))], ignore_index=True)
+    sheet.columns = ["" if i == 2 else f"Unnamed: {i}" for i in range(width)]
+    sheet.index = range(-2, len(body))
+    return sheet
+
+# Function to read the per-domain files of a columnar source into the frames read_workbook_sheets gives for a
+# workbook, so they go through the same extraction, validation and build. Returns {sheet name: frame}
+def read_columnar_sheets(source, sheet_names=None):
+    files = columnar_files(source)
+    sheets = {}
+    for name in sheet_names or SHEET_NAMES:
+        if name not in files:
+            oid = next(domain.oid for domain in DOMAINS if domain.sheet == name)
+            raise ValueError(f"No file for the sheet '{name.strip()}' in {source} (e.g. {oid}.csv)")
+        sheets[name] = columnar_sheet(read_columnar_file(files[name]), SHEET_WIDTHS[name])
+    return sheets
+
+# Function to load all the sheets of the workbook opening and parsing it only once.
+# Parsed sheets are kept in cache_dir/<sha256 of the workbook>/ so a later run on the
+# same workbook content skips Excel parsing entirely.
+def load_workbook_sheets(file_path, cache_dir=None):
+    # a columnar source reads about as fast as the cached frames, only workbooks are cached
+    if os.path.isdir(file_path):
+        return read_columnar_sheets(file_path)
+
+    sheet_cache_dir = None
+    if cache_dir:
+        sheet_cache_dir = os.path.join(cache_dir, file_sha256(file_path))
+        cached_paths = [os.path.join(sheet_cache_dir, f"{i}.pkl") for i in range(len(SHEET_NAMES))]
+        if all(os.path.exists(path) for path in cached_paths):
+            try:
+                return {name: pd.read_pickle(path) for name, path in zip(SHEET_NAMES, cached_paths)}
+            except Exception as e:
+                # Unreadable cache (e.g. written by another pandas version), parse the workbook again
+                print(f"Ignoring sheet cache in {sheet_cache_dir}: {e}")
+
+    sheets = read_workbook_sheets(file_path)
+
+    if sheet_cache_dir:
+        os.makedirs(sheet_cache_dir, exist_ok=True)
+        for i, name in enumerate(SHEET_NAMES):
+            path = os.path.join(sheet_cache_dir, f"{i}.pkl")
+            # write to a temporary name first so an interrupted run never leaves a partial cache
+            # the pid keeps apart the workers of a batch converting copies of the same workbook
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            sheets[name].to_pickle(tmp_path)
+            os.replace(tmp_path, path)
+
+    return sheets
+
+
+# A JSON array whose items are generated while the resource is serialized, so the concepts and elements
+# of a large resource are never all held in memory as dicts. make_item turns each input row into a JSON item.
+class StreamedArray:
+    def __init__(self, rows, make_item):
+        self.rows = rows
+        self.make_item = make_item
+
+    def __iter__(self):
+        return map(self.make_item, self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+# Function to create the JSON of a (code, display) concept
+def concept_json(concept):
+    code, display = concept
+    return {"code": code, "display": display}
+
+# Function to create the JSON of a ConceptMap element from a (source code, source display, [(target code, target display), ...])
+# element of group_map_rows, every target with the same equivalence
+def element_json(element, equivalence=default_equivalence):
+    sourceCode, sourceDisplay, targets = element
+    return {"code": sourceCode, "display": sourceDisplay, "target": [{"code": targetCode, "display": targetDisplay, "equivalence": equivalence} for targetCode, targetDisplay in targets]}
+
+# Function to group the (source code, source display, target code, target display) rows of a map by source code, so
+# each source code has a single element with all its targets, $translate then finds them in one element.
+# Codes keep the order they first appear in, with the display of their first row, and a target repeated by
+# several rows is kept once. Returns a list of (source code, source display, [(target code, target display), ...])
+def group_map_rows(map_values):
+    elements = {}
+    for sourceCode, sourceDisplay, targetCode, targetDisplay in map_values:
+        element = elements.get(sourceCode)
+        if element is None:
+            element = elements[sourceCode] = (sourceCode, sourceDisplay, {})
+        element[2].setdefault(targetCode, targetDisplay)
+    return [(code, display, list(targets.items())) for code, display, targets in elements.values()]
+
+# Function to get the id of a resource, derived from its canonical url so it is the same on every build
+def resource_id(url):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, url))
+
+# Function to get the canonical url of a ValueSet
+def value_set_url(oid):
+    return f"http://racsel.org/fhir/ValueSet/{oid}"
 
 # Function to create a ValueSet JSON manually
 def create_value_set_json(name, oid, concepts, uri=snomed_uri):
+    url = value_set_url(oid)
     value_set = {
         "resourceType": "ValueSet",
-        "id": str(uuid.uuid4()),
-        "url": f"http://racsel.org/fhir/ValueSet/{oid}",
+        "id": resource_id(url),
+        "url": url,
         "name": name,
         "status": "active",
         "compose": {
             "include": [
                 {
                     "system": uri,
-                    "concept": [{"code": code, "display": display} for code, display in concepts]
+                    "concept": StreamedArray(concepts, concept_json)
                 }
             ]
         }
     }
     return value_set
 
-# Function to extract SNOMED concepts from a dataframe with unique rows
-def extract_codes(df, code_col, display_col):
-    return df.iloc[2:, [code_col, display_col]].dropna().drop_duplicates().values.tolist()
+# Function to create a ValueSet that includes all the codes of other ValueSets (one include each, so it is their union)
+def create_parent_value_set_json(name, oid, value_set_urls):
+    url = value_set_url(oid)
+    value_set = {
+        "resourceType": "ValueSet",
+        "id": resource_id(url),
+        "url": url,
+        "name": name,
+        "status": "active",
+        "compose": {
+            "include": [{"valueSet": [included_url]} for included_url in value_set_urls]
+        }
+    }
+    return value_set
+
+# Function to split a list in consecutive chunks of at most max_size items, a single chunk without max_size
+def split_chunks(items, max_size=None):
+    if max_size is not None and max_size < 1:
+        raise ValueError(f"max_size must be at least 1, got {max_size}")
+    if not max_size or len(items) <= max_size:
+        return [items]
+    return [items[start:start + max_size] for start in range(0, len(items), max_size)]
+
+# Function to turn every sheet into a single long-format frame with one row per (sheet row, system), including
+# the empty cells. Columns: domain, row (the row number in the sheet), system, code, display.
+# Systems declared in DOMAINS whose columns are not in the sheet (e.g. no PreQual columns) are skipped.
+def stack_terms(sheets):
+    frames = []
+    for domain in DOMAINS:
+        df = sheets[domain.sheet]
+        data = df.iloc[2:]
+        columns = {system: cols for system, cols in domain.columns.items() if max(cols) < df.shape[1]}
+        if len(data) == 0 or not columns:
+            continue
+        codes = data.iloc[:, [code_col for code_col, _ in columns.values()]].to_numpy(dtype=object)
+        displays = data.iloc[:, [display_col for _, display_col in columns.values()]].to_numpy(dtype=object)
+        # stack the column groups: the first len(data) rows belong to the first system and so on
+        frames.append(pd.DataFrame({
+            "domain": domain.label,
+            # row 1 of the sheet holds the column names, so index i is row i + 2
+            "row": list(data.index + 2) * len(columns),
+            "system": [system for system in columns for _ in range(len(data))],
+            "code": codes.ravel(order="F"),
+            "display": displays.ravel(order="F"),
+        }))
+    if not frames:
+        return pd.DataFrame(columns=["domain", "row", "system", "code", "display"])
+    return pd.concat(frames, ignore_index=True)
+
+# Function to keep the terms that have both a code and a display
+def complete_terms(terms):
+    return terms[terms["code"].notna() & terms["display"].notna()]
+
+# Function to get the terms of every sheet that have both a code and a display, see stack_terms
+def extract_terms(sheets):
+    return complete_terms(stack_terms(sheets))
+
+# Function to find the defects of the stacked terms (see stack_terms) with grouped operations over all the sheets.
+# Returns a frame with one row per defect cell: severity, check, sheet, row, column (Excel letter), code, display, detail
+def validate_terms(terms):
+    has_code = terms["code"].notna()
+    has_display = terms["display"].notna()
+    complete = has_code & has_display
+    found = []
+
+    def report(mask, check, field="code", detail=None):
+        if mask.any():
+            defects = terms[mask].assign(check=check, field=field, detail="")
+            if detail is not None:
+                defects["detail"] = detail[mask]
+            found.append(defects)
+
+    report(has_code & ~has_display, "missing-display")
+    report(~has_code & has_display, "missing-code", "display")
+
+    # numbers in a text column end up as JSON numbers in the resources: any code that is not text in the text systems
+    # (a local or CIE10 code read as an int loses its leading zeros), SNOMED codes read as decimals (46635009.5)
+    code_types = terms["code"].map(type)
+    numeric = has_code & code_types.isin([float, int])
+    text_system = ~terms["system"].isin(NUMERIC_SYSTEMS)
+    report(has_code & ((text_system & (code_types != str)) | (~text_system & (code_types == float))), "numeric-code")
+    snomed = has_code & (terms["system"] == "snomed") & ~numeric
+    invalid = pd.Series(False, index=terms.index)
+    invalid[snomed] = ~terms.loc[snomed, "code"].astype(str).str.fullmatch(r"\d{6,18}").astype(bool)
+    report(invalid, "invalid-snomed")
+
+    # the same code of a system with more than one display, within or across sheets
+    keys = [terms["system"], terms["code"]]
+    displays = terms["display"].where(complete).groupby(keys, sort=False, dropna=True).transform("nunique")
+    conflict = complete & (displays > 1)
+    if conflict.any():
+        # the displays are joined once per conflicting code, not once per cell
+        conflicting = terms[conflict].drop_duplicates(["system", "code", "display"])
+        joined = conflicting["display"].astype(str).groupby([conflicting["system"], conflicting["code"]], sort=False).agg(" | ".join)
+        detail = pd.Series("", index=terms.index)
+        detail[conflict] = terms[conflict].merge(joined.rename("detail").reset_index(), on=["system", "code"], how="left")["detail"].values
+        report(conflict, "display-conflict", "display", detail)
+
+    # RACSEL and local codes identify a row of the sheet, a repeated one maps to several rows
+    row_key = complete & terms["system"].isin(ROW_KEY_SYSTEMS)
+    repeated = row_key & terms[["domain", "system", "code"]].where(row_key).duplicated(keep=False)
+    if repeated.any():
+        groups = terms[repeated].groupby(["domain", "system", "code"], sort=False)["row"]
+        detail = pd.Series("", index=terms.index)
+        detail[repeated] = "in " + groups.transform("size").astype(str) + " rows, first in row " + groups.transform("min").astype(str)
+        report(repeated, "repeated-code", "code", detail)
+
+    # rows with codes of some systems but not of a required one
+    row_has_code = has_code.groupby([terms["domain"], terms["row"]]).transform("any")
+    report(row_has_code & ~has_code & ~has_display & terms["system"].isin(REQUIRED_SYSTEMS), "unmapped-row")
+
+    if not found:
+        return pd.DataFrame(columns=["severity", "check", "sheet", "row", "column", "code", "display", "detail"])
+    defects = pd.concat(found)
+    # Excel column letter of every (domain, system, field) cell
+    cells = pd.DataFrame(
+        [(domain.label, system, field, chr(ord("A") + cols[field == "display"]), i)
+         for i, domain in enumerate(DOMAINS) for system, cols in domain.columns.items() for field in ("code", "display")],
+        columns=["domain", "system", "field", "column", "order"]
+    )
+    defects = defects.merge(cells, on=["domain", "system", "field"], how="left")
+    defects = defects.assign(
+        severity=defects["check"].map({check: severity for check, (severity, _) in VALIDATION_CHECKS.items()}),
+        sheet=defects["domain"].map({domain.label: domain.sheet for domain in DOMAINS}),
+    )
+    defects = defects.sort_values(["order", "row", "column"], kind="stable")
+    return defects[["severity", "check", "sheet", "row", "column", "code", "display", "detail"]].reset_index(drop=True)
+
+# Function to check a workbook without building the package
+def validate_workbook(file_path, cache_dir=None):
+    return validate_terms(stack_terms(load_workbook_sheets(file_path, cache_dir)))
+
+# Function to print the defects of a workbook, one per line
+def print_defects(file_path, defects):
+    errors = int((defects["severity"] == "error").sum())
+    print(f"{file_path}: {errors} errors, {len(defects) - errors} warnings")
+    for defect in defects.itertuples(index=False):
+        cell = f"'{defect.sheet.strip()}'!{defect.column}{defect.row}"
+        value = defect.code if pd.notna(defect.code) else defect.display
+        value = "empty" if pd.isna(value) else repr(value)
+        detail = f" ({defect.detail})" if defect.detail else ""
+        print(f"  {defect.severity:<8}{cell:<32} {defect.check:<18}{value}: {VALIDATION_CHECKS[defect.check][1]}{detail}")
+
+# Function to get the unique (code, display) concepts of each system in each domain
+# Returns a dict {(domain label, system): [(code, display), ...]}
+def project_codes(terms, registry=None):
+    registry = registry or build_concept_registry(terms)
+    codes = {}
+    for (domain, system), group in terms.groupby(["domain", "system"], sort=False):
+        displays = registry.displays[system]
+        codes[(domain, system)] = [[code, displays[code]] for code in group["code"].drop_duplicates()]
+    return codes
+
+# The concepts of every system deduplicated across the domains. displays is {system: {code: display}}, each code
+# once in the order it first appears; linked is {(domain label, system): other domains with a display of its codes},
+# the domains a resource with its concepts depends on; collapsed is {system: (concepts listed by the domains,
+# concepts kept, codes with conflicting displays)}, listed counting each (domain, code, display) once.
+ConceptRegistry = namedtuple("ConceptRegistry", ["displays", "linked", "collapsed"])
+
+# Function to build the concept registry of the terms (see ConceptRegistry). The candidates of every code are
+# counted in one grouped pass and indexed by code, a code with several displays keeps the one chosen by policy
+# (see DISPLAY_POLICIES). The codes repeated with the same display in several domains are simply listed once.
+def build_concept_registry(terms, policy="first"):
+    choose = DISPLAY_POLICIES[policy]
+    rows = terms.groupby(["system", "code", "display"], sort=False).size()
+    candidates = {system: {} for system in SYSTEMS}
+    for (system, code, display), count in rows.items():
+        candidates[system].setdefault(code, []).append((display, int(count)))
+
+    listed = terms.drop_duplicates(["domain", "system", "code", "display"]).groupby("system").size()
+    displays, collapsed = {}, {}
+    conflicting = set()
+    for system, codes in candidates.items():
+        displays[system] = {code: choose(options)[0] if len(options) > 1 else options[0][0] for code, options in codes.items()}
+        conflicts = {code for code, options in codes.items() if len(options) > 1}
+        conflicting.update((system, code) for code in conflicts)
+        collapsed[system] = (int(listed.get(system, 0)), len(codes), len(conflicts))
+
+    # a domain depends on the other domains that have one of its codes with a conflicting display
+    code_domains = {}
+    for domain, system, code in terms[["domain", "system", "code"]].drop_duplicates().itertuples(index=False):
+        if (system, code) in conflicting:
+            code_domains.setdefault((system, code), []).append(domain)
+    linked = {}
+    for (system, code), domains in code_domains.items():
+        for domain in domains:
+            linked.setdefault((domain, system), set()).update(other for other in domains if other != domain)
+    return ConceptRegistry(displays, {key: sorted(others) for key, others in linked.items()}, collapsed)
+
+# Function to print what the concept registry collapsed, one line per system with repeated concepts
+def print_collapsed(registry, policy="first"):
+    for system, (listed, kept, conflicts) in registry.collapsed.items():
+        if listed > kept:
+            resolved = f", {conflicts} codes with different displays resolved by the {policy} policy" if conflicts else ""
+            print(f"Deduplicated {SYSTEMS[system].label} concepts: {listed} listed by the sheets, {kept} kept{resolved}")
+
+# Function to get the direct maps of every domain from the rows that have both systems, in both directions
+# Returns a dict {(domain label, source system, target system): [(source code, source display, target code, target display), ...]}
+def project_maps(terms, pairs=DIRECT_MAP_PAIRS):
+    parts = {key: group[["row", "code", "display"]] for key, group in terms.groupby(["domain", "system"], sort=False)}
+    maps = {}
+    for domain in DOMAINS:
+        for source, target in pairs:
+            if source not in domain.columns or target not in domain.columns:
+                continue
+            if (domain.label, source) in parts and (domain.label, target) in parts:
+                joined = parts[(domain.label, source)].merge(parts[(domain.label, target)], on="row")
+                rows = joined[["code_x", "display_x", "code_y", "display_y"]].values.tolist()
+            else:
+                rows = []
+            maps[(domain.label, source, target)] = rows
+            # the reverse map is the same rows with the columns swapped
+            maps[(domain.label, target, source)] = [(c, d, a, b) for a, b, c, d in rows]
+    return maps
+
+# Function to compose two maps through their shared pivot system: (A -> pivot) + (pivot -> B) gives (A -> B).
+# The second map is indexed by its source code, so the cost is linear in the size of both maps
+# and the rows keep the same order as a nested loop over the first and then the second map.
+def compose_maps(first_map, second_map):
+    index = {}
+    for row in second_map:
+        index.setdefault(row[0], []).append(row)
+    return [(r[0], r[1], s[2], s[3]) for r in first_map for s in index.get(r[2], ())]
+
+# Function to list every transitive pair that can be built through the pivot system.
+# maps is a dict {(source system, target system): map values}; pairs that already have a
+# direct map are not derived again.
+def chain_pairs(maps, pivot="local"):
+    return [
+        (source, target)
+        for source in SYSTEMS
+        for target in SYSTEMS
+        if source != target and pivot not in (source, target) and (source, target) not in maps
+        and (source, pivot) in maps and (pivot, target) in maps
+    ]
 
-def extract_maps(df, source_code_col, source_display_col, target_code_col, target_display_col):
-    return df.iloc[2:, [source_code_col, source_display_col, target_code_col, target_display_col]].dropna().values.tolist()
+# Function to derive every transitive map that can be built through the pivot system.
+# Returns a dict with the same shape as maps with only the new pairs.
+def chain_maps(maps, pivot="local"):
+    return {(source, target): compose_maps(maps[(source, pivot)], maps[(pivot, target)]) for source, target in chain_pairs(maps, pivot)}
 
 # Function to create a CodeSystem JSON fragment
 def create_code_system_fragment(concepts_lists, code_system_uri, name):
@@ -64,22 +965,23 @@ def create_code_system_fragment(concepts_lists, code_system_uri, name):
     
     code_system = {
         "resourceType": "CodeSystem",
-        "id": str(uuid.uuid4()),
+        "id": resource_id(code_system_uri),
         "url": code_system_uri,
         "name": name,
         "version": "2024",
         "status": "active",
         "content": "fragment",
-        "concept": [{"code": code, "display": display} for code, display in all_concepts]
+        "concept": StreamedArray(all_concepts, concept_json)
     }
     return code_system
 
 # Function to create a ConceptMap JSON
-def create_concept_map(map_values, sourceUri, targetUri, name):
+def create_concept_map(map_values, sourceUri, targetUri, name, max_group_size=None, equivalence=default_equivalence):
+    url = str(sourceUri) + "/" + name.replace(" ", "-").lower()
     conceptMap = {
         "resourceType": "ConceptMap",
-        "id": str(uuid.uuid4()),
-        "url": str(sourceUri) + "/" + name.replace(" ", "-").lower(),
+        "id": resource_id(url),
+        "url": url,
         "name": name,
         "version": "2024",
         "status": "active",
@@ -89,16 +991,17 @@ def create_concept_map(map_values, sourceUri, targetUri, name):
     }
     
     # Add group if there map values
-    add_group_to_concept_map(conceptMap, sourceUri, targetUri, map_values)
+    add_group_to_concept_map(conceptMap, sourceUri, targetUri, map_values, max_group_size, equivalence)
 
     return conceptMap
 
 # Function to create a ValueSet-based ConceptMap JSON
-def create_valueset_concept_map(map_values, sourceValueSetUrl, targetValueSetUrl, sourceSystemUri, targetSystemUri, name):
+def create_valueset_concept_map(map_values, sourceValueSetUrl, targetValueSetUrl, sourceSystemUri, targetSystemUri, name, max_group_size=None, equivalence=default_equivalence):
+    url = f"http://racsel.org/fhir/ConceptMap/{name.replace(' ', '-').lower()}"
     conceptMap = {
         "resourceType": "ConceptMap",
-        "id": str(uuid.uuid4()),
-        "url": f"http://racsel.org/fhir/ConceptMap/{name.replace(' ', '-').lower()}",
+        "id": resource_id(url),
+        "url": url,
         "name": name.replace(" ", ""),
         "version": "2024",
         "status": "active",
@@ -108,670 +1011,504 @@ def create_valueset_concept_map(map_values, sourceValueSetUrl, targetValueSetUrl
     }
     
     # Add group if there are map values
-    add_group_to_valueset_concept_map(conceptMap, sourceSystemUri, targetSystemUri, map_values)
+    add_group_to_valueset_concept_map(conceptMap, sourceSystemUri, targetSystemUri, map_values, max_group_size, equivalence)
 
     return conceptMap
 
-def add_group_to_concept_map(conceptMap, sourceUri, targetUri, map_values):
+# The rows are grouped in one element per source code (see group_map_rows), large maps are split in several groups
+# with the same source and target of at most max_group_size elements
+def add_group_to_concept_map(conceptMap, sourceUri, targetUri, map_values, max_group_size=None, equivalence=default_equivalence):
     if len(map_values) > 0:
-        conceptMap["group"].append({
-            "source": sourceUri,
-            "target": targetUri,
-            "element": [{"code": sourceCode, "display": sourceDisplay, "target": [{"code": targetCode, "display": targetDisplay, "equivalence": "equivalent"}]} for sourceCode, sourceDisplay, targetCode, targetDisplay in map_values]
-        })
-
-def add_group_to_valueset_concept_map(conceptMap, sourceSystemUri, targetSystemUri, map_values):
+        for chunk in split_chunks(group_map_rows(map_values), max_group_size):
+            conceptMap["group"].append({
+                "source": sourceUri,
+                "target": targetUri,
+                "element": StreamedArray(chunk, functools.partial(element_json, equivalence=equivalence))
+            })
+
+def add_group_to_valueset_concept_map(conceptMap, sourceSystemUri, targetSystemUri, map_values, max_group_size=None, equivalence=default_equivalence):
     if len(map_values) > 0:
-        conceptMap["group"].append({
-            "source": sourceSystemUri,
-            "target": targetSystemUri,
-            "element": [{"code": sourceCode, "display": sourceDisplay, "target": [{"code": targetCode, "display": targetDisplay, "equivalence": "equivalent"}]} for sourceCode, sourceDisplay, targetCode, targetDisplay in map_values]
-        })
-
-# Function to convert the Excel file to FHIR
-def convert_to_fhir(file_path):
-    # Load all sheets into dataframes
-    antecedentes_df = pd.read_excel(file_path, sheet_name='Antecedentes Personales ')
-    diagnosticos_df = pd.read_excel(file_path, sheet_name='Diagnósticos')
-    vacunas_df = pd.read_excel(file_path, sheet_name='Vacunas')
-    alergias_df = pd.read_excel(file_path, sheet_name='Alergias')
-    medicacion_df = pd.read_excel(file_path, sheet_name='Medicación ')
-    procedimientos_df = pd.read_excel(file_path, sheet_name='Procedimientos')
-    
-    # set the local uri to default or colmuns(2_ in antecedentes_df if it exists
-    local_uri = antecedentes_df.columns[2] if antecedentes_df.columns[2] else "http://node-x.org/terminology/default"
-
-    # Extract codes from each sheet
-    antecedentes_concepts = extract_codes(antecedentes_df, 7, 8)
-    antecedentes_racsel = extract_codes(antecedentes_df, 1, 2)
-    antecedentes_cie10 = extract_codes(antecedentes_df, 5, 6)
-    antecedentes_local = extract_codes(antecedentes_df, 3, 4)
-    diagnosticos_concepts = extract_codes(diagnosticos_df, 7, 8)
-    diagnosticos_racsel = extract_codes(diagnosticos_df, 1, 2)
-    diagnosticos_cie10 = extract_codes(diagnosticos_df, 5, 6)
-    diagnosticos_local = extract_codes(diagnosticos_df, 3, 4)
-    vacunas_concepts = extract_codes(vacunas_df, 7, 8)
-    vacunas_racsel = extract_codes(vacunas_df, 1, 2)
-    vacunas_cie11 = extract_codes(vacunas_df, 5, 6)
-    vacunas_local = extract_codes(vacunas_df, 3, 4)
-    alergias_concepts = extract_codes(alergias_df, 7, 8)
-    alergias_racsel = extract_codes(alergias_df, 1, 2)
-    alergias_local = extract_codes(alergias_df, 3, 4)
-    medicacion_concepts = extract_codes(medicacion_df, 7, 8)
-    medicacion_racsel = extract_codes(medicacion_df, 1, 2)
-    medicacion_local = extract_codes(medicacion_df, 3, 4)
-    procedimientos_concepts = extract_codes(procedimientos_df, 7, 8)
-    procedimientos_racsel = extract_codes(procedimientos_df, 1, 2)
-    procedimientos_local = extract_codes(procedimientos_df, 3, 4)
-    #prequal
-    vacunas_prequal_concepts = extract_codes(vacunas_df, 9, 10)
-
-    # Forward maps
-    antecedentes_local_to_racsel = extract_maps(antecedentes_df, 3, 4, 1, 2)
-    antecedentes_local_to_cie10 = extract_maps(antecedentes_df, 3, 4, 5, 6)
-    antecedentes_local_to_snomed = extract_maps(antecedentes_df, 3, 4, 7, 8)
-    diagnosticos_local_to_racsel = extract_maps(diagnosticos_df, 3, 4, 1, 2)
-    diagnosticos_local_to_cie10 = extract_maps(diagnosticos_df, 3, 4, 5, 6)
-    diagnosticos_local_to_snomed = extract_maps(diagnosticos_df, 3, 4, 7, 8)
-    vacunas_local_to_racsel = extract_maps(vacunas_df, 3, 4, 1, 2)
-    vacunas_local_to_cie11 = extract_maps(vacunas_df, 3, 4, 5, 6)
-    vacunas_local_to_snomed = extract_maps(vacunas_df, 3, 4, 7, 8)
-    alergias_local_to_racsel = extract_maps(alergias_df, 3, 4, 1, 2)
-    alergias_local_to_snomed = extract_maps(alergias_df, 3, 4, 7, 8)
-    medicacion_local_to_racsel = extract_maps(medicacion_df, 3, 4, 1, 2)
-    medicacion_local_to_snomed = extract_maps(medicacion_df, 3, 4, 7, 8)
-    procedimientos_local_to_racsel = extract_maps(procedimientos_df, 3, 4, 1, 2)
-    procedimientos_local_to_snomed = extract_maps(procedimientos_df, 3, 4, 7, 8)
-    antecedentes_cie10_to_snomed = extract_maps(antecedentes_df, 5, 6, 7, 8)
-    diagnosticos_cie10_to_snomed = extract_maps(diagnosticos_df, 5, 6, 7, 8)
-    vacunas_cie11_to_snomed = extract_maps(vacunas_df, 5, 6, 7, 8)
-    #prequal
-    vacunas_local_to_prequal = extract_maps(vacunas_df, 3, 4, 9, 10)
-    vacunas_cie11_to_prequal = extract_maps(vacunas_df, 5, 6, 9, 10)
-    vacunas_snomed_to_prequal = extract_maps(vacunas_df, 7, 8, 9, 10)
-
-
-    # Reverse maps
-    antecedentes_racsel_to_local = extract_maps(antecedentes_df, 1, 2, 3, 4)
-    antecedentes_cie10_to_local = extract_maps(antecedentes_df, 5, 6, 3, 4)
-    antecedentes_snomed_to_local = extract_maps(antecedentes_df, 7, 8, 3, 4)
-    diagnosticos_racsel_to_local = extract_maps(diagnosticos_df, 1, 2, 3, 4)
-    diagnosticos_cie10_to_local = extract_maps(diagnosticos_df, 5, 6, 3, 4)
-    diagnosticos_snomed_to_local = extract_maps(diagnosticos_df, 7, 8, 3, 4)
-    vacunas_racsel_to_local = extract_maps(vacunas_df, 1, 2, 3, 4)
-    vacunas_cie11_to_local = extract_maps(vacunas_df, 5, 6, 3, 4)
-    vacunas_snomed_to_local = extract_maps(vacunas_df, 7, 8, 3, 4)
-    alergias_racsel_to_local = extract_maps(alergias_df, 1, 2, 3, 4)
-    alergias_snomed_to_local = extract_maps(alergias_df, 7, 8, 3, 4)
-    medicacion_racsel_to_local = extract_maps(medicacion_df, 1, 2, 3, 4)
-    medicacion_snomed_to_local = extract_maps(medicacion_df, 7, 8, 3, 4)
-    procedimientos_racsel_to_local = extract_maps(procedimientos_df, 1, 2, 3, 4)
-    procedimientos_snomed_to_local = extract_maps(procedimientos_df, 7, 8, 3, 4)
-    antecedentes_snomed_to_cie10 = extract_maps(antecedentes_df, 7, 8, 5, 6)
-    diagnosticos_snomed_to_cie10 = extract_maps(diagnosticos_df, 7, 8, 5, 6)
-    vacunas_snomed_to_cie11 = extract_maps(vacunas_df, 7, 8, 5, 6)
-
-    #prequal
-    vacunas_prequal_to_local = extract_maps(vacunas_df, 9, 10, 3, 4)
-    vacunas_prequal_to_cie11 = extract_maps(vacunas_df, 9, 10, 5, 6)
-    vacunas_prequal_to_snomed = extract_maps(vacunas_df, 9, 10, 7, 8)
-
-    local_to_racsel = antecedentes_local_to_racsel + diagnosticos_local_to_racsel + vacunas_local_to_racsel + alergias_local_to_racsel + medicacion_local_to_racsel + procedimientos_local_to_racsel
-    local_to_snomed = antecedentes_local_to_snomed + diagnosticos_local_to_snomed + vacunas_local_to_snomed + alergias_local_to_snomed + medicacion_local_to_snomed + procedimientos_local_to_snomed
-    local_to_cie10 = antecedentes_local_to_cie10 + diagnosticos_local_to_cie10
-    local_to_cie11 = vacunas_local_to_cie11
-    cie10_to_snomed = antecedentes_cie10_to_snomed + diagnosticos_cie10_to_snomed
-    cie11_to_snomed = vacunas_cie11_to_snomed
-    cie11_to_local = vacunas_cie11_to_local
-    racsel_to_local = antecedentes_racsel_to_local + diagnosticos_racsel_to_local + vacunas_racsel_to_local + alergias_racsel_to_local + medicacion_racsel_to_local + procedimientos_racsel_to_local
-    cie10_to_local = antecedentes_cie10_to_local + diagnosticos_cie10_to_local
-    snomed_to_local = antecedentes_snomed_to_local + diagnosticos_snomed_to_local + vacunas_snomed_to_local + alergias_snomed_to_local + medicacion_snomed_to_local + procedimientos_snomed_to_local
-    snomed_to_cie10 = antecedentes_snomed_to_cie10 + diagnosticos_snomed_to_cie10
-    snomed_to_cie11 = vacunas_snomed_to_cie11
-    
-    racselConnectathonUri = "http://racsel.org/connectathon"
-
-    # Create ValueSet JSONs
-    antecedentes_value_set_json = create_value_set_json("AntecedentesPersonalesValueSet", "antecedentes-personales-vs", antecedentes_concepts)
-    antecentes_racsel_value_set_json = create_value_set_json("AntecedentesPersonalesRacselValueSet", "antecedentes-personales-racsel-vs", antecedentes_racsel, racselConnectathonUri)
-    antecentes_local_value_set_json = create_value_set_json("AntecedentesPersonalesLocalValueSet", "antecedentes-personales-local-vs", antecedentes_local, local_uri)
-    diagnosticos_value_set_json = create_value_set_json("DiagnosticosValueSet", "diagnosticos-vs", diagnosticos_concepts)
-    diagnosticos_racsel_value_set_json = create_value_set_json("DiagnosticosRacselValueSet", "diagnosticos-racsel-vs", diagnosticos_racsel, racselConnectathonUri)
-    diagnosticos_local_value_set_json = create_value_set_json("DiagnosticosLocalValueSet", "diagnosticos-local-vs", diagnosticos_local, local_uri)
-    vacunas_value_set_json = create_value_set_json("VacunasValueSet", "vacunas-vs", vacunas_concepts)
-    vacunas_racsel_value_set_json = create_value_set_json("VacunasRacselValueSet", "vacunas-racsel-vs", vacunas_racsel, racselConnectathonUri)
-    vacunas_local_value_set_json = create_value_set_json("VacunasLocalValueSet", "vacunas-local-vs", vacunas_local, local_uri)
-    alergias_value_set_json = create_value_set_json("AlergiasValueSet", "alergias-vs", alergias_concepts)
-    alergias_racsel_value_set_json = create_value_set_json("AlergiasRacselValueSet", "alergias-racsel-vs", alergias_racsel, racselConnectathonUri)
-    alergias_local_value_set_json = create_value_set_json("AlergiasLocalValueSet", "alergias-local-vs", alergias_local, local_uri)
-    medicacion_value_set_json = create_value_set_json("MedicacionValueSet", "medicacion-vs", medicacion_concepts)
-    medicacion_racsel_value_set_json = create_value_set_json("MedicacionRacselValueSet", "medicacion-racsel-vs", medicacion_racsel, racselConnectathonUri)
-    medicacion_local_value_set_json = create_value_set_json("MedicacionLocalValueSet", "medicacion-local-vs", medicacion_local, local_uri)
-    procedimientos_value_set_json = create_value_set_json("ProcedimientosValueSet", "procedimientos-vs", procedimientos_concepts)
-    procedimientos_racsel_value_set_json = create_value_set_json("ProcedimientosRacselValueSet", "procedimientos-racsel-vs", procedimientos_racsel, racselConnectathonUri)
-    procedimientos_local_value_set_json = create_value_set_json("ProcedimientosLocalValueSet", "procedimientos-local-vs", procedimientos_local, local_uri)
-    racsel_value_set_json = create_value_set_json("RACSELValueSet", "racsel-vs", antecedentes_racsel + diagnosticos_racsel + vacunas_racsel + alergias_racsel + medicacion_racsel + procedimientos_racsel, racselConnectathonUri)
-    cie10_value_set_json = create_value_set_json("CIE10ValueSet", "cie10-vs", antecedentes_cie10 + diagnosticos_cie10, cie10_uri)
-    cie11_value_set_json = create_value_set_json("CIE11ValueSet", "cie11-vs", vacunas_cie11, cie11_uri)
-    local_value_set_json = create_value_set_json("LocalValueSet", "local-vs", antecedentes_local + diagnosticos_local + vacunas_local + alergias_local + medicacion_local + procedimientos_local, local_uri)
-    snomed_value_set_json = create_value_set_json("SNOMEDValueSet", "snomed-vs", antecedentes_concepts + diagnosticos_concepts + vacunas_concepts + alergias_concepts + medicacion_concepts + procedimientos_concepts, snomed_uri)  
-    #prequal
-    vacunas_prequal_value_set_json = create_value_set_json("PreQualValueSet", "prequal-vs", vacunas_prequal_concepts, prequal_uri)
-    
-    # Create CodeSystem JSONs - Unified approach
-    conceptes_local_dfs = [antecedentes_local, diagnosticos_local, vacunas_local, alergias_local, medicacion_local, procedimientos_local]
-    code_system_local_json = create_code_system_fragment(conceptes_local_dfs, local_uri, "LocalCodeSystem")
-    
-    concepts_dfs = [antecedentes_racsel, diagnosticos_racsel, vacunas_racsel, alergias_racsel, medicacion_racsel, procedimientos_racsel]
-    code_system_json = create_code_system_fragment(concepts_dfs, racselConnectathonUri, "RACSELCodeSystem")
-    concepts_cie10_dfs = [antecedentes_cie10, diagnosticos_cie10]
-    code_system_cie10_json = create_code_system_fragment(concepts_cie10_dfs, cie10_uri, "icd-10")
-    concepts_cie11_dfs = [vacunas_cie11]
-    code_system_cie11_json = create_code_system_fragment(concepts_cie11_dfs, cie11_uri, "icd-11")
-    
-    #prequal
-    concepts_prequal_dfs = [vacunas_prequal_concepts]
-    code_system_prequal_json = create_code_system_fragment(concepts_prequal_dfs, prequal_uri, "prequal")
-
-    # Create CodeSystem-based ConceptMaps - Unified approach
-    local_to_racsel_map_json = create_concept_map(local_to_racsel, local_uri, racselConnectathonUri, "Local to RACSEL")
-    local_to_snomed_map_json = create_concept_map(local_to_snomed, local_uri, snomed_uri, "Local to SNOMED")
-    local_to_cie10_map_json = create_concept_map(local_to_cie10, local_uri, cie10_uri, "Local to CIE10")
-    local_to_cie11_map_json = create_concept_map(local_to_cie11, local_uri, cie11_uri, "Local to CIE11")
-    racsel_to_local_map_json = create_concept_map(racsel_to_local, racselConnectathonUri, local_uri, "RACSEL to Local")
-    cie10_to_local_map_json = create_concept_map(cie10_to_local, cie10_uri, local_uri, "CIE10 to Local")
-    cie11_to_local_map_json = create_concept_map(cie11_to_local, cie11_uri, local_uri, "CIE11 to Local")
-    snomed_to_local_map_json = create_concept_map(snomed_to_local, snomed_uri, local_uri, "SNOMED to Local")
-    
-    cie10_to_snomed_map_json = create_concept_map(cie10_to_snomed, cie10_uri, snomed_uri, "CIE10 to SNOMED")
-    cie11_to_snomed_map_json = create_concept_map(cie11_to_snomed, cie11_uri, snomed_uri, "CIE11 to SNOMED")
-    snomed_to_cie10_map_json = create_concept_map(snomed_to_cie10, snomed_uri, cie10_uri, "SNOMED to CIE10")
-    snomed_to_cie11_map_json = create_concept_map(snomed_to_cie11, snomed_uri, cie11_uri, "SNOMED to CIE11")
-
-    #prequal
-    vacunas_local_to_prequal_map_json = create_concept_map(vacunas_local_to_prequal, local_uri, prequal_uri, "Local to PreQual")
-    vacunas_cie11_to_prequal_map_json = create_concept_map(vacunas_cie11_to_prequal, cie11_uri, prequal_uri, "CIE11 to PreQual")
-    vacunas_snomed_to_prequal_map_json = create_concept_map(vacunas_snomed_to_prequal, snomed_uri, prequal_uri, "SNOMED to PreQual")
-    vacunas_prequal_to_local_map_json = create_concept_map(vacunas_prequal_to_local, prequal_uri, local_uri, "PreQual to Local")
-    vacunas_prequal_to_cie11_map_json = create_concept_map(vacunas_prequal_to_cie11, prequal_uri, cie11_uri, "Prequal to CIE11")
-    vacunas_prequal_to_snomed_map_json = create_concept_map(vacunas_prequal_to_snomed, prequal_uri, snomed_uri, "PreQual to SNOMED")
-
-    # Create ValueSet-based ConceptMaps
-    
-    # Domain-specific ValueSet to ValueSet mappings - Antecedentes
-    vs_antecedentes_local_to_racsel_map = create_valueset_concept_map(
-        antecedentes_local_to_racsel, 
-        antecentes_local_value_set_json["url"], 
-        antecentes_racsel_value_set_json["url"],
-        local_uri,
-        racselConnectathonUri,
-        "VS Antecedentes Local to RACSEL"
-    )
-    vs_antecedentes_racsel_to_local_map = create_valueset_concept_map(
-        antecedentes_racsel_to_local,
-        antecentes_racsel_value_set_json["url"],
-        antecentes_local_value_set_json["url"],
-        racselConnectathonUri,
-        local_uri,
-        "VS Antecedentes RACSEL to Local"
-    )
-    vs_antecedentes_local_to_snomed_map = create_valueset_concept_map(
-        antecedentes_local_to_snomed,
-        antecentes_local_value_set_json["url"],
-        antecedentes_value_set_json["url"],
-        local_uri,
-        snomed_uri,
-        "VS Antecedentes Local to SNOMED"
-    )
-    vs_antecedentes_snomed_to_local_map = create_valueset_concept_map(
-        antecedentes_snomed_to_local,
-        antecedentes_value_set_json["url"],
-        antecentes_local_value_set_json["url"],
-        snomed_uri,
-        local_uri,
-        "VS Antecedentes SNOMED to Local"
-    )
-    # Create indirect RACSEL to SNOMED mappings via Local (for domains where direct mappings exist)
-    vs_antecedentes_racsel_to_snomed_map = create_valueset_concept_map(
-        # Create mapping by linking RACSEL->Local->SNOMED chains
-        [(r[0], r[1], s[2], s[3]) for r in antecedentes_racsel_to_local for s in antecedentes_local_to_snomed if r[2] == s[0]],
-        antecentes_racsel_value_set_json["url"],
-        antecedentes_value_set_json["url"],
-        racselConnectathonUri,
-        snomed_uri,
-        "VS Antecedentes RACSEL to SNOMED"
-    )
-    vs_antecedentes_snomed_to_racsel_map = create_valueset_concept_map(
-        # Create reverse mapping by linking SNOMED->Local->RACSEL chains
-        [(s[0], s[1], r[2], r[3]) for s in antecedentes_snomed_to_local for r in antecedentes_local_to_racsel if s[2] == r[0]],
-        antecedentes_value_set_json["url"],
-        antecentes_racsel_value_set_json["url"],
-        snomed_uri,
-        racselConnectathonUri,
-        "VS Antecedentes SNOMED to RACSEL"
-    )
-
-    # Domain-specific ValueSet to ValueSet mappings - Diagnósticos
-    vs_diagnosticos_local_to_racsel_map = create_valueset_concept_map(
-        diagnosticos_local_to_racsel,
-        diagnosticos_local_value_set_json["url"],
-        diagnosticos_racsel_value_set_json["url"],
-        local_uri,
-        racselConnectathonUri,
-        "VS Diagnosticos Local to RACSEL"
-    )
-    vs_diagnosticos_racsel_to_local_map = create_valueset_concept_map(
-        diagnosticos_racsel_to_local,
-        diagnosticos_racsel_value_set_json["url"],
-        diagnosticos_local_value_set_json["url"],
-        racselConnectathonUri,
-        local_uri,
-        "VS Diagnosticos RACSEL to Local"
-    )
-    vs_diagnosticos_local_to_snomed_map = create_valueset_concept_map(
-        diagnosticos_local_to_snomed,
-        diagnosticos_local_value_set_json["url"],
-        diagnosticos_value_set_json["url"],
-        local_uri,
-        snomed_uri,
-        "VS Diagnosticos Local to SNOMED"
-    )
-    vs_diagnosticos_snomed_to_local_map = create_valueset_concept_map(
-        diagnosticos_snomed_to_local,
-        diagnosticos_value_set_json["url"],
-        diagnosticos_local_value_set_json["url"],
-        snomed_uri,
-        local_uri,
-        "VS Diagnosticos SNOMED to Local"
-    )
-    vs_diagnosticos_local_to_cie10_map = create_valueset_concept_map(
-        diagnosticos_local_to_cie10,
-        diagnosticos_local_value_set_json["url"],
-        cie10_value_set_json["url"],
-        local_uri,
-        cie10_uri,
-        "VS Diagnosticos Local to CIE10"
-    )
-    vs_diagnosticos_cie10_to_local_map = create_valueset_concept_map(
-        diagnosticos_cie10_to_local,
-        cie10_value_set_json["url"],
-        diagnosticos_local_value_set_json["url"],
-        cie10_uri,
-        local_uri,
-        "VS Diagnosticos CIE10 to Local"
-    )
-    # RACSEL to SNOMED mappings for Diagnósticos
-    vs_diagnosticos_racsel_to_snomed_map = create_valueset_concept_map(
-        [(r[0], r[1], s[2], s[3]) for r in diagnosticos_racsel_to_local for s in diagnosticos_local_to_snomed if r[2] == s[0]],
-        diagnosticos_racsel_value_set_json["url"],
-        diagnosticos_value_set_json["url"],
-        racselConnectathonUri,
-        snomed_uri,
-        "VS Diagnosticos RACSEL to SNOMED"
-    )
-    vs_diagnosticos_snomed_to_racsel_map = create_valueset_concept_map(
-        [(s[0], s[1], r[2], r[3]) for s in diagnosticos_snomed_to_local for r in diagnosticos_local_to_racsel if s[2] == r[0]],
-        diagnosticos_value_set_json["url"],
-        diagnosticos_racsel_value_set_json["url"],
-        snomed_uri,
-        racselConnectathonUri,
-        "VS Diagnosticos SNOMED to RACSEL"
-    )
-
-    # Domain-specific ValueSet to ValueSet mappings - Vacunas
-    vs_vacunas_local_to_racsel_map = create_valueset_concept_map(
-        vacunas_local_to_racsel,
-        vacunas_local_value_set_json["url"],
-        vacunas_racsel_value_set_json["url"],
-        local_uri,
-        racselConnectathonUri,
-        "VS Vacunas Local to RACSEL"
-    )
-    vs_vacunas_racsel_to_local_map = create_valueset_concept_map(
-        vacunas_racsel_to_local,
-        vacunas_racsel_value_set_json["url"],
-        vacunas_local_value_set_json["url"],
-        racselConnectathonUri,
-        local_uri,
-        "VS Vacunas RACSEL to Local"
-    )
-    vs_vacunas_local_to_snomed_map = create_valueset_concept_map(
-        vacunas_local_to_snomed,
-        vacunas_local_value_set_json["url"],
-        vacunas_value_set_json["url"],
-        local_uri,
-        snomed_uri,
-        "VS Vacunas Local to SNOMED"
-    )
-    vs_vacunas_snomed_to_local_map = create_valueset_concept_map(
-        vacunas_snomed_to_local,
-        vacunas_value_set_json["url"],
-        vacunas_local_value_set_json["url"],
-        snomed_uri,
-        local_uri,
-        "VS Vacunas SNOMED to Local"
-    )
-    vs_vacunas_local_to_cie11_map = create_valueset_concept_map(
-        vacunas_local_to_cie11,
-        vacunas_local_value_set_json["url"],
-        cie11_value_set_json["url"],
-        local_uri,
-        cie11_uri,
-        "VS Vacunas Local to CIE11"
-    )
-    vs_vacunas_cie11_to_local_map = create_valueset_concept_map(
-        vacunas_cie11_to_local,
-        cie11_value_set_json["url"],
-        vacunas_local_value_set_json["url"],
-        cie11_uri,
-        local_uri,
-        "VS Vacunas CIE11 to Local"
-    )
-    # RACSEL to SNOMED mappings for Vacunas
-    vs_vacunas_racsel_to_snomed_map = create_valueset_concept_map(
-        [(r[0], r[1], s[2], s[3]) for r in vacunas_racsel_to_local for s in vacunas_local_to_snomed if r[2] == s[0]],
-        vacunas_racsel_value_set_json["url"],
-        vacunas_value_set_json["url"],
-        racselConnectathonUri,
-        snomed_uri,
-        "VS Vacunas RACSEL to SNOMED"
-    )
-    vs_vacunas_snomed_to_racsel_map = create_valueset_concept_map(
-        [(s[0], s[1], r[2], r[3]) for s in vacunas_snomed_to_local for r in vacunas_local_to_racsel if s[2] == r[0]],
-        vacunas_value_set_json["url"],
-        vacunas_racsel_value_set_json["url"],
-        snomed_uri,
-        racselConnectathonUri,
-        "VS Vacunas SNOMED to RACSEL"
-    )
-
-
-    #prequal
-    vs_vacunas_local_to_prequal_map = create_valueset_concept_map(
-        vacunas_local_to_prequal,
-        vacunas_local_value_set_json["url"],
-        vacunas_prequal_value_set_json["url"],
-        local_uri,
-        prequal_uri,
-        "VS Vacunas Local to PreQual"
-    )
-
-    vs_vacunas_cie11_to_prequal_map = create_valueset_concept_map(
-        vacunas_cie11_to_prequal,
-        cie11_value_set_json["url"],
-        vacunas_prequal_value_set_json["url"],
-        local_uri,
-        prequal_uri,
-        "VS Vacunas CIE11 to PreQual"
-    )
-
-    vs_vacunas_snomed_to_prequal_map = create_valueset_concept_map(
-        vacunas_snomed_to_prequal,
-        snomed_value_set_json["url"],
-        vacunas_prequal_value_set_json["url"],
-        local_uri,
-        snomed_uri,
-        "VS Vacunas SNOMED to PreQual"
-    )
-    
-    #prequal
-    vs_vacunas_prequal_to_local_map = create_valueset_concept_map(
-        vacunas_prequal_to_local,
-        vacunas_prequal_value_set_json["url"],
-        vacunas_local_value_set_json["url"],
-        prequal_uri,
-        local_uri,
-        "VS Vacunas PreQual to Local"
-    )
-
-
-    vs_vacunas_prequal_to_cie11_map =  create_valueset_concept_map(
-        vacunas_prequal_to_cie11,
-        vacunas_prequal_value_set_json["url"],
-        cie11_value_set_json["url"],
-        prequal_uri,
-        cie11_uri,
-        "VS Vacunas PreQual to CIE11"
-    )
-
-    vs_vacunas_prequal_to_snomed_map =  create_valueset_concept_map(
-        vacunas_prequal_to_snomed,
-        vacunas_prequal_value_set_json["url"],
-        snomed_value_set_json["url"],
-        prequal_uri,
-        snomed_uri,
-        "VS Vacunas PreQual to SNOMED"
-    )
-
-
-
-
-
-
-    # Domain-specific ValueSet to ValueSet mappings - Alergias
-    vs_alergias_local_to_racsel_map = create_valueset_concept_map(
-        alergias_local_to_racsel,
-        alergias_local_value_set_json["url"],
-        alergias_racsel_value_set_json["url"],
-        local_uri,
-        racselConnectathonUri,
-        "VS Alergias Local to RACSEL"
-    )
-    vs_alergias_racsel_to_local_map = create_valueset_concept_map(
-        alergias_racsel_to_local,
-        alergias_racsel_value_set_json["url"],
-        alergias_local_value_set_json["url"],
-        racselConnectathonUri,
-        local_uri,
-        "VS Alergias RACSEL to Local"
-    )
-    vs_alergias_local_to_snomed_map = create_valueset_concept_map(
-        alergias_local_to_snomed,
-        alergias_local_value_set_json["url"],
-        alergias_value_set_json["url"],
-        local_uri,
-        snomed_uri,
-        "VS Alergias Local to SNOMED"
-    )
-    vs_alergias_snomed_to_local_map = create_valueset_concept_map(
-        alergias_snomed_to_local,
-        alergias_value_set_json["url"],
-        alergias_local_value_set_json["url"],
-        snomed_uri,
-        local_uri,
-        "VS Alergias SNOMED to Local"
-    )
-    
-    # RACSEL to SNOMED mappings for Alergias
-    vs_alergias_racsel_to_snomed_map = create_valueset_concept_map(
-        [(r[0], r[1], s[2], s[3]) for r in alergias_racsel_to_local for s in alergias_local_to_snomed if r[2] == s[0]],
-        alergias_racsel_value_set_json["url"],
-        alergias_value_set_json["url"],
-        racselConnectathonUri,
-        snomed_uri,
-        "VS Alergias RACSEL to SNOMED"
-    )
-
-    vs_alergias_snomed_to_racsel_map = create_valueset_concept_map(
-        [(s[0], s[1], r[2], r[3]) for s in alergias_snomed_to_local for r in alergias_local_to_racsel if s[2] == r[0]],
-        alergias_value_set_json["url"],
-        alergias_racsel_value_set_json["url"],
-        snomed_uri,
-        racselConnectathonUri,
-        "VS Alergias SNOMED to RACSEL"
-    )
-
-    # Domain-specific ValueSet to ValueSet mappings - Medicación
-    vs_medicacion_local_to_racsel_map = create_valueset_concept_map(
-        medicacion_local_to_racsel,
-        medicacion_local_value_set_json["url"],
-        medicacion_racsel_value_set_json["url"],
-        local_uri,
-        racselConnectathonUri,
-        "VS Medicacion Local to RACSEL"
-    )
-    vs_medicacion_racsel_to_local_map = create_valueset_concept_map(
-        medicacion_racsel_to_local,
-        medicacion_racsel_value_set_json["url"],
-        medicacion_local_value_set_json["url"],
-        racselConnectathonUri,
-        local_uri,
-        "VS Medicacion RACSEL to Local"
-    )
-    vs_medicacion_local_to_snomed_map = create_valueset_concept_map(
-        medicacion_local_to_snomed,
-        medicacion_local_value_set_json["url"],
-        medicacion_value_set_json["url"],
-        local_uri,
-        snomed_uri,
-        "VS Medicacion Local to SNOMED"
-    )
-    vs_medicacion_snomed_to_local_map = create_valueset_concept_map(
-        medicacion_snomed_to_local,
-        medicacion_value_set_json["url"],
-        medicacion_local_value_set_json["url"],
-        snomed_uri,
-        local_uri,
-        "VS Medicacion SNOMED to Local"
-    )
-    # RACSEL to SNOMED mappings for Medicación
-    vs_medicacion_racsel_to_snomed_map = create_valueset_concept_map(
-        [(r[0], r[1], s[2], s[3]) for r in medicacion_racsel_to_local for s in medicacion_local_to_snomed if r[2] == s[0]],
-        medicacion_racsel_value_set_json["url"],
-        medicacion_value_set_json["url"],
-        racselConnectathonUri,
-        snomed_uri,
-        "VS Medicacion RACSEL to SNOMED"
-    )
-    vs_medicacion_snomed_to_racsel_map = create_valueset_concept_map(
-        [(s[0], s[1], r[2], r[3]) for s in medicacion_snomed_to_local for r in medicacion_local_to_racsel if s[2] == r[0]],
-        medicacion_value_set_json["url"],
-        medicacion_racsel_value_set_json["url"],
-        snomed_uri,
-        racselConnectathonUri,
-        "VS Medicacion SNOMED to RACSEL"
-    )
-
-    # Domain-specific ValueSet to ValueSet mappings - Procedimientos
-    vs_procedimientos_local_to_racsel_map = create_valueset_concept_map(
-        procedimientos_local_to_racsel,
-        procedimientos_local_value_set_json["url"],
-        procedimientos_racsel_value_set_json["url"],
-        local_uri,
-        racselConnectathonUri,
-        "VS Procedimientos Local to RACSEL"
-    )
-    vs_procedimientos_racsel_to_local_map = create_valueset_concept_map(
-        procedimientos_racsel_to_local,
-        procedimientos_racsel_value_set_json["url"],
-        procedimientos_local_value_set_json["url"],
-        racselConnectathonUri,
-        local_uri,
-        "VS Procedimientos RACSEL to Local"
-    )
-    vs_procedimientos_local_to_snomed_map = create_valueset_concept_map(
-        procedimientos_local_to_snomed,
-        procedimientos_local_value_set_json["url"],
-        procedimientos_value_set_json["url"],
-        local_uri,
-        snomed_uri,
-        "VS Procedimientos Local to SNOMED"
-    )
-    vs_procedimientos_snomed_to_local_map = create_valueset_concept_map(
-        procedimientos_snomed_to_local,
-        procedimientos_value_set_json["url"],
-        procedimientos_local_value_set_json["url"],
-        snomed_uri,
-        local_uri,
-        "VS Procedimientos SNOMED to Local"
-    )
-    # RACSEL to SNOMED mappings for Procedimientos
-    vs_procedimientos_racsel_to_snomed_map = create_valueset_concept_map(
-        [(r[0], r[1], s[2], s[3]) for r in procedimientos_racsel_to_local for s in procedimientos_local_to_snomed if r[2] == s[0]],
-        procedimientos_racsel_value_set_json["url"],
-        procedimientos_value_set_json["url"],
-        racselConnectathonUri,
-        snomed_uri,
-        "VS Procedimientos RACSEL to SNOMED"
-    )
-    vs_procedimientos_snomed_to_racsel_map = create_valueset_concept_map(
-        [(s[0], s[1], r[2], r[3]) for s in procedimientos_snomed_to_local for r in procedimientos_local_to_racsel if s[2] == r[0]],
-        procedimientos_value_set_json["url"],
-        procedimientos_racsel_value_set_json["url"],
-        snomed_uri,
-        racselConnectathonUri,
-        "VS Procedimientos SNOMED to RACSEL"
-    )
-
-    # Global ValueSet to ValueSet mappings
-    vs_local_to_racsel_global_map = create_valueset_concept_map(
-        local_to_racsel,
-        local_value_set_json["url"],
-        racsel_value_set_json["url"],
-        local_uri,
-        racselConnectathonUri,
-        "VS Local Global to RACSEL Global"
-    )
-    vs_racsel_to_local_global_map = create_valueset_concept_map(
-        racsel_to_local,
-        racsel_value_set_json["url"],
-        local_value_set_json["url"],
-        racselConnectathonUri,
-        local_uri,
-        "VS RACSEL Global to Local Global"
-    )
-    vs_local_to_snomed_global_map = create_valueset_concept_map(
-        local_to_snomed,
-        local_value_set_json["url"],
-        snomed_value_set_json["url"],
-        local_uri,
-        snomed_uri,
-        "VS Local Global to SNOMED Global"
-    )
-    vs_snomed_to_local_global_map = create_valueset_concept_map(
-        snomed_to_local,
-        snomed_value_set_json["url"],
-        local_value_set_json["url"],
-        snomed_uri,
-        local_uri,
-        "VS SNOMED Global to Local Global"
-    )
-    vs_cie10_to_snomed_global_map = create_valueset_concept_map(
-        cie10_to_snomed,
-        cie10_value_set_json["url"],
-        snomed_value_set_json["url"],
-        cie10_uri,
-        snomed_uri,
-        "VS CIE10 Global to SNOMED Global"
-    )
-    vs_snomed_to_cie10_global_map = create_valueset_concept_map(
-        snomed_to_cie10,
-        snomed_value_set_json["url"],
-        cie10_value_set_json["url"],
-        snomed_uri,
-        cie10_uri,
-        "VS SNOMED Global to CIE10 Global"
-    )
-    vs_cie11_to_snomed_global_map = create_valueset_concept_map(
-        cie11_to_snomed,
-        cie11_value_set_json["url"],
-        snomed_value_set_json["url"],
-        cie11_uri,
-        snomed_uri,
-        "VS CIE11 Global to SNOMED Global"
-    )
-    vs_snomed_to_cie11_global_map = create_valueset_concept_map(
-        snomed_to_cie11,
-        snomed_value_set_json["url"],
-        cie11_value_set_json["url"],
-        snomed_uri,
-        cie11_uri,
-        "VS SNOMED Global to CIE11 Global"
-    )
-
-
-    # prepare FHIR package
-
+        for chunk in split_chunks(group_map_rows(map_values), max_group_size):
+            conceptMap["group"].append({
+                "source": sourceSystemUri,
+                "target": targetSystemUri,
+                "element": StreamedArray(chunk, functools.partial(element_json, equivalence=equivalence))
+            })
+
+# Writer producing a single-member gzip stream whose blocks are deflated in parallel threads (zlib releases the GIL).
+# Every block is primed with the last 32KB of the previous one and ends with a sync flush, like pigz does,
+# so the result is a regular .tgz readable by Snowstorm, tar and gzip.
+class ParallelGzipWriter:
+    block_size = 1024 * 1024
+
+    def __init__(self, fileobj, level=9, threads=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.dictionary = b""
+        self.crc = 0
+        self.size = 0
+        # gzip header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+        self.fileobj.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", 0) + b"\x00\xff")
+
+    def _deflate(self, block, dictionary):
+        if dictionary:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def _submit(self, block):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(self.executor.submit(self._deflate, block, self.dictionary))
+        self.dictionary = block[-32768:]
+        # keep a bounded number of blocks in flight
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        # empty final deflate block and gzip trailer (CRC32 and size of the uncompressed data)
+        self.fileobj.write(zlib.compressobj(self.level, zlib.DEFLATED, -15).flush(zlib.Z_FINISH))
+        self.fileobj.write(struct.pack("<II", self.crc & 0xffffffff, self.size & 0xffffffff))
+
+# Function to open the output package as a tar archive with the selected compression backend
+@contextlib.contextmanager
+def open_package_tar(output_path, compression="gzip", level=9, threads=None):
+    if compression == "gzip":
+        # no file name and a fixed timestamp in the gzip header, so identical content gives an identical file
+        with open(output_path, "wb") as f, gzip.GzipFile(filename="", mode="wb", fileobj=f, compresslevel=level, mtime=package_mtime) as writer:
+            with tarfile.open(fileobj=writer, mode="w") as tar:
+                yield tar
+    elif compression == "gzip-mt":
+        with open(output_path, "wb") as f:
+            writer = ParallelGzipWriter(f, level, threads)
+            with tarfile.open(fileobj=writer, mode="w|") as tar:
+                yield tar
+            writer.close()
+    elif compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd compression requires the zstandard package (pip install zstandard)")
+        compressor = zstandard.ZstdCompressor(level=level, threads=-1 if threads is None else threads)
+        with open(output_path, "wb") as f, compressor.stream_writer(f) as writer:
+            with tarfile.open(fileobj=writer, mode="w|") as tar:
+                yield tar
+    else:
+        raise ValueError(f"Unknown compression {compression}, expected one of {', '.join(COMPRESSION_CHOICES)}")
+
+# Function to add an in-memory file to the package
+def add_bytes_to_tar(tar, arcname, data, mtime):
+    member = tarfile.TarInfo(arcname)
+    member.size = len(data)
+    member.mtime = mtime
+    member.mode = 0o644
+    tar.addfile(member, io.BytesIO(data))
+
+# Function to serialize a JSON document as it is stored in the package, with sorted keys so it is canonical
+def json_bytes(document):
+    return json.dumps(document, ensure_ascii=False, indent=2, sort_keys=True).encode("utf-8")
+
+# Function to encode a JSON value with the standard library, with sorted keys and without escaping non-ASCII
+# characters, indented by indent spaces or compact with indent None
+def encode_json_stdlib(value, indent=None):
+    separators = (",", ":") if indent is None else (",", ": ")
+    return json.dumps(value, ensure_ascii=False, indent=indent, separators=separators, sort_keys=True)
+
+# Function to encode a JSON value with orjson, written as encode_json_stdlib does (orjson only indents by 2)
+def encode_json_orjson(value, indent=None):
+    import orjson
+
+    option = orjson.OPT_SORT_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+    return orjson.dumps(value, option=option).decode("utf-8")
+
+# JSON encoders of the resources: name -> function encoding a value as encode_json_stdlib does
+JSON_ENCODERS = {
+    "json": encode_json_stdlib,
+    "orjson": encode_json_orjson,
+}
+
+# Function to get the name of the JSON encoder to use, auto is orjson when it is installed
+def json_encoder_name(name="auto"):
+    if name == "auto":
+        return "orjson" if importlib.util.find_spec("orjson") else "json"
+    if name == "orjson" and importlib.util.find_spec("orjson") is None:
+        raise RuntimeError("the orjson encoder requires the orjson package (pip install orjson)")
+    return name
+
+# Function to serialize a JSON document in small chunks, with sorted keys like json_bytes.
+# The items of a StreamedArray are generated and encoded stream_batch_size at a time, so memory does not grow
+# with the number of concepts. With indent=None the output is compact. encode is one of JSON_ENCODERS. Yields str chunks.
+def iter_json(value, indent=2, level=0, encode=encode_json_stdlib):
+    if not isinstance(value, (dict, list, tuple, StreamedArray)):
+        yield encode(value)
+        return
+    if len(value) == 0:
+        yield "{}" if isinstance(value, dict) else "[]"
+        return
+
+    if indent is None:
+        newline, closing, key_separator = "", "", ":"
+    else:
+        newline, closing, key_separator = "\n" + " " * (indent * (level + 1)), "\n" + " " * (indent * level), ": "
+
+    if isinstance(value, dict):
+        yield "{"
+        for i, key in enumerate(sorted(value)):
+            yield ("," if i else "") + newline + json.dumps(key, ensure_ascii=False) + key_separator
+            yield from iter_json(value[key], indent, level + 1, encode)
+        yield closing + "}"
+    elif isinstance(value, StreamedArray):
+        yield "["
+        items = iter(value)
+        first = True
+        while True:
+            batch = list(itertools.islice(items, stream_batch_size))
+            if not batch:
+                break
+            # the items are encoded as one array without its brackets, "[\n  a,\n  b\n]" at the first level,
+            # and moved to the current indentation
+            text = encode(batch, indent)
+            text = text[1:-1] if indent is None else text[1:-2].replace("\n", closing)
+            yield ("" if first else ",") + text
+            first = False
+        yield closing + "]"
+    else:
+        yield "["
+        for i, item in enumerate(value):
+            yield ("," if i else "") + newline
+            yield from iter_json(item, indent, level + 1, encode)
+        yield closing + "]"
+
+# Function to write a JSON document to a binary file with iter_json, in blocks of about 64KB
+# Returns the sha256 of the written bytes
+def write_json(document, f, indent=2, encode=encode_json_stdlib):
+    digest = hashlib.sha256()
+    chunks = []
+    buffered = 0
+    for chunk in iter_json(document, indent, encode=encode):
+        chunks.append(chunk)
+        buffered += len(chunk)
+        if buffered >= 65536:
+            data = "".join(chunks).encode("utf-8")
+            digest.update(data)
+            f.write(data)
+            chunks = []
+            buffered = 0
+    data = "".join(chunks).encode("utf-8")
+    digest.update(data)
+    f.write(data)
+    return digest.hexdigest()
+
+# Function to add a serialized resource to the package, data is the path of a file or a file object
+def add_file_to_tar(tar, arcname, data, mtime):
+    with (open(data, "rb") if isinstance(data, str) else contextlib.nullcontext(data)) as f:
+        f.seek(0, os.SEEK_END)
+        member = tarfile.TarInfo(arcname)
+        member.size = f.tell()
+        member.mtime = mtime
+        member.mode = 0o644
+        f.seek(0)
+        tar.addfile(member, f)
+
+# A resource of the package: its filename, the domains (sheets) its content comes from and
+# a callable that builds it, so unchanged resources can be taken from the build cache without building them
+ResourceJob = namedtuple("ResourceJob", ["filename", "domains", "build"])
+
+# Function to build a ValueSet-based ConceptMap of a domain derived through the pivot system
+def create_chained_valueset_concept_map(first_map, second_map, *args, **kwargs):
+    return create_valueset_concept_map(compose_maps(first_map, second_map), *args, **kwargs)
+
+# Function to plan a ValueSet. With max_size, a ValueSet with more concepts is split in parts of at most max_size
+# concepts (<name>PartN, <url>-part-N) and the ValueSet itself includes the parts, so its url stays the same.
+def plan_value_set(domains, name, oid, concepts, uri, max_size=None):
+    chunks = split_chunks(concepts, max_size)
+    if len(chunks) == 1:
+        return [ResourceJob(f"package/ValueSet/{name}.json", domains, functools.partial(create_value_set_json, name, oid, concepts, uri))]
+    jobs = [
+        ResourceJob(f"package/ValueSet/{name}Part{part}.json", domains, functools.partial(create_value_set_json, f"{name}Part{part}", f"{oid}-part-{part}", chunk, uri))
+        for part, chunk in enumerate(chunks, 1)
+    ]
+    part_urls = [value_set_url(f"{oid}-part-{part}") for part in range(1, len(chunks) + 1)]
+    jobs.append(ResourceJob(f"package/ValueSet/{name}.json", domains, functools.partial(create_parent_value_set_json, name, oid, part_urls)))
+    return jobs
+
+# Function to plan every FHIR resource of the package from the extracted codes and maps
+# max_resource_size limits the concepts of each ValueSet and the elements of each ConceptMap group.
+# registry (see build_concept_registry) gives the concepts of the global ValueSets and CodeSystems, each code once
+# across the domains, and the domains the ValueSet of each domain depends on.
+# equivalence is {(source, target): value} with None for every other map (see parse_equivalence)
+# Returns a list of ResourceJob
+def plan_resources(codes, maps, local_uri, max_resource_size=None, registry=None, equivalence=None):
+    system_uris = {system: spec.uri or local_uri for system, spec in SYSTEMS.items()}
+    equivalence = equivalence or {}
+    equivalences = {(source, target): equivalence.get((source, target), equivalence.get(None, default_equivalence)) for source in SYSTEMS for target in SYSTEMS}
+    jobs = []
+
+    # ValueSets per domain: SNOMED, RACSEL and local codes of each sheet
+    domain_value_set_urls = {}
+    for domain in DOMAINS:
+        for system, spec in SYSTEMS.items():
+            if spec.domain_value_set is None or system not in domain.columns:
+                continue
+            name = f"{domain.name}{spec.domain_value_set}ValueSet"
+            oid = f"{domain.oid}-{spec.domain_value_set.lower()}-vs" if spec.domain_value_set else f"{domain.oid}-vs"
+            domain_value_set_urls[(domain.label, system)] = value_set_url(oid)
+            domains = [domain.label] + (registry.linked.get((domain.label, system), []) if registry else [])
+            jobs += plan_value_set(domains, name, oid, codes.get((domain.label, system), []), system_uris[system], max_resource_size)
+
+    # Global ValueSets and CodeSystem fragments with the codes of all the domains
+    global_value_set_urls = {}
+    for system, spec in SYSTEMS.items():
+        domains = [domain.label for domain in DOMAINS if system in domain.columns]
+        if registry:
+            concepts_lists = [[[code, display] for code, display in registry.displays[system].items()]]
+        else:
+            concepts_lists = [codes.get((domain, system), []) for domain in domains]
+        global_value_set_urls[system] = value_set_url(spec.value_set_oid)
+        all_concepts = [concept for concepts in concepts_lists for concept in concepts]
+        jobs += plan_value_set(domains, spec.value_set_name, spec.value_set_oid, all_concepts, system_uris[system], max_resource_size)
+        if spec.code_system_name:
+            jobs.append(ResourceJob(
+                f"package/CodeSystem/{spec.code_system_name}.json",
+                domains,
+                functools.partial(create_code_system_fragment, concepts_lists, system_uris[system], spec.code_system_name)
+            ))
+
+    # CodeSystem-based ConceptMaps with the rows of all the domains
+    for pair in DIRECT_MAP_PAIRS:
+        for source, target in (pair, pair[::-1]):
+            domains = [domain.label for domain in DOMAINS if source in domain.columns and target in domain.columns]
+            if not domains:
+                continue
+            map_values = [row for domain in domains for row in maps[(domain, source, target)]]
+            name = f"{SYSTEMS[source].label} to {SYSTEMS[target].label}"
+            jobs.append(ResourceJob(
+                f"package/ConceptMap/{name.replace(' ', '-')}.json",
+                domains,
+                functools.partial(create_concept_map, map_values, system_uris[source], system_uris[target], name, max_group_size=max_resource_size, equivalence=equivalences[(source, target)])
+            ))
+
+    # ValueSet-based ConceptMaps between the global ValueSets
+    for pair in GLOBAL_VALUESET_MAP_PAIRS:
+        for source, target in (pair, pair[::-1]):
+            domains = [domain.label for domain in DOMAINS if source in domain.columns and target in domain.columns]
+            map_values = [row for domain in domains for row in maps[(domain, source, target)]]
+            name = f"VS {SYSTEMS[source].label} Global to {SYSTEMS[target].label} Global"
+            jobs.append(ResourceJob(
+                f"package/ConceptMap/{name.replace(' ', '-')}.json",
+                domains,
+                functools.partial(
+                    create_valueset_concept_map,
+                    map_values,
+                    global_value_set_urls[source],
+                    global_value_set_urls[target],
+                    system_uris[source],
+                    system_uris[target],
+                    name,
+                    max_group_size=max_resource_size,
+                    equivalence=equivalences[(source, target)]
+                )
+            ))
+
+    # Domain-specific ValueSet to ValueSet mappings, direct from the sheet rows and
+    # indirect through the local codes (RACSEL->Local->SNOMED, RACSEL->Local->CIE10, PreQual->Local->RACSEL, ...)
+    for domain in DOMAINS:
+        domain_maps = {(source, target): rows for (label, source, target), rows in maps.items() if label == domain.label}
+        pairs = [(source, target, None) for source, target in domain_maps] + [(source, target, "local") for source, target in chain_pairs(domain_maps)]
+        for source, target, pivot in pairs:
+            name = f"VS {domain.label} {SYSTEMS[source].label} to {SYSTEMS[target].label}"
+            args = (
+                domain_value_set_urls.get((domain.label, source), global_value_set_urls[source]),
+                domain_value_set_urls.get((domain.label, target), global_value_set_urls[target]),
+                system_uris[source],
+                system_uris[target],
+                name
+            )
+            if pivot:
+                build = functools.partial(create_chained_valueset_concept_map, domain_maps[(source, pivot)], domain_maps[(pivot, target)], *args, max_group_size=max_resource_size, equivalence=equivalences[(source, target)])
+            else:
+                build = functools.partial(create_valueset_concept_map, domain_maps[(source, target)], *args, max_group_size=max_resource_size, equivalence=equivalences[(source, target)])
+            jobs.append(ResourceJob(f"package/ConceptMap/{name.replace(' ', '-')}.json", [domain.label], build))
+
+    return jobs
+
+# Function to hash the rows of every sheet, the build cache reuses a resource while the sheets it comes from do not change
+# Returns a dict {domain label: sha256}
+def sheet_hashes(sheets):
+    hashes = {}
+    for domain in DOMAINS:
+        df = sheets[domain.sheet]
+        columns = sorted(col for cols in domain.columns.values() for col in cols if col < df.shape[1])
+        # repr keeps the cell types apart (e.g. 123 and "123" are written differently in the resources)
+        rows = repr(df.iloc[2:, columns].values.tolist())
+        hashes[domain.label] = hashlib.sha256(rows.encode("utf-8")).hexdigest()
+    return hashes
+
+# Hash of this script, part of every build cache key so a code change rebuilds every resource
+code_version = file_sha256(__file__)
+
+# Function to get the entry of a resource in the package manifest and index
+def resource_metadata(resource):
+    return {key: resource[key] for key in ("resourceType", "id", "url", "name", "version") if key in resource}
+
+# Function to build a resource and serialize it, to the build cache entry data_path and metadata_path when they
+# are given, to the binary file f otherwise. Returns the metadata of the resource, with the sha256 of its bytes
+def serialize_job(job, indent=2, encode=encode_json_stdlib, data_path=None, metadata_path=None, f=None):
+    resource = job.build()
+    metadata = resource_metadata(resource)
+    if data_path is None:
+        metadata["sha256"] = write_json(resource, f, indent, encode)
+        return metadata
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    # the data is written first, an entry is only used when its metadata exists.
+    # Temporary names include the pid, batch and build workers may build the same entry at the same time
+    with open(f"{data_path}.{os.getpid()}.tmp", "wb") as data:
+        metadata["sha256"] = write_json(resource, data, indent, encode)
+    os.replace(f"{data_path}.{os.getpid()}.tmp", data_path)
+    with open(f"{metadata_path}.{os.getpid()}.tmp", "wb") as data:
+        data.write(json_bytes(metadata))
+    os.replace(f"{metadata_path}.{os.getpid()}.tmp", metadata_path)
+    return metadata
+
+# Jobs of each build worker process, set once by init_build_worker (inherited without copying where processes fork)
+worker_jobs = None
+
+def init_build_worker(jobs):
+    global worker_jobs
+    worker_jobs = jobs
+
+# Function to build and serialize a job in a build worker, see serialize_job. Without a cache entry the resource is
+# written to output_path, a file of the parent's temporary directory, so only its path goes back through the pipe.
+# The worker measures it as Profiler.measure does (traced memory only when the parent traces it).
+# Returns the metadata, output_path or None, and the measures
+def serialize_worker_job(index, indent, encoder, data_path, metadata_path, output_path):
+    memory_start = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    if data_path:
+        metadata = serialize_job(worker_jobs[index], indent, JSON_ENCODERS[encoder], data_path, metadata_path)
+        output_path = None
+    else:
+        with open(output_path, "wb") as f:
+            metadata = serialize_job(worker_jobs[index], indent, JSON_ENCODERS[encoder], f=f)
+    memory_end, memory_peak = tracemalloc.get_traced_memory()
+    measures = {
+        "start": wall_start,
+        "wall": time.perf_counter() - wall_start,
+        "cpu": time.process_time() - cpu_start,
+        "memory_peak": memory_peak - memory_start,
+        "memory_delta": memory_end - memory_start,
+        "worker": os.getpid(),
+    }
+    return metadata, output_path, measures
+
+# Function to build and serialize the package resources, reusing the serialized resources of the
+# build cache for every resource whose sheets did not change.
+# Resources are streamed to their build cache file, or to a spooled temporary file without a cache.
+# memory_cache is a dict kept by a long-running caller (--watch) with the serialized resources of the last build,
+# checked before the build cache and left with the resources of this build only.
+# settings are the other options that change the resources (display policy, equivalences), part of the cache key.
+# The resources not reused are built by up to workers processes at once (default: number of CPUs), each one encoded with the JSON encoder named
+# encoder (see JSON_ENCODERS). Each resource is measured where it is built and the processes used are kept in the profiler.
+# Returns a list of (metadata, package filename, serialized resource path or file) and the number of reused resources
+def build_package_members(jobs, hashes, local_uri, build_cache_dir=None, compact=False, max_resource_size=None, profiler=None, memory_cache=None, settings=None,
+                          workers=1, encoder="json"):
+    profiler = profiler or Profiler(enabled=False)
+    indent = None if compact else 2
+    settings = {**(settings or {}), "encoder": encoder}
+    members = [None] * len(jobs)
+    keys, paths, pending = [], [], []
+    reused = 0
+    for position, job in enumerate(jobs):
+        key_source = "\n".join([code_version, job.filename, str(local_uri), f"indent:{indent}", f"max_resource_size:{max_resource_size}"] + [f"{name}:{value!r}" for name, value in sorted(settings.items())] + [f"{domain}:{hashes[domain]}" for domain in job.domains])
+        key = hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+        data_path = os.path.join(build_cache_dir, key + ".json") if build_cache_dir else None
+        metadata_path = os.path.join(build_cache_dir, key + ".meta.json") if build_cache_dir else None
+        keys.append(key)
+        paths.append((data_path, metadata_path))
+
+        if memory_cache is not None and key in memory_cache:
+            metadata, content = memory_cache[key]
+            members[position] = (metadata, job.filename, io.BytesIO(content))
+        elif data_path and os.path.exists(data_path) and os.path.exists(metadata_path):
+            with open(metadata_path, encoding="utf-8") as f:
+                members[position] = (json.load(f), job.filename, data_path)
+        else:
+            pending.append(position)
+            continue
+        reused += 1
+        with profiler.resource(job.filename) as record:
+            data = members[position][2]
+            record["reused"] = True
+            record["bytes"] = os.path.getsize(data) if isinstance(data, str) else data.seek(0, os.SEEK_END)
+
+    workers = min(workers or os.cpu_count() or 1, len(pending))
+    profiler.build_workers = max(workers, 1)
+    if workers > 1:
+        # fork shares the jobs with the workers as they are, other start methods send them once to each worker
+        context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+        pending_jobs = [jobs[position] for position in pending]
+        with tempfile.TemporaryDirectory(prefix="racsel-build-") as output_dir, \
+                ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_build_worker, initargs=(pending_jobs,)) as executor:
+            futures = [executor.submit(serialize_worker_job, index, indent, encoder, *paths[position], os.path.join(output_dir, f"{index}.json"))
+                       for index, position in enumerate(pending)]
+            for position, future in zip(pending, futures):
+                metadata, output_path, measures = future.result()
+                data = paths[position][0]
+                if output_path is not None:
+                    # moved to a spooled file as in a serial build, the worker files go with the directory
+                    data = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+                    with open(output_path, "rb") as f:
+                        shutil.copyfileobj(f, data)
+                    os.remove(output_path)
+                members[position] = (metadata, jobs[position].filename, data)
+                profiler.add_resource(jobs[position].filename, measures, reused=False, bytes=os.path.getsize(data) if isinstance(data, str) else data.seek(0, os.SEEK_END))
+    else:
+        for position in pending:
+            job = jobs[position]
+            with profiler.resource(job.filename) as record:
+                data_path, metadata_path = paths[position]
+                data = data_path or tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+                metadata = serialize_job(job, indent, JSON_ENCODERS[encoder], data_path, metadata_path, None if data_path else data)
+                record["reused"] = False
+                record["bytes"] = os.path.getsize(data) if isinstance(data, str) else data.seek(0, os.SEEK_END)
+            members[position] = (metadata, job.filename, data)
+
+    if memory_cache is not None:
+        kept = {}
+        for key, (metadata, _, data) in zip(keys, members):
+            if key in memory_cache:
+                kept[key] = memory_cache[key]
+            else:
+                with (open(data, "rb") if isinstance(data, str) else contextlib.nullcontext(data)) as f:
+                    f.seek(0)
+                    kept[key] = (metadata, f.read())
+        memory_cache.clear()
+        memory_cache.update(kept)
+    return members, reused
+
+# Function to write the FHIR package with its manifest (package.json) and index (.index.json)
+# members is a list of (metadata, package filename, serialized resource) as built by build_package_members,
+# extra_files a list of (package filename, bytes) added as they are (not listed in the manifest)
+def write_package(members, output_tgz_path, compression="gzip", compress_level=9, compress_threads=None, extra_files=()):
     # Create the package manifest (package.json)
     package_manifest = {
         "name": "racsel.connectathon",
@@ -790,121 +1527,8 @@ def convert_to_fhir(file_path):
         "files": []
     }
 
-    # Resources list
-    resources = [
-        (antecedentes_value_set_json, "package/ValueSet/AntecedentesPersonalesValueSet.json"),
-        (antecentes_racsel_value_set_json, "package/ValueSet/AntecedentesPersonalesRacselValueSet.json"),
-        (antecentes_local_value_set_json, "package/ValueSet/AntecedentesPersonalesLocalValueSet.json"),
-        (diagnosticos_value_set_json, "package/ValueSet/DiagnosticosValueSet.json"),
-        (diagnosticos_racsel_value_set_json, "package/ValueSet/DiagnosticosRacselValueSet.json"),
-        (diagnosticos_local_value_set_json, "package/ValueSet/DiagnosticosLocalValueSet.json"),
-        (vacunas_value_set_json, "package/ValueSet/VacunasValueSet.json"),
-        (vacunas_racsel_value_set_json, "package/ValueSet/VacunasRacselValueSet.json"),
-        (vacunas_local_value_set_json, "package/ValueSet/VacunasLocalValueSet.json"),
-        (alergias_value_set_json, "package/ValueSet/AlergiasValueSet.json"),
-        (alergias_racsel_value_set_json, "package/ValueSet/AlergiasRacselValueSet.json"),
-        (alergias_local_value_set_json, "package/ValueSet/AlergiasLocalValueSet.json"),
-        (medicacion_value_set_json, "package/ValueSet/MedicacionValueSet.json"),
-        (medicacion_racsel_value_set_json, "package/ValueSet/MedicacionRacselValueSet.json"),
-        (medicacion_local_value_set_json, "package/ValueSet/MedicacionLocalValueSet.json"),
-        (procedimientos_value_set_json, "package/ValueSet/ProcedimientosValueSet.json"),
-        (procedimientos_racsel_value_set_json, "package/ValueSet/ProcedimientosRacselValueSet.json"),
-        (procedimientos_local_value_set_json, "package/ValueSet/ProcedimientosLocalValueSet.json"),
-        (racsel_value_set_json, "package/ValueSet/RACSELValueSet.json"),
-        (local_value_set_json, "package/ValueSet/LocalValueSet.json"),
-        (snomed_value_set_json, "package/ValueSet/SNOMEDValueSet.json"),
-        (cie10_value_set_json, "package/ValueSet/CIE10ValueSet.json"),
-        (cie11_value_set_json, "package/ValueSet/CIE11ValueSet.json"),
-        (code_system_cie10_json, "package/CodeSystem/icd-10.json"),
-        (code_system_cie11_json, "package/CodeSystem/icd-11.json"),
-        (code_system_json, "package/CodeSystem/RACSELCodeSystem.json"),
-        (code_system_local_json, "package/CodeSystem/LocalCodeSystem.json"),
-        # CodeSystem-based ConceptMaps - Unified approach
-            (local_to_racsel_map_json, "package/ConceptMap/Local-to-RACSEL.json"),
-            (local_to_snomed_map_json, "package/ConceptMap/Local-to-SNOMED.json"),
-            (local_to_cie10_map_json, "package/ConceptMap/Local-to-CIE10.json"),
-            (local_to_cie11_map_json, "package/ConceptMap/Local-to-CIE11.json"),
-            (racsel_to_local_map_json, "package/ConceptMap/RACSEL-to-Local.json"),
-            (cie10_to_local_map_json, "package/ConceptMap/CIE10-to-Local.json"),
-            (cie11_to_local_map_json, "package/ConceptMap/CIE11-to-Local.json"),
-        (snomed_to_local_map_json, "package/ConceptMap/SNOMED-to-Local.json"),
-        (cie10_to_snomed_map_json, "package/ConceptMap/CIE10-to-SNOMED.json"),
-        (cie11_to_snomed_map_json, "package/ConceptMap/CIE11-to-SNOMED.json"),
-        (snomed_to_cie10_map_json, "package/ConceptMap/SNOMED-to-CIE10.json"),
-        (snomed_to_cie11_map_json, "package/ConceptMap/SNOMED-to-CIE11.json"),
-        # ValueSet-based ConceptMaps - Global mappings
-        (vs_local_to_racsel_global_map, "package/ConceptMap/VS-Local-Global-to-RACSEL-Global.json"),
-        (vs_racsel_to_local_global_map, "package/ConceptMap/VS-RACSEL-Global-to-Local-Global.json"),
-        (vs_local_to_snomed_global_map, "package/ConceptMap/VS-Local-Global-to-SNOMED-Global.json"),
-        (vs_snomed_to_local_global_map, "package/ConceptMap/VS-SNOMED-Global-to-Local-Global.json"),
-        (vs_cie10_to_snomed_global_map, "package/ConceptMap/VS-CIE10-Global-to-SNOMED-Global.json"),
-        (vs_snomed_to_cie10_global_map, "package/ConceptMap/VS-SNOMED-Global-to-CIE10-Global.json"),
-        (vs_cie11_to_snomed_global_map, "package/ConceptMap/VS-CIE11-Global-to-SNOMED-Global.json"),
-        (vs_snomed_to_cie11_global_map, "package/ConceptMap/VS-SNOMED-Global-to-CIE11-Global.json"),
-        # ValueSet-based ConceptMaps - Domain-specific Antecedentes
-        (vs_antecedentes_local_to_racsel_map, "package/ConceptMap/VS-Antecedentes-Local-to-RACSEL.json"),
-        (vs_antecedentes_racsel_to_local_map, "package/ConceptMap/VS-Antecedentes-RACSEL-to-Local.json"),
-        (vs_antecedentes_local_to_snomed_map, "package/ConceptMap/VS-Antecedentes-Local-to-SNOMED.json"),
-        (vs_antecedentes_snomed_to_local_map, "package/ConceptMap/VS-Antecedentes-SNOMED-to-Local.json"),
-        (vs_antecedentes_racsel_to_snomed_map, "package/ConceptMap/VS-Antecedentes-RACSEL-to-SNOMED.json"),
-        (vs_antecedentes_snomed_to_racsel_map, "package/ConceptMap/VS-Antecedentes-SNOMED-to-RACSEL.json"),
-        # ValueSet-based ConceptMaps - Domain-specific Diagnósticos
-        (vs_diagnosticos_local_to_racsel_map, "package/ConceptMap/VS-Diagnosticos-Local-to-RACSEL.json"),
-        (vs_diagnosticos_racsel_to_local_map, "package/ConceptMap/VS-Diagnosticos-RACSEL-to-Local.json"),
-        (vs_diagnosticos_local_to_snomed_map, "package/ConceptMap/VS-Diagnosticos-Local-to-SNOMED.json"),
-        (vs_diagnosticos_snomed_to_local_map, "package/ConceptMap/VS-Diagnosticos-SNOMED-to-Local.json"),
-        (vs_diagnosticos_local_to_cie10_map, "package/ConceptMap/VS-Diagnosticos-Local-to-CIE10.json"),
-        (vs_diagnosticos_cie10_to_local_map, "package/ConceptMap/VS-Diagnosticos-CIE10-to-Local.json"),
-        (vs_diagnosticos_racsel_to_snomed_map, "package/ConceptMap/VS-Diagnosticos-RACSEL-to-SNOMED.json"),
-        (vs_diagnosticos_snomed_to_racsel_map, "package/ConceptMap/VS-Diagnosticos-SNOMED-to-RACSEL.json"),
-        # ValueSet-based ConceptMaps - Domain-specific Vacunas
-        (vs_vacunas_local_to_racsel_map, "package/ConceptMap/VS-Vacunas-Local-to-RACSEL.json"),
-        (vs_vacunas_racsel_to_local_map, "package/ConceptMap/VS-Vacunas-RACSEL-to-Local.json"),
-        (vs_vacunas_local_to_snomed_map, "package/ConceptMap/VS-Vacunas-Local-to-SNOMED.json"),
-        (vs_vacunas_snomed_to_local_map, "package/ConceptMap/VS-Vacunas-SNOMED-to-Local.json"),
-        (vs_vacunas_local_to_cie11_map, "package/ConceptMap/VS-Vacunas-Local-to-CIE11.json"),
-        (vs_vacunas_cie11_to_local_map, "package/ConceptMap/VS-Vacunas-CIE11-to-Local.json"),
-        (vs_vacunas_racsel_to_snomed_map, "package/ConceptMap/VS-Vacunas-RACSEL-to-SNOMED.json"),
-        (vs_vacunas_snomed_to_racsel_map, "package/ConceptMap/VS-Vacunas-SNOMED-to-RACSEL.json"),
-
-        #prequal
-        (code_system_prequal_json, "package/CodeSystem/PreQualCodeSystem.json"),
-        #prequal vs 
-        (vacunas_prequal_value_set_json, "package/ValueSet/VacunasPreQualValueSet.json"),
-        #prequal maps based on valueset
-        (vs_vacunas_local_to_prequal_map, "package/ConceptMap/VS-Vacunas-Local-to-Prequal.json"),
-        (vs_vacunas_cie11_to_prequal_map, "package/ConceptMap/VS-Vacunas-CIE11-to-Prequal.json"),
-        (vs_vacunas_snomed_to_prequal_map, "package/ConceptMap/VS-Vacunas-SNOMED-to-Prequal.json"),
-        (vs_vacunas_prequal_to_local_map, "package/ConceptMap/VS-Vacunas-Prequal-to-Local.json"),
-        (vs_vacunas_prequal_to_cie11_map, "package/ConceptMap/VS-Vacunas-PreQual-to-CIE11.json"),
-        (vs_vacunas_prequal_to_snomed_map, "package/ConceptMap/VS-Vacunas-PreQual-to-SNOMED.json"),
-
-        # ValueSet-based ConceptMaps - Domain-specific Alergias
-        (vs_alergias_local_to_racsel_map, "package/ConceptMap/VS-Alergias-Local-to-RACSEL.json"),
-        (vs_alergias_racsel_to_local_map, "package/ConceptMap/VS-Alergias-RACSEL-to-Local.json"),
-        (vs_alergias_local_to_snomed_map, "package/ConceptMap/VS-Alergias-Local-to-SNOMED.json"),
-        (vs_alergias_snomed_to_local_map, "package/ConceptMap/VS-Alergias-SNOMED-to-Local.json"),
-        (vs_alergias_racsel_to_snomed_map, "package/ConceptMap/VS-Alergias-RACSEL-to-SNOMED.json"),
-        (vs_alergias_snomed_to_racsel_map, "package/ConceptMap/VS-Alergias-SNOMED-to-RACSEL.json"),
-        # ValueSet-based ConceptMaps - Domain-specific Medicación
-        (vs_medicacion_local_to_racsel_map, "package/ConceptMap/VS-Medicacion-Local-to-RACSEL.json"),
-        (vs_medicacion_racsel_to_local_map, "package/ConceptMap/VS-Medicacion-RACSEL-to-Local.json"),
-        (vs_medicacion_local_to_snomed_map, "package/ConceptMap/VS-Medicacion-Local-to-SNOMED.json"),
-        (vs_medicacion_snomed_to_local_map, "package/ConceptMap/VS-Medicacion-SNOMED-to-Local.json"),
-        (vs_medicacion_racsel_to_snomed_map, "package/ConceptMap/VS-Medicacion-RACSEL-to-SNOMED.json"),
-        (vs_medicacion_snomed_to_racsel_map, "package/ConceptMap/VS-Medicacion-SNOMED-to-RACSEL.json"),
-        # ValueSet-based ConceptMaps - Domain-specific Procedimientos
-        (vs_procedimientos_local_to_racsel_map, "package/ConceptMap/VS-Procedimientos-Local-to-RACSEL.json"),
-        (vs_procedimientos_racsel_to_local_map, "package/ConceptMap/VS-Procedimientos-RACSEL-to-Local.json"),
-        (vs_procedimientos_local_to_snomed_map, "package/ConceptMap/VS-Procedimientos-Local-to-SNOMED.json"),
-        (vs_procedimientos_snomed_to_local_map, "package/ConceptMap/VS-Procedimientos-SNOMED-to-Local.json"),
-        (vs_procedimientos_racsel_to_snomed_map, "package/ConceptMap/VS-Procedimientos-RACSEL-to-SNOMED.json"),
-        (vs_procedimientos_snomed_to_racsel_map, "package/ConceptMap/VS-Procedimientos-SNOMED-to-RACSEL.json")
-    ]
-
-
     # Add resources to manifests
-    for resource, filename in resources:
+    for resource, filename, _ in members:
         loopReference = {
             "filename": filename[8:],
             "resourceType": resource["resourceType"],
@@ -920,38 +1544,497 @@ def convert_to_fhir(file_path):
         index_file["files"].append(loopReference)
         package_manifest["resources"].append({"type": resource["resourceType"], "reference": f"{resource['resourceType']}/{resource['name']}"})
 
-    # Create the tgz file
-    output_tgz_path = "racsel_fhir_package.tgz"
-    with tarfile.open(output_tgz_path, "w:gz") as tar:
+    # Create the tgz file, every member is written straight from memory
+    with open_package_tar(output_tgz_path, compression, compress_level, compress_threads) as tar:
         # Add the package manifest
-        manifest_path = os.path.join(temp_dir, "package.json")
-        with open(manifest_path, "w", encoding="utf-8") as f:
-            json.dump(package_manifest, f, ensure_ascii=False, indent=2)
-        tar.add(manifest_path, arcname="package/package.json")
-        os.remove(manifest_path)
+        add_bytes_to_tar(tar, "package/package.json", json_bytes(package_manifest), package_mtime)
 
         # Add the .index.json file
-        index_path = os.path.join(temp_dir, ".index.json")
-        with open(index_path, "w", encoding="utf-8") as f:
-            json.dump(index_file, f, ensure_ascii=False, indent=2)
-        tar.add(index_path, arcname="package/.index.json")
-        os.remove(index_path)
-        
-        # Add each resource to the appropriate folder in the tar file
-        for resource, filename in resources:
-            json_path = os.path.join("/tmp", os.path.basename(filename))
-            with open(json_path, "w", encoding="utf-8") as f:
-                json.dump(resource, f, ensure_ascii=False, indent=2)
-            tar.add(json_path, arcname=filename)
-            os.remove(json_path)  # Clean up the temporary file
+        add_bytes_to_tar(tar, "package/.index.json", json_bytes(index_file), package_mtime)
 
-    print(f"FHIR package saved to {output_tgz_path}")
+        # Add each resource to the appropriate folder in the tar file
+        for _, filename, data in members:
+            add_file_to_tar(tar, filename, data, package_mtime)
+
+        for filename, data in extra_files:
+            add_bytes_to_tar(tar, filename, data, package_mtime)
+
+# Function to get the path of the lookup index written next to a package (racsel_fhir_package.idx)
+def index_path(package_path, compression="gzip"):
+    return package_path[:-len(package_extension(compression))] + ".idx"
+
+# Function to get the directories of the transaction Bundles and of the NDJSON files written next to a package
+def bundles_path(package_path, compression="gzip"):
+    return package_path[:-len(package_extension(compression))] + ".bundles"
+
+def ndjson_path(package_path, compression="gzip"):
+    return package_path[:-len(package_extension(compression))] + ".ndjson"
+
+# Function to get the members of the resources, in the order of BUNDLE_RESOURCE_TYPES and then of the package
+def members_by_type(members):
+    return sorted(members, key=lambda member: BUNDLE_RESOURCE_TYPES.index(member[0]["resourceType"]) if member[0]["resourceType"] in BUNDLE_RESOURCE_TYPES else len(BUNDLE_RESOURCE_TYPES))
+
+# Function to write the resources of the package members as FHIR transaction Bundles of at most bundle_size
+# resources, bundle-0001.json... in directory. Every entry is a conditional update by canonical url
+# (PUT CodeSystem?url=...), so loading the Bundles again updates the same resources instead of creating copies.
+# The Bundles of an earlier build are removed first. Returns the paths of the Bundles
+def write_bundles(members, directory, bundle_size=default_bundle_size):
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "bundle-*.json")):
+        os.remove(path)
+    ordered = members_by_type(members)
+    paths = []
+    for number, start in enumerate(range(0, len(ordered), bundle_size), 1):
+        bundle = {"resourceType": "Bundle", "type": "transaction", "entry": [
+            {"resource": resource, "request": {"method": "PUT", "url": f"{resource['resourceType']}?url={quote(resource['url'], safe='')}"}}
+            for resource in member_resources(ordered[start:start + bundle_size])
+        ]}
+        path = os.path.join(directory, f"bundle-{number:04d}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(bundle, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+        paths.append(path)
+    return paths
+
+# Function to write the resources of the package members as NDJSON, one <resource type>.ndjson file per type in
+# directory with one resource per line, as read by the bulk $import of FHIR servers. Returns the paths of the files
+def write_ndjson(members, directory):
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "*.ndjson")):
+        os.remove(path)
+    ordered = members_by_type(members)
+    files = {}
+    try:
+        for resource in member_resources(ordered):
+            resource_type = resource["resourceType"]
+            if resource_type not in files:
+                files[resource_type] = open(os.path.join(directory, f"{resource_type}.ndjson"), "w", encoding="utf-8")
+            files[resource_type].write(json.dumps(resource, ensure_ascii=False, separators=(",", ":")) + "\n")
+    finally:
+        for f in files.values():
+            f.close()
+    return [f.name for f in files.values()]
+
+# Function to read back the resources of the package members, for the lookup index
+def member_resources(members):
+    for _, _, data in members:
+        with (open(data, "rb") if isinstance(data, str) else contextlib.nullcontext(data)) as f:
+            f.seek(0)
+            yield json.load(f)
+
+# Function to read every file of a package (.tgz, or .tar.zst with the zstandard package)
+# Returns a dict {package filename: bytes}
+def read_package(package_path):
+    files = {}
+    with open(package_path, "rb") as f:
+        if package_path.endswith(".zst"):
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("reading zstd packages requires the zstandard package (pip install zstandard)")
+            fileobj = zstandard.ZstdDecompressor().stream_reader(f)
+        else:
+            fileobj = gzip.GzipFile(fileobj=f, mode="rb")
+        with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+            for member in tar:
+                if member.isfile():
+                    files[member.name] = tar.extractfile(member).read()
+    return files
+
+# Function to get the sha256 of every resource of a package, keyed by canonical url (taken from .index.json)
+def package_resource_hashes(package_path):
+    files = read_package(package_path)
+    index = json.loads(files["package/.index.json"])
+    return {
+        entry["url"]: hashlib.sha256(files["package/" + entry["filename"]]).hexdigest()
+        for entry in index["files"]
+        if "package/" + entry["filename"] in files
+    }
 
-    print(f'Load in Snowstorm with curl --form file=@{output_tgz_path} --form resourceUrls="*" http://localhost/fhir-admin/load-package (or equivalent in windows)')
+# Function to compare the package members with a previous package
+# Returns the added and changed members and the canonical urls removed since the previous package
+def package_delta(members, previous_package_path):
+    previous = package_resource_hashes(previous_package_path)
+    added = [member for member in members if member[0]["url"] not in previous]
+    changed = [member for member in members if member[0]["url"] in previous and previous[member[0]["url"]] != member[0]["sha256"]]
+    removed = sorted(set(previous) - {member[0]["url"] for member in members})
+    return added, changed, removed
+
+# Function to write a delta package with the resources added or changed since a previous package.
+# package/other/delta.json lists the added, changed and removed canonical urls and the resourceUrls to load.
+# Returns the resourceUrls value for load-package, or None when nothing changed
+def write_delta_package(members, previous_package_path, delta_path, compression="gzip", compress_level=9, compress_threads=None):
+    added, changed, removed = package_delta(members, previous_package_path)
+    print(f"Changes since {previous_package_path}: {len(added)} added, {len(changed)} changed, {len(removed)} removed resources")
+    if not added and not changed and not removed:
+        return None
+
+    resource_urls = ",".join(member[0]["url"] for member in added + changed)
+    delta_manifest = {
+        "since": os.path.basename(previous_package_path),
+        "added": [member[0]["url"] for member in added],
+        "changed": [member[0]["url"] for member in changed],
+        "removed": removed,
+        "resourceUrls": resource_urls
+    }
+    write_package(added + changed, delta_path, compression, compress_level, compress_threads, [("package/other/delta.json", json_bytes(delta_manifest))])
+    for url in removed:
+        print(f"Removed since the previous package (delete it from the terminology server): {url}")
+    return resource_urls
+
+# Function to add the concepts of other_concepts whose code is not in concepts yet
+def merge_concepts(concepts, other_concepts):
+    codes = {concept["code"] for concept in concepts}
+    for concept in other_concepts:
+        if concept["code"] not in codes:
+            codes.add(concept["code"])
+            concepts.append(concept)
+
+# Function to merge other into resource, two versions of the same canonical url from different workbooks.
+# Concepts and map elements are deduplicated by code keeping the first display, ValueSets keep one include
+# per system and ConceptMaps one element per source code with the targets of every workbook.
+def merge_resource(resource, other, max_group_size=None):
+    if resource["resourceType"] == "CodeSystem":
+        merge_concepts(resource["concept"], other["concept"])
+    elif resource["resourceType"] == "ValueSet":
+        includes = resource["compose"]["include"]
+        for include in other["compose"]["include"]:
+            same_system = next((i for i in includes if "system" in include and i.get("system") == include["system"]), None)
+            if same_system:
+                merge_concepts(same_system["concept"], include["concept"])
+            elif include not in includes:
+                includes.append(include)
+    elif resource["resourceType"] == "ConceptMap":
+        elements = {}
+        for group in resource["group"] + other["group"]:
+            group_elements = elements.setdefault((group["source"], group["target"]), {})
+            for element in group["element"]:
+                merged = group_elements.setdefault(element["code"], {**element, "target": []})
+                target_codes = {target["code"] for target in merged["target"]}
+                merged["target"] += [target for target in element["target"] if target["code"] not in target_codes]
+        resource["group"] = [
+            {"source": source, "target": target, "element": chunk}
+            for (source, target), group_elements in elements.items()
+            for chunk in split_chunks(list(group_elements.values()), max_group_size)
+        ]
+
+# Function to split again the merged ValueSets of a regional package, whose parts hold the concepts of several
+# workbooks. The parts of each ValueSet are first merged back into it, then every ValueSet with more than max_size
+# concepts is split as plan_value_set does: parts <name>PartN (<url>-part-N) included by the ValueSet itself.
+# resources is {url: (filename, resource)}, filenames the package filenames in use. Returns the new resources
+def split_merged_value_sets(resources, filenames, max_size):
+    parts = {}
+    for url, (filename, resource) in resources.items():
+        if resource["resourceType"] != "ValueSet":
+            continue
+        included = [included_url for include in resource["compose"]["include"] for included_url in include.get("valueSet", [])]
+        numbers = [re.fullmatch(re.escape(url) + r"-part-(\d+)", included_url) for included_url in included]
+        if included and all(numbers) and len(included) == len(resource["compose"]["include"]):
+            parts[url] = [included_url for _, included_url in sorted(zip((int(number.group(1)) for number in numbers), included)) if included_url in resources]
+
+    part_of = {part_url for part_urls in parts.values() for part_url in part_urls}
+    split = {}
+    for url, (filename, resource) in resources.items():
+        if url in part_of:
+            continue
+        if resource["resourceType"] != "ValueSet":
+            split[url] = (filename, resource)
+            continue
+        if parts.get(url):
+            # the first part collects the concepts of the others, the parts are left out of the package
+            merged = resources[parts[url][0]][1]
+            for part_url in parts[url][1:]:
+                merge_resource(merged, resources[part_url][1])
+            resource = {**resource, "compose": merged["compose"]}
+        includes = resource["compose"]["include"]
+        if not all("concept" in include for include in includes):
+            # includes of whole systems or of other ValueSets are not split
+            split[url] = (filename, resource)
+            continue
+        concepts = [(include["system"], concept) for include in includes for concept in include["concept"]]
+        chunks = split_chunks(concepts, max_size)
+        if len(chunks) == 1:
+            split[url] = (filename, resource)
+            continue
+        part_urls = []
+        for part, chunk in enumerate(chunks, 1):
+            part_url = f"{url}-part-{part}"
+            includes = []
+            for system, concept in chunk:
+                if not includes or includes[-1]["system"] != system:
+                    includes.append({"system": system, "concept": []})
+                includes[-1]["concept"].append(concept)
+            part_filename = f"{os.path.splitext(filename)[0]}Part{part}.json"
+            filenames.add(part_filename)
+            split[part_url] = (part_filename, {**resource, "id": resource_id(part_url), "url": part_url, "name": f"{resource['name']}Part{part}", "compose": {"include": includes}})
+            part_urls.append(part_url)
+        split[url] = (filename, {**resource, "compose": {"include": [{"valueSet": [part_url]} for part_url in part_urls]}})
+    return split
+
+# Function to merge several packages into a regional package. packages is a list of (label, package path).
+# Resources with the same canonical url are merged (shared RACSEL, SNOMED, CIE and PreQual codes appear once);
+# resources that only share the file name (e.g. the CodeSystem of each local uri) get the label as a suffix.
+# With max_group_size the merged ValueSets and ConceptMap groups are split again (see split_merged_value_sets).
+def merge_packages(packages, output_path, compression="gzip", compress_level=9, compress_threads=None, compact=False, max_group_size=None, index=False, bundle_size=None, ndjson=False):
+    resources = {}
+    filenames = set()
+    for label, package_path in packages:
+        files = read_package(package_path)
+        for entry in json.loads(files["package/.index.json"])["files"]:
+            filename = "package/" + entry["filename"]
+            resource = json.loads(files[filename])
+            if resource["url"] in resources:
+                merge_resource(resources[resource["url"]][1], resource, max_group_size)
+                continue
+            if filename in filenames:
+                filename = f"{os.path.splitext(filename)[0]}-{label}.json"
+            filenames.add(filename)
+            resources[resource["url"]] = (filename, resource)
+    if max_group_size:
+        resources = split_merged_value_sets(resources, filenames, max_group_size)
+
+    indent = None if compact else 2
+    members = []
+    for filename, resource in resources.values():
+        data = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+        metadata = resource_metadata(resource)
+        metadata["sha256"] = write_json(resource, data, indent)
+        members.append((metadata, filename, data))
+    write_package(members, output_path, compression, compress_level, compress_threads)
+    print(f"Merged {len(packages)} packages into {len(members)} resources")
+    if index:
+        write_index([resource for _, resource in resources.values()], index_path(output_path, compression))
+    if bundle_size:
+        write_bundles(members, bundles_path(output_path, compression), bundle_size)
+    if ndjson:
+        write_ndjson(members, ndjson_path(output_path, compression))
+
+# Records the wall time, CPU time and traced memory (tracemalloc) of the pipeline stages and of each
+# package resource, with the row and concept counts of each sheet. A disabled profiler records nothing.
+# With cprofile every stage also runs under its own cProfile.Profile, so the slowest one can be dumped.
+# Without memory tracemalloc is not started, so the times are not slowed down by it (the memory is then reported as 0)
+class Profiler:
+    def __init__(self, enabled=True, cprofile=False, memory=True):
+        self.enabled = enabled
+        self.cprofile = cprofile
+        self.origin = time.perf_counter()
+        self.stages = []
+        self.resources = []
+        # processes that built the resources, see build_package_members
+        self.build_workers = None
+        self.sheets = {}
+        self.profiles = {}
+        # frames being measured, their memory peak is kept up to date before a nested measure resets it
+        self.open_frames = []
+        if enabled and memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def measure(self, records, name, profile=False):
+        record = {"name": name}
+        if not self.enabled:
+            yield record
+            return
+        memory_start, memory_peak = tracemalloc.get_traced_memory()
+        for frame in self.open_frames:
+            frame["peak"] = max(frame["peak"], memory_peak)
+        tracemalloc.reset_peak()
+        frame = {"peak": memory_start}
+        self.open_frames.append(frame)
+        profile = cProfile.Profile() if profile else None
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if profile:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile:
+                profile.disable()
+                self.profiles[name] = profile
+            wall_end, cpu_end = time.perf_counter(), time.process_time()
+            memory_end, memory_peak = tracemalloc.get_traced_memory()
+            self.open_frames.pop()
+            record.update({
+                "start": wall_start - self.origin,
+                "wall": wall_end - wall_start,
+                "cpu": cpu_end - cpu_start,
+                "memory_peak": max(frame["peak"], memory_peak) - memory_start,
+                "memory_delta": memory_end - memory_start,
+            })
+            records.append(record)
+
+    # Function to measure a pipeline stage
+    def stage(self, name):
+        return self.measure(self.stages, name, self.cprofile)
+
+    # Function to measure the build of a package resource, the caller adds its bytes to the record
+    def resource(self, filename):
+        return self.measure(self.resources, filename)
+
+    # Function to record a package resource built and measured in a build worker (see serialize_worker_job)
+    def add_resource(self, filename, measures, **fields):
+        if self.enabled:
+            self.resources.append({"name": filename, **measures, "start": measures["start"] - self.origin, **fields})
+
+    # Function to record the data rows, the extracted terms and the concepts of each system of every sheet
+    def record_sheets(self, sheets, terms, codes):
+        if not self.enabled:
+            return
+        term_counts = terms.groupby("domain").size()
+        for domain in DOMAINS:
+            self.sheets[domain.sheet] = {
+                "rows": max(len(sheets[domain.sheet]) - 2, 0),
+                "terms": int(term_counts.get(domain.label, 0)),
+                "concepts": {system: len(codes.get((domain.label, system), [])) for system in domain.columns},
+            }
+
+    # Function to get the whole profile as a JSON document
+    def report(self):
+        return {"stages": self.stages, "resources": self.resources, "sheets": self.sheets, "build_workers": self.build_workers}
+
+    # Function to print the stages, the sheet counts and the slowest resources as tables
+    def print_summary(self, top=10):
+        print(f"{'Stage':<12}{'Wall (s)':>10}{'CPU (s)':>10}{'Peak mem (MB)':>15}")
+        for stage in self.stages:
+            print(f"{stage['name']:<12}{stage['wall']:>10.3f}{stage['cpu']:>10.3f}{stage['memory_peak'] / 2**20:>15.1f}")
+        if self.build_workers and self.build_workers > 1:
+            print(f"Resources built by {self.build_workers} processes, the CPU time of the build stage is the one of this process only")
+        print(f"{'Sheet':<26}{'Rows':>8}{'Terms':>8}  Concepts")
+        for sheet, counts in self.sheets.items():
+            concepts = ", ".join(f"{system} {count}" for system, count in counts["concepts"].items())
+            print(f"{sheet.strip():<26}{counts['rows']:>8}{counts['terms']:>8}  {concepts}")
+        print(f"{'Slowest resources':<60}{'Wall (s)':>10}{'Bytes':>12}")
+        for resource in sorted(self.resources, key=lambda r: r["wall"], reverse=True)[:top]:
+            print(f"{resource['name'][8:]:<60}{resource['wall']:>10.3f}{resource.get('bytes', 0):>12}")
+
+    # Function to write the profile as JSON
+    def write_report(self, path):
+        with open(path, "wb") as f:
+            f.write(json_bytes(self.report()))
+        print(f"Profile saved to {path}")
+
+    # Function to write the stages and resources in Chrome trace event format (complete events, in microseconds)
+    def write_trace(self, path):
+        events = [{"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": "racsel-convert-xlsx-to-fhir"}}]
+        for category, records in (("stage", self.stages), ("resource", self.resources)):
+            for record in records:
+                events.append({
+                    "name": record["name"],
+                    "cat": category,
+                    "ph": "X",
+                    "ts": round(record["start"] * 1e6),
+                    "dur": round(record["wall"] * 1e6),
+                    "pid": os.getpid(),
+                    # resources built in a build worker are on the row of that worker
+                    "tid": record.get("worker", 1),
+                    "args": {key: value for key, value in record.items() if key not in ("name", "start", "wall")},
+                })
+        with open(path, "wb") as f:
+            f.write(json_bytes({"traceEvents": events, "displayTimeUnit": "ms"}))
+        print(f"Trace saved to {path}")
+
+    # Function to dump the cProfile stats of the slowest stage and print its most expensive functions
+    def dump_slowest_stage(self, path, top=15):
+        profiled = [stage for stage in self.stages if stage["name"] in self.profiles]
+        if not profiled:
+            return
+        slowest = max(profiled, key=lambda stage: stage["wall"])
+        self.profiles[slowest["name"]].dump_stats(path)
+        print(f"cProfile of the slowest stage ({slowest['name']}, {slowest['wall']:.3f}s) saved to {path}")
+        pstats.Stats(path).sort_stats("cumulative").print_stats(top)
+
+# Function to get the file extension of a package compressed with compression
+def package_extension(compression):
+    return ".tar.zst" if compression == "zstd" else ".tgz"
 
-if __name__ == "__main__":
-    main()
+# Function to convert the Excel file to FHIR
+# Writes the package to output_path (default racsel_fhir_package.tgz in the current directory) and returns its path
+# file_path is a workbook or a columnar source directory (see read_columnar_sheets), local_uri replaces the uri it gives.
+# sheets (already parsed), memory_cache and list_defects are used by watch_workbook to rebuild from memory
+def convert_to_fhir(file_path, cache_dir=None, compression="gzip", compress_level=9, compress_threads=None, since=None, compact=False, max_resource_size=None, output_path=None, profiler=None, index=False,
+                    local_uri=None, display_policy="first", equivalence=None, bundle_size=None, ndjson=False, json_encoder="auto", build_jobs=None,
+                    sheets=None, memory_cache=None, list_defects=False):
+    profiler = profiler or Profiler(enabled=False)
 
+    # Load all sheets into dataframes
+    with profiler.stage("ingest"):
+        sheets = sheets if sheets is not None else load_workbook_sheets(file_path, cache_dir)
+
+    # set the local uri to default or columns[2] in the first sheet if it exists
+    first_sheet = sheets[DOMAINS[0].sheet]
+    local_uri = local_uri or (first_sheet.columns[2] if first_sheet.columns[2] else default_local_uri)
+
+    # Extract all the codes and maps of the workbook in a single pass
+    with profiler.stage("extract"):
+        stacked = stack_terms(sheets)
+        terms = complete_terms(stacked)
+        registry = build_concept_registry(terms, display_policy)
+        codes = project_codes(terms, registry)
+        maps = project_maps(terms)
+    profiler.record_sheets(sheets, terms, codes)
+
+    with profiler.stage("validate"):
+        defects = validate_terms(stacked)
+    if len(defects) and list_defects:
+        print_defects(file_path, defects)
+    elif len(defects):
+        errors = int((defects["severity"] == "error").sum())
+        print(f"Found {errors} errors and {len(defects) - errors} warnings in the workbook, run with --validate-only to list them")
+
+    # Build the resources, taking the ones whose sheets did not change from the build cache
+    with profiler.stage("plan"):
+        jobs = plan_resources(codes, maps, local_uri, max_resource_size, registry, equivalence)
+    print_collapsed(registry, display_policy)
+    build_cache_dir = os.path.join(cache_dir, "build") if cache_dir else None
+    with profiler.stage("build"):
+        members, reused = build_package_members(jobs, sheet_hashes(sheets), local_uri, build_cache_dir, compact, max_resource_size, profiler, memory_cache,
+                                                  {"display_policy": display_policy, "equivalence": sorted((equivalence or {}).items(), key=repr)}, build_jobs, json_encoder_name(json_encoder))
+    if reused:
+        print(f"Reused {reused} of {len(members)} resources from the build cache")
+
+    extension = package_extension(compression)
+    output_tgz_path = output_path or "racsel_fhir_package" + extension
+    # compare before writing, the previous package may be the one about to be overwritten
+    delta = None
+    if since:
+        delta_path = output_tgz_path[:-len(extension)] + ".delta" + extension
+        with profiler.stage("delta"):
+            delta = write_delta_package(members, since, delta_path, compression, compress_level, compress_threads)
+
+    with profiler.stage("package") as record:
+        write_package(members, output_tgz_path, compression, compress_level, compress_threads)
+    record["bytes"] = os.path.getsize(output_tgz_path)
 
+    print(f"FHIR package saved to {output_tgz_path}")
 
+    # compiled lookup tables for racsel_terminology.PackageIndex, opened with mmap by the tools that translate codes
+    if index:
+        with profiler.stage("index") as record:
+            write_index(member_resources(members), index_path(output_tgz_path, compression))
+        record["bytes"] = os.path.getsize(index_path(output_tgz_path, compression))
+        print(f"Lookup index saved to {index_path(output_tgz_path, compression)}")
+
+    # transaction Bundles and NDJSON files of the same resources, for FHIR servers without load-package (HAPI FHIR)
+    if bundle_size:
+        with profiler.stage("bundles"):
+            bundle_paths = write_bundles(members, bundles_path(output_tgz_path, compression), bundle_size)
+        print(f"{len(bundle_paths)} transaction Bundles saved to {bundles_path(output_tgz_path, compression)}")
+    if ndjson:
+        with profiler.stage("ndjson"):
+            write_ndjson(members, ndjson_path(output_tgz_path, compression))
+        print(f"NDJSON files saved to {ndjson_path(output_tgz_path, compression)}")
+
+    if compression == "zstd":
+        print("Snowstorm only loads gzip packages, use --compression gzip or gzip-mt to build a package for load-package")
+    elif since and delta:
+        print(f"Delta package saved to {delta_path}")
+        print(f'Load the changes in Snowstorm with curl --form file=@{delta_path} --form resourceUrls="{delta}" http://localhost/fhir-admin/load-package (or equivalent in windows)')
+    elif since:
+        print("No changes since the previous package, nothing to load")
+    else:
+        print(f'Load in Snowstorm with curl --form file=@{output_tgz_path} --form resourceUrls="*" http://localhost/fhir-admin/load-package (or equivalent in windows)')
+
+    return output_tgz_path
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import argparse
+import hashlib
+import json
+import sys
+
+from racsel_terminology import read_package_members, code_key
+
+
+# Key of the content of each resource type, compared concept by concept, the other keys are compared as metadata
+CONTENT_KEYS = {"CodeSystem": "concept", "ValueSet": "compose", "ConceptMap": "group"}
+
+# Keys that differ between builds without a change of content
+IGNORED_KEYS = {"id"}
+
+# Fields of the key of each kind of change, in the change list
+KEY_FIELDS = {
+    "concept": ["system", "code"],
+    "include": ["include"],
+    "element": ["source", "target", "code"],
+    "target": ["source", "target", "code", "targetCode"],
+    "metadata": ["field"],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two FHIR packages built by racsel-convert-xlsx-to-fhir.py: the concepts, displays and map targets added, removed or changed in each resource.")
+    parser.add_argument("old_package", help="The previous package")
+    parser.add_argument("new_package", help="The new package")
+    parser.add_argument("--changes", metavar="FILE", default=None, help="Write every change as JSON Lines, - for stdout (the summary then goes to stderr)")
+    parser.add_argument("--shown", type=int, default=20, help="Changed resources listed in the summary (default: 20)")
+
+    args = parser.parse_args()
+
+    summary = sys.stderr if args.changes == "-" else sys.stdout
+    output = None
+    if args.changes:
+        output = sys.stdout if args.changes == "-" else open(args.changes, "w", encoding="utf-8")
+    try:
+        resources = diff_packages(args.old_package, args.new_package, output)
+    finally:
+        if output is not None and output is not sys.stdout:
+            output.close()
+
+    print_summary(resources, args.old_package, args.new_package, args.shown, summary)
+    # as diff, the exit status is 1 when the packages differ
+    sys.exit(1 if any(resource["status"] != "unchanged" for resource in resources) else 0)
+
+# Function to stream the resources of a package as (url, resource type, raw JSON bytes).
+# The url comes from .index.json, written before the resources, so the JSON is only parsed when needed
+def package_resources(package_path):
+    urls = {}
+    for name, data in read_package_members(package_path):
+        if name == "package/.index.json":
+            urls = {"package/" + entry["filename"]: (entry["url"], entry["resourceType"]) for entry in json.loads(data)["files"]}
+        elif name in urls:
+            yield urls[name] + (data,)
+        elif name.endswith(".json") and name != "package/package.json" and not name.startswith("package/other/"):
+            resource = json.loads(data)
+            if resource.get("resourceType") in CONTENT_KEYS:
+                yield resource["url"], resource["resourceType"], data
+
+# Function to get the key of a code, most codes are already strings
+def string_code(code):
+    return code if type(code) is str else code_key(code)
+
+# Function to index the content of a resource as {key: value}, where the key identifies a concept, an include,
+# a map element or a map target (a tuple of strings) and the value is what may change for the same key
+# (display, equivalence and display of a target)
+def content_index(resource):
+    url, resource_type = resource["url"], resource["resourceType"]
+    index = {}
+    if resource_type == "CodeSystem":
+        index.update((("concept", url, string_code(concept["code"])), concept.get("display")) for concept in resource.get("concept", []))
+    elif resource_type == "ValueSet":
+        for include in resource.get("compose", {}).get("include", []):
+            for value_set in include.get("valueSet", []):
+                index[("include", value_set)] = None
+            if "concept" in include:
+                system = include["system"]
+                index.update((("concept", system, string_code(concept["code"])), concept.get("display")) for concept in include["concept"])
+            elif "system" in include:
+                index[("include", include["system"])] = None
+    else:
+        for group in resource.get("group", []):
+            source, target_system = group["source"], group["target"]
+            for element in group.get("element", []):
+                code = element["code"]
+                if type(code) is not str:
+                    code = code_key(code)
+                index[("element", source, target_system, code)] = element.get("display")
+                for target in element.get("target", ()):
+                    target_code = target["code"]
+                    if type(target_code) is not str:
+                        target_code = code_key(target_code)
+                    index[("target", source, target_system, code, target_code)] = (target.get("equivalence"), target.get("display"))
+    for key, value in resource.items():
+        if key != CONTENT_KEYS[resource_type] and key not in IGNORED_KEYS:
+            index[("metadata", key)] = value
+    return index
+
+# Function to compare the content indexes of two versions of a resource with set operations on their keys.
+# Yields the changes as (kind, action, key, old value, new value), sorted by key
+def compare_indexes(old, new):
+    removed = old.keys() - new.keys()
+    added = new.keys() - old.keys()
+    changed = [key for key in old.keys() & new.keys() if old[key] != new[key]]
+    changes = [(key, "removed") for key in removed] + [(key, "added") for key in added] + [(key, "changed") for key in changed]
+    changes.sort()
+    for key, action in changes:
+        yield key[0], action, key[1:], old.get(key), new.get(key)
+
+# Function to get the value of a change as written in the change list
+def value_json(kind, value):
+    if kind == "target" and value is not None:
+        return {"equivalence": value[0], "display": value[1]}
+    return value
+
+# Function to compare two packages, matching their resources by canonical url.
+# Unchanged resources are recognized by the hash of their bytes and never parsed; the new versions of the changed
+# ones are indexed on a second pass and compared while the old package is read again, so at most one package
+# is parsed at a time. Each change is written to output as a JSON line. Returns one summary per resource.
+def diff_packages(old_package, new_package, output=None):
+    old_hashes = {url: (resource_type, hashlib.sha256(data).digest()) for url, resource_type, data in package_resources(old_package)}
+
+    resources = {}
+    new_indexes = {}
+    for url, resource_type, data in package_resources(new_package):
+        if url in resources:
+            continue
+        if url not in old_hashes:
+            resource = json.loads(data)
+            concepts = sum(key[0] in ("concept", "target") for key in content_index(resource))
+            resources[url] = {"url": url, "resourceType": resource_type, "status": "added", "counts": {"concepts": concepts}}
+        elif old_hashes[url][1] == hashlib.sha256(data).digest():
+            resources[url] = {"url": url, "resourceType": resource_type, "status": "unchanged", "counts": {}}
+        else:
+            new_indexes[url] = content_index(json.loads(data))
+            # bytes that differ with the same content (e.g. new ids) leave the resource unchanged
+            resources[url] = {"url": url, "resourceType": resource_type, "status": "unchanged", "counts": {}}
+    for url, (resource_type, _) in old_hashes.items():
+        if url not in resources:
+            resources[url] = {"url": url, "resourceType": resource_type, "status": "removed", "counts": {}}
+
+    encode = json.JSONEncoder(ensure_ascii=False, default=str).encode
+    for url, resource_type, data in package_resources(old_package):
+        new_index = new_indexes.pop(url, None)
+        if new_index is None:
+            continue
+        record = resources[url]
+        counts = {}
+        for kind, action, key, old_value, new_value in compare_indexes(content_index(json.loads(data)), new_index):
+            record["status"] = "changed"
+            counts[(kind, action)] = counts.get((kind, action), 0) + 1
+            if output is not None:
+                change = {"resourceType": resource_type, "url": url, "kind": kind, "action": action}
+                change.update(zip(KEY_FIELDS[kind], key))
+                change["old"], change["new"] = value_json(kind, old_value), value_json(kind, new_value)
+                output.write(encode(change) + "\n")
+        record["counts"] = {f"{kind} {action}": count for (kind, action), count in counts.items()}
+
+    if output is not None:
+        for record in resources.values():
+            if record["status"] in ("added", "removed"):
+                output.write(json.dumps({"resourceType": record["resourceType"], "url": record["url"], "kind": "resource", "action": record["status"]}, ensure_ascii=False) + "\n")
+    return sorted(resources.values(), key=lambda record: (record["resourceType"], record["url"]))
+
+# Function to print the number of resources added, removed, changed and unchanged, and what changed in each
+def print_summary(resources, old_package, new_package, shown=20, file=sys.stdout):
+    statuses = {status: [record for record in resources if record["status"] == status] for status in ("added", "removed", "changed", "unchanged")}
+    print(f"Comparing {old_package} with {new_package}", file=file)
+    print(f"{len(resources)} resources: " + ", ".join(f"{len(records)} {status}" for status, records in statuses.items()), file=file)
+
+    listed = statuses["added"] + statuses["removed"] + statuses["changed"]
+    for record in listed[:shown]:
+        if record["status"] == "changed":
+            details = ", ".join(f"{count} {change}" for change, count in sorted(record["counts"].items()))
+        elif record["status"] == "added":
+            details = f"{record['counts']['concepts']} concepts and map targets"
+        else:
+            details = ""
+        print(f"  {record['status']:<8} {record['resourceType']} {record['url']}" + (f": {details}" if details else ""), file=file)
+    if len(listed) > shown:
+        print(f"  ... and {len(listed) - shown} more, see --changes", file=file)
+
+if __name__ == "__main__":
+    main()
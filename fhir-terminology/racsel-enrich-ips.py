@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+from racsel_terminology import TerminologyEngine, PackageIndex, resolve_system, code_key
+
+
+# Constants
+default_targets = ["snomed", "cie10", "cie11", "prequal"]
+
+# Coded elements enriched in each resource type of the IPS
+ENRICHED_ELEMENTS = {
+    "Condition": ["code"],
+    "Procedure": ["code"],
+    "AllergyIntolerance": ["code"],
+    "Immunization": ["vaccineCode"],
+    "MedicationStatement": ["medicationCodeableConcept"],
+    "Medication": ["code"],
+}
+
+# Systems written differently in some documents, looked up as the system of the package
+EQUIVALENT_SYSTEMS = {
+    "http://id.who.int/icd11/mms": "http://id.who.int/icd/release/11/mms",
+}
+
+# Engine and target systems of each worker process, loaded once by init_worker
+worker_engine = None
+worker_targets = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add the SNOMED, CIE10, CIE11 and PreQual codings translated with the ConceptMaps of a FHIR package to IPS Bundles.")
+    parser.add_argument("package", help="The FHIR package with the ConceptMaps (racsel_fhir_package.tgz), or its lookup index (racsel_fhir_package.idx), memory-mapped and shared by the workers")
+    parser.add_argument("input", help="NDJSON file with one Bundle per line, a Bundle .json file or a directory of them")
+    parser.add_argument("--output", required=True, help="Output NDJSON or .json file, or directory for a directory input")
+    parser.add_argument("--target-system", nargs="+", default=default_targets, help="Systems of the codings to add: uris or racsel, local, snomed, cie10, cie11, prequal (default: snomed cie10 cie11 prequal)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: number of CPUs)")
+    parser.add_argument("--chunk-size", type=int, default=64, help="Documents sent to a worker at once (default: 64)")
+
+    args = parser.parse_args()
+
+    if os.path.isdir(args.input):
+        os.makedirs(args.output, exist_ok=True)
+        tasks = [
+            (os.path.join(args.input, name), os.path.join(args.output, name))
+            for name in sorted(os.listdir(args.input)) if name.endswith(".json")
+        ]
+        work, items = enrich_file, tasks
+    elif args.input.endswith(".json"):
+        work, items = enrich_file, [(args.input, args.output)]
+    else:
+        work, items = enrich_line, None
+
+    documents = added = 0
+    with Pool(args.workers, initializer=init_worker, initargs=([args.package], args.target_system)) as pool:
+        if items is not None:
+            for count in pool.imap_unordered(work, items, args.chunk_size):
+                documents += 1
+                added += count
+        else:
+            # NDJSON: lines are parsed, enriched and serialized in the workers and written back in order
+            with open(args.input, encoding="utf-8") as source, open(args.output, "w", encoding="utf-8") as output:
+                for line, count in pool.imap(work, source, args.chunk_size):
+                    if line:
+                        output.write(line + "\n")
+                        documents += 1
+                        added += count
+
+    print(f"Enriched {documents} documents with {added} codings", file=sys.stderr)
+
+# Function to load the package, or map its lookup index, in a worker process
+def init_worker(package_paths, target_systems):
+    global worker_engine, worker_targets
+    if len(package_paths) == 1 and package_paths[0].endswith(".idx"):
+        worker_engine = PackageIndex(package_paths[0])
+    else:
+        worker_engine = TerminologyEngine.from_packages(package_paths)
+    worker_targets = {resolve_system(system, worker_engine.code_systems()) for system in target_systems}
+
+# Function to add to a CodeableConcept the translations of its codings to the target systems.
+# Codings already present are not repeated. Returns the number of codings added.
+def enrich_codeable_concept(concept, engine, target_systems):
+    codings = concept.get("coding", [])
+    present = {(coding.get("system"), code_key(coding.get("code"))) for coding in codings}
+    added = 0
+    for coding in list(codings):
+        system = EQUIVALENT_SYSTEMS.get(coding.get("system"), coding.get("system"))
+        for match in engine.matches(system, coding.get("code")):
+            if match.system in target_systems and (match.system, match.code) not in present:
+                present.add((match.system, match.code))
+                codings.append({"system": match.system, "code": match.code, "display": match.display})
+                added += 1
+    return added
+
+# Function to enrich the coded elements of a resource, or of every entry of a Bundle
+def enrich_resource(resource, engine, target_systems):
+    if resource.get("resourceType") == "Bundle":
+        return sum(enrich_resource(entry.get("resource", {}), engine, target_systems) for entry in resource.get("entry", []))
+    added = 0
+    for element in ENRICHED_ELEMENTS.get(resource.get("resourceType"), []):
+        if isinstance(resource.get(element), dict):
+            added += enrich_codeable_concept(resource[element], engine, target_systems)
+    return added
+
+# Function to enrich one NDJSON line in a worker. Returns the enriched line and the codings added
+def enrich_line(line):
+    if not line.strip():
+        return None, 0
+    document = json.loads(line)
+    added = enrich_resource(document, worker_engine, worker_targets)
+    return json.dumps(document, ensure_ascii=False, separators=(",", ":")), added
+
+# Function to enrich one .json document in a worker, written to output_path. Returns the codings added
+def enrich_file(paths):
+    input_path, output_path = paths
+    with open(input_path, encoding="utf-8") as f:
+        document = json.load(f)
+    added = enrich_resource(document, worker_engine, worker_targets)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(document, f, ensure_ascii=False, indent=2)
+    return added
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import json
+import sys
+
+import pandas as pd
+
+from racsel_terminology import read_package_resources, resolve_system, code_key
+
+
+# Constants
+default_chunk_size = 100000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Translate the codes of a CSV or NDJSON file in bulk with the ConceptMaps of a FHIR package built by racsel-convert-xlsx-to-fhir.py.")
+    parser.add_argument("package", help="The FHIR package with the ConceptMaps (racsel_fhir_package.tgz)")
+    parser.add_argument("input_file", help="CSV or NDJSON file with the codes, - for stdin")
+    parser.add_argument("--source-system", required=True, help="System of the input codes: a uri or racsel, local, snomed, cie10, cie11, prequal")
+    parser.add_argument("--target-system", required=True, help="System to translate to: a uri or racsel, local, snomed, cie10, cie11, prequal")
+    parser.add_argument("--domain", default=None, help="Only use the maps of a domain (Antecedentes, Diagnosticos, Vacunas, Alergias, Medicacion, Procedimientos)")
+    parser.add_argument("--code-column", default="code", help="Column (CSV) or field (NDJSON) with the codes (default: code)")
+    parser.add_argument("--format", choices=["csv", "ndjson"], default=None, help="Input format (default: from the file extension, csv for stdin)")
+    parser.add_argument("--output", default="-", help="Output file, in the input format (default: stdout)")
+    parser.add_argument("--chunk-size", type=int, default=default_chunk_size, help=f"Rows translated at once (default: {default_chunk_size})")
+    parser.add_argument("--unmapped-only", action="store_true", help="Only write the rows without a translation")
+
+    args = parser.parse_args()
+
+    input_format = args.format or ("ndjson" if args.input_file.endswith((".ndjson", ".jsonl")) else "csv")
+    resources = list(read_package_resources(args.package))
+    source_system = resolve_system(args.source_system, resources)
+    target_system = resolve_system(args.target_system, resources)
+    table = mapping_table(resources, source_system, target_system, args.domain)
+
+    rows = mapped = 0
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8", newline="")
+    try:
+        for i, chunk in enumerate(read_chunks(args.input_file, input_format, args.chunk_size, args.code_column)):
+            translated = translate_chunk(chunk, table, args.code_column)
+            rows += len(chunk)
+            mapped += int(translated.drop_duplicates("_row")["mapped"].sum())
+            if args.unmapped_only:
+                translated = translated[~translated["mapped"]]
+            write_chunk(translated.drop(columns="_row"), output, input_format, header=i == 0)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(f"Translated {rows} rows from {source_system} to {target_system}: {mapped} mapped, {rows - mapped} unmapped", file=sys.stderr)
+
+# Function to build the translation table from source_system to target_system out of the package ConceptMaps,
+# optionally only the ValueSet-based maps of a domain. Returns a frame with one row per (source code, target code).
+def mapping_table(resources, source_system, target_system, domain=None):
+    prefix = f"http://racsel.org/fhir/ConceptMap/vs-{domain.lower()}-" if domain else None
+    rows = []
+    for resource in resources:
+        if resource["resourceType"] != "ConceptMap" or (prefix and not resource["url"].startswith(prefix)):
+            continue
+        for group in resource.get("group", []):
+            if group["source"] != source_system or group["target"] != target_system:
+                continue
+            for element in group.get("element", []):
+                for target in element.get("target", []):
+                    rows.append((code_key(element["code"]), code_key(target["code"]), target.get("display"), target.get("equivalence", "equivalent")))
+    if not rows:
+        scope = f" in domain {domain}" if domain else ""
+        raise ValueError(f"The package has no ConceptMap from {source_system} to {target_system}{scope}")
+    # the same map is in the package once per scope (CodeSystem, global and domain ValueSets)
+    return pd.DataFrame(rows, columns=["_code", "target_code", "target_display", "equivalence"]).drop_duplicates(["_code", "target_code"])
+
+# Function to read the input in chunks of chunk_size rows, with the code column as strings
+def read_chunks(input_file, input_format, chunk_size, code_column):
+    source = sys.stdin if input_file == "-" else input_file
+    if input_format == "csv":
+        chunks = pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=chunk_size)
+    else:
+        chunks = pd.read_json(source, lines=True, dtype=False, chunksize=chunk_size)
+    for chunk in chunks:
+        if code_column not in chunk.columns:
+            raise ValueError(f"The input has no {code_column} column, use --code-column")
+        yield chunk
+
+# Function to translate a chunk with a single join against the translation table.
+# A code with several targets gives one output row per target, codes without one keep the row with mapped false.
+def translate_chunk(chunk, table, code_column):
+    codes = chunk[code_column].astype(str).str.strip()
+    # codes read as numbers by a spreadsheet or a JSON parser (46635009.0), but not ICD-10 codes like E10.0
+    numeric = codes.str.endswith(".0")
+    numeric[numeric] = codes[numeric].str[:-2].str.isdigit()
+    codes[numeric] = codes[numeric].str[:-2]
+    keyed = chunk.assign(_code=codes.values, _row=range(len(chunk)))
+    translated = keyed.merge(table, on="_code", how="left", sort=False)
+    translated["mapped"] = translated["target_code"].notna()
+    return translated.drop(columns="_code")
+
+# Function to write a translated chunk in the input format
+def write_chunk(translated, output, output_format, header):
+    if output_format == "csv":
+        translated.to_csv(output, index=False, header=header)
+    else:
+        for record in translated.to_dict("records"):
+            record = {key: (None if isinstance(value, float) and pd.isna(value) else value) for key, value in record.items()}
+            output.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+if __name__ == "__main__":
+    main()
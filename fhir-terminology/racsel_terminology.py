@@ -0,0 +1,748 @@
+import argparse
+import asyncio
+import datetime
+import email.parser
+import email.policy
+import gzip
+import json
+import mmap
+import os
+import struct
+import sys
+import tarfile
+import tempfile
+import uuid
+from collections import namedtuple
+from urllib.parse import urlsplit, parse_qs
+
+
+# Constants
+default_host = "127.0.0.1"
+default_port = 8090
+fhir_json = "application/fhir+json; charset=utf-8"
+load_package_path = "/fhir-admin/load-package"
+index_magic = b"RACSELIX"
+index_version = 1
+# string id of a missing display
+no_string = 0xFFFFFFFF
+
+# Resource types loaded from the packages and served by the search and read interactions
+RESOURCE_TYPES = ["CodeSystem", "ValueSet", "ConceptMap"]
+
+# Short names accepted for the systems by the command line tools, the local system is the uri of the LocalCodeSystem
+SYSTEM_ALIASES = {
+    "racsel": "http://racsel.org/connectathon",
+    "snomed": "http://snomed.info/sct",
+    "cie10": "http://hl7.org/fhir/sid/icd-10",
+    "cie11": "http://id.who.int/icd/release/11/mms",
+    "prequal": "http://smart.who.int/pcmt-vaxprequal/CodeSystem/PreQualProductIDs",
+}
+
+# One translation of a code: the concept it maps to, with the ConceptMap it comes from and the source and
+# target scopes of that map (the ValueSet urls of a ValueSet-based map, the system uris of a CodeSystem-based one)
+Match = namedtuple("Match", ["system", "code", "display", "equivalence", "map_url", "source", "target"])
+
+HTTP_REASONS = {200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+# Error of a terminology operation, answered with an OperationOutcome and the HTTP status
+class OperationError(Exception):
+    def __init__(self, message, status=400, code="invalid"):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+    def outcome(self):
+        return {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": self.code, "diagnostics": str(self)}]}
+
+
+# Function to get the key of a code. Codes may be numbers in the packages (SNOMED codes read from Excel)
+# and are always strings in the requests, 46635009, 46635009.0 and "46635009" are the same code.
+def code_key(code):
+    if isinstance(code, float) and code.is_integer():
+        code = int(code)
+    return str(code)
+
+# Function to get the uri of a system given as a uri or alias, resources are the package resources
+def resolve_system(system, resources):
+    if system == "local":
+        local = [resource["url"] for resource in resources if resource["resourceType"] == "CodeSystem" and resource.get("name") == "LocalCodeSystem"]
+        if not local:
+            raise ValueError("The package has no LocalCodeSystem, give the local system uri")
+        return local[0]
+    return SYSTEM_ALIASES.get(system, system)
+
+# Function to stream the files of a package (.tgz, or .tar.zst with the zstandard package) in archive order,
+# one (package filename, bytes) at a time
+def read_package_members(package_path):
+    with open(package_path, "rb") as f:
+        if package_path.endswith(".zst"):
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("reading zstd packages requires the zstandard package (pip install zstandard)")
+            fileobj = zstandard.ZstdDecompressor().stream_reader(f)
+        else:
+            fileobj = gzip.GzipFile(fileobj=f, mode="rb")
+        with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+            for member in tar:
+                if member.isfile():
+                    yield member.name, tar.extractfile(member).read()
+
+# Function to read every resource of a package (.tgz, or .tar.zst with the zstandard package)
+def read_package_resources(package_path):
+    for name, data in read_package_members(package_path):
+        if name.endswith(".json") and not name.startswith("package/other/"):
+            resource = json.loads(data)
+            if resource.get("resourceType") in RESOURCE_TYPES:
+                yield resource
+
+
+# Answers $translate, $validate-code, $expand and $lookup from the resources of one or more packages, with hash
+# indexes built once at load time: forward and reverse translations by (system, code), displays by (system, code)
+# and the members of every ValueSet (resolved on first use, including the ValueSets it includes).
+class TerminologyEngine:
+    def __init__(self):
+        self.resources = {resource_type: {} for resource_type in RESOURCE_TYPES}
+        self.ids = {resource_type: {} for resource_type in RESOURCE_TYPES}
+        self.code_system_names = {}
+        self.displays = {}
+        self.translations = {}
+        self.reverse_translations = {}
+        self.value_set_members = {}
+        self.value_set_codes = {}
+
+    # Function to create an engine with the resources of several packages.
+    # A canonical url found in more than one package keeps the resource of the first one.
+    @classmethod
+    def from_packages(cls, package_paths):
+        engine = cls()
+        for package_path in package_paths:
+            for resource in read_package_resources(package_path):
+                engine.add_resource(resource)
+        return engine
+
+    # Function to add a resource and index its concepts and maps
+    def add_resource(self, resource):
+        resource_type, url = resource["resourceType"], resource["url"]
+        if url in self.resources[resource_type]:
+            return
+        self.resources[resource_type][url] = resource
+        self.ids[resource_type][resource["id"]] = resource
+
+        if resource_type == "CodeSystem":
+            self.code_system_names[url] = resource.get("name", url)
+            # the CodeSystem display wins over the displays found in ValueSets and maps
+            for concept in resource.get("concept", []):
+                self.displays[(url, code_key(concept["code"]))] = concept.get("display")
+        elif resource_type == "ValueSet":
+            for include in resource.get("compose", {}).get("include", []):
+                for concept in include.get("concept", []):
+                    self.displays.setdefault((include["system"], code_key(concept["code"])), concept.get("display"))
+        else:
+            source_scope = resource.get("sourceCanonical") or resource.get("sourceUri")
+            target_scope = resource.get("targetCanonical") or resource.get("targetUri")
+            for group in resource.get("group", []):
+                for element in group.get("element", []):
+                    source_code = code_key(element["code"])
+                    self.displays.setdefault((group["source"], source_code), element.get("display"))
+                    for target in element.get("target", []):
+                        target_code = code_key(target["code"])
+                        self.displays.setdefault((group["target"], target_code), target.get("display"))
+                        equivalence = target.get("equivalence", "equivalent")
+                        self.translations.setdefault((group["source"], source_code), []).append(
+                            Match(group["target"], target_code, target.get("display"), equivalence, url, source_scope, target_scope))
+                        self.reverse_translations.setdefault((group["target"], target_code), []).append(
+                            Match(group["source"], source_code, element.get("display"), equivalence, url, target_scope, source_scope))
+
+        # a new resource may change the members of the ValueSets resolved so far
+        self.value_set_members.clear()
+        self.value_set_codes.clear()
+
+    # Function to load resources replacing the ones with the same canonical url, as a load-package of Snowstorm does.
+    # The indexes are built again from all the resources.
+    def load(self, resources):
+        loaded = {resource_type: dict(by_url) for resource_type, by_url in self.resources.items()}
+        for resource in resources:
+            loaded[resource["resourceType"]][resource["url"]] = resource
+        self.__init__()
+        for by_url in loaded.values():
+            for resource in by_url.values():
+                self.add_resource(resource)
+
+    # Function to get the members of a ValueSet as a dict {(system, code): display}, in compose order.
+    # Includes with a concept list add those concepts, includes of other ValueSets add their members
+    # and includes of a whole system add the concepts of its CodeSystem fragment.
+    def members(self, url, resolving=()):
+        if url in self.value_set_members:
+            return self.value_set_members[url]
+        value_set = self.resources["ValueSet"].get(url)
+        if value_set is None:
+            raise OperationError(f"ValueSet {url} not found", 404, "not-found")
+        if url in resolving:
+            raise OperationError(f"ValueSet {url} includes itself", 400, "processing")
+
+        members = {}
+        for include in value_set.get("compose", {}).get("include", []):
+            for included_url in include.get("valueSet", []):
+                for key, display in self.members(included_url, resolving + (url,)).items():
+                    members.setdefault(key, display)
+            if "system" not in include:
+                continue
+            if "concept" in include:
+                for concept in include["concept"]:
+                    members.setdefault((include["system"], code_key(concept["code"])), concept.get("display"))
+            elif include["system"] in self.resources["CodeSystem"]:
+                for concept in self.resources["CodeSystem"][include["system"]].get("concept", []):
+                    members.setdefault((include["system"], code_key(concept["code"])), concept.get("display"))
+
+        self.value_set_members[url] = members
+        return members
+
+    # Function to get the members of a ValueSet by code only, for $validate-code without a system
+    def member_codes(self, url):
+        if url not in self.value_set_codes:
+            codes = {}
+            for (system, code), display in self.members(url).items():
+                codes.setdefault(code, (system, display))
+            self.value_set_codes[url] = codes
+        return self.value_set_codes[url]
+
+    # Function to get the translations of a code, or with reverse the codes that map to it, as Match tuples
+    def matches(self, system, code, reverse=False):
+        index = self.reverse_translations if reverse else self.translations
+        return index.get((system, code_key(code)), ())
+
+    # Function to get the url and name of every CodeSystem, enough to resolve the system aliases
+    def code_systems(self):
+        return [{"resourceType": "CodeSystem", "url": url, "name": name} for url, name in self.code_system_names.items()]
+
+    # Function to translate a code, or with reverse to find the codes that map to it.
+    # targetsystem, url (ConceptMap), source and target (ValueSet or system scopes) narrow the maps used.
+    # A concept reached through several maps is returned once, with the first map that gives it.
+    def translate(self, code, system, targetsystem=None, url=None, source=None, target=None, reverse=False):
+        if code is None or system is None:
+            raise OperationError("$translate needs a code and a system")
+        index = self.reverse_translations if reverse else self.translations
+        matches = []
+        seen = set()
+        for match in index.get((system, code_key(code)), ()):
+            if (targetsystem and match.system != targetsystem) or (url and match.map_url != url):
+                continue
+            if (source and match.source != source) or (target and match.target != target):
+                continue
+            if (match.system, match.code) not in seen:
+                seen.add((match.system, match.code))
+                matches.append(match)
+
+        parameters = [{"name": "result", "valueBoolean": bool(matches)}]
+        if not matches:
+            parameters.append({"name": "message", "valueString": f"No mappings found for {system}|{code}" + (f" to {targetsystem}" if targetsystem else "")})
+        for match in matches:
+            parameters.append({"name": "match", "part": [
+                {"name": "equivalence", "valueCode": match.equivalence},
+                {"name": "concept", "valueCoding": {"system": match.system, "code": match.code, "display": match.display}},
+                {"name": "source", "valueUri": match.map_url},
+            ]})
+        return {"resourceType": "Parameters", "parameter": parameters}
+
+    # Function to check that a code is in a ValueSet, and its display when given
+    def validate_code(self, url, code, system=None, display=None):
+        if url is None or code is None:
+            raise OperationError("$validate-code needs a ValueSet url and a code")
+        code = code_key(code)
+        if system:
+            found = (system, code) in self.members(url)
+            expected = self.members(url).get((system, code))
+        else:
+            found = code in self.member_codes(url)
+            system, expected = self.member_codes(url).get(code, (None, None))
+
+        parameters = [{"name": "result", "valueBoolean": found}]
+        if not found:
+            parameters.append({"name": "message", "valueString": f"The code '{code}' is not in the ValueSet {url}"})
+        elif display and expected and display != expected:
+            parameters[0]["valueBoolean"] = False
+            parameters.append({"name": "message", "valueString": f"The display '{display}' is not the display of '{code}' ('{expected}')"})
+        if found and expected:
+            parameters.append({"name": "display", "valueString": expected})
+        return {"resourceType": "Parameters", "parameter": parameters}
+
+    # Function to expand a ValueSet, filter matches the code or display (case insensitive)
+    def expand(self, url, filter=None, offset=0, count=None):
+        if url is None:
+            raise OperationError("$expand needs a ValueSet url")
+        members = self.members(url)
+        text = filter.lower() if filter else None
+        contains = [
+            {"system": system, "code": code, "display": display}
+            for (system, code), display in members.items()
+            if text is None or text in code.lower() or (display and text in display.lower())
+        ]
+        value_set = {key: value for key, value in self.resources["ValueSet"][url].items() if key != "compose"}
+        value_set["expansion"] = {
+            "identifier": f"urn:uuid:{uuid.uuid4()}",
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "total": len(contains),
+            "offset": offset,
+            "contains": contains[offset:offset + count if count is not None else None],
+        }
+        return value_set
+
+    # Function to get the display of a code of a system
+    def lookup(self, system, code):
+        if system is None or code is None:
+            raise OperationError("$lookup needs a system and a code")
+        key = (system, code_key(code))
+        if key not in self.displays:
+            raise OperationError(f"Code '{code}' not found in {system}", 404, "not-found")
+        parameters = [{"name": "name", "valueString": self.code_system_names.get(system, system)}]
+        code_system = self.resources["CodeSystem"].get(system)
+        if code_system and "version" in code_system:
+            parameters.append({"name": "version", "valueString": code_system["version"]})
+        parameters.append({"name": "display", "valueString": self.displays[key]})
+        return {"resourceType": "Parameters", "parameter": parameters}
+
+    # Function to search the resources of a type, optionally by canonical url, as a searchset Bundle
+    def search(self, resource_type, url=None):
+        if url is not None:
+            resources = [self.resources[resource_type][url]] if url in self.resources[resource_type] else []
+        else:
+            resources = list(self.resources[resource_type].values())
+        return {"resourceType": "Bundle", "type": "searchset", "total": len(resources), "entry": [{"resource": resource} for resource in resources]}
+
+    # Function to read a resource by id
+    def read(self, resource_type, resource_id):
+        if resource_id not in self.ids[resource_type]:
+            raise OperationError(f"{resource_type}/{resource_id} not found", 404, "not-found")
+        return self.ids[resource_type][resource_id]
+
+
+# Function to write the compiled lookup index of the resources of a package to index_path.
+# The index is a table of sections after a fixed header, every section aligned to 8 bytes:
+#   stroff  u32 offsets of the strings in strdat (one more than the strings)
+#   strdat  UTF-8 bytes of every string (system uris, codes, displays, equivalences, map and ValueSet urls)
+#   trans   u32 records (source system, source code, target system, target code, target display, equivalence, map url)
+#           sorted by source system id and source code bytes, one record per (source, target) concept pair
+#   rtrans  u32 record numbers of trans sorted by target system id and target code bytes, for reverse translations
+#   display u32 records (system, code, display) sorted by system id and code bytes
+#   vsmem   u32 records (ValueSet url, system, code, display) sorted by url id, system id and code bytes
+#   systems u32 string ids of the code systems, vsets the ids of the ValueSet urls
+#   meta    JSON with the CodeSystem urls and names
+# All numbers are little-endian, strings are referenced by id and a missing display is no_string.
+def write_index(resources, index_path):
+    engine = TerminologyEngine()
+    for resource in resources:
+        engine.add_resource(resource)
+
+    strings = {}
+    def string_id(value):
+        if value is None:
+            return no_string
+        return strings.setdefault(str(value), len(strings))
+
+    translations = {}
+    for (system, code), matches in engine.translations.items():
+        for match in matches:
+            # the same map is in the package once per scope, the first map that gives a concept is kept
+            translations.setdefault((system, code, match.system, match.code), (
+                string_id(system), string_id(code), string_id(match.system), string_id(match.code),
+                string_id(match.display), string_id(match.equivalence), string_id(match.map_url)))
+    displays = [(string_id(system), string_id(code), string_id(display)) for (system, code), display in engine.displays.items()]
+    members = []
+    for url in engine.resources["ValueSet"]:
+        try:
+            value_set_members = engine.members(url)
+        except OperationError:
+            # a ValueSet including one of another package has no members of its own in the index
+            continue
+        members.extend((string_id(url), string_id(system), string_id(code), string_id(display)) for (system, code), display in value_set_members.items())
+    systems = sorted({string_id(system) for system, code in engine.displays})
+    value_sets = [string_id(url) for url in engine.resources["ValueSet"]]
+
+    encoded = [value.encode("utf-8") for value in strings]
+    translations = sorted(translations.values(), key=lambda record: (record[0], encoded[record[1]], record[2], encoded[record[3]]))
+    reverse = sorted(range(len(translations)), key=lambda i: (translations[i][2], encoded[translations[i][3]], translations[i][0], encoded[translations[i][1]]))
+    displays.sort(key=lambda record: (record[0], encoded[record[1]]))
+    members.sort(key=lambda record: (record[0], record[1], encoded[record[2]]))
+
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    meta = {"code_systems": engine.code_systems()}
+
+    def u32(values):
+        return struct.pack(f"<{len(values)}I", *values)
+    sections = [
+        ("stroff", u32(offsets)),
+        ("strdat", b"".join(encoded)),
+        ("trans", u32([field for record in translations for field in record])),
+        ("rtrans", u32(reverse)),
+        ("display", u32([field for record in displays for field in record])),
+        ("vsmem", u32([field for record in members for field in record])),
+        ("systems", u32(systems)),
+        ("vsets", u32(value_sets)),
+        ("meta", json.dumps(meta, ensure_ascii=False).encode("utf-8")),
+    ]
+
+    # header (magic, version, section count) and table of sections (name, offset, length in bytes)
+    position = 16 + 24 * len(sections)
+    table, padded = [], []
+    for name, data in sections:
+        position += -position % 8
+        table.append(struct.pack("<8sQQ", name.encode("ascii"), position, len(data)))
+        padded.append(data)
+        position += len(data)
+    temp_path = index_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(struct.pack("<8sII", index_magic, index_version, len(sections)))
+        f.write(b"".join(table))
+        for data in padded:
+            f.write(b"\0" * (-f.tell() % 8))
+            f.write(data)
+    os.replace(temp_path, index_path)
+    return {"strings": len(strings), "translations": len(translations), "displays": len(displays), "members": len(members)}
+
+
+# Reads a lookup index written by write_index. The file is memory-mapped and the record tables are used in place
+# as u32 arrays, so opening it only reads the header and nothing is parsed or copied: lookups are binary searches
+# over the mapped pages, shared between the processes that open the same file.
+# It answers the lookups of TerminologyEngine that do not need the resources (matches, display, members).
+class PackageIndex:
+    def __init__(self, index_path):
+        with open(index_path, "rb") as f:
+            self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = struct.unpack_from("<8sII", self.mapped, 0)
+        if magic != index_magic:
+            raise ValueError(f"{index_path} is not a terminology index")
+        if version != index_version:
+            raise ValueError(f"{index_path} is an index of version {version}, this reader supports version {index_version}")
+        if sys.byteorder != "little":
+            raise RuntimeError("terminology indexes can only be read on little-endian machines")
+
+        view = memoryview(self.mapped)
+        self.sections, offsets = {}, {}
+        for i in range(count):
+            name, offset, length = struct.unpack_from("<8sQQ", self.mapped, 16 + 24 * i)
+            name = name.rstrip(b"\0").decode("ascii")
+            self.sections[name], offsets[name] = view[offset:offset + length], offset
+        self.string_offsets = self.sections["stroff"].cast("I")
+        # strings are sliced from the map itself, which gives the bytes in a single step
+        self.string_base = offsets["strdat"]
+        self.translations = self.sections["trans"].cast("I")
+        self.reverse_order = self.sections["rtrans"].cast("I")
+        self.display_records = self.sections["display"].cast("I")
+        self.member_records = self.sections["vsmem"].cast("I")
+        # the few systems and ValueSets are looked up by uri, every other string only by id
+        self.system_ids = {self.string(i): i for i in self.sections["systems"].cast("I")}
+        self.value_set_ids = {self.string(i): i for i in self.sections["vsets"].cast("I")}
+        self.meta = json.loads(bytes(self.sections["meta"]))
+
+    # Function to get the bytes of a string by id
+    def string_bytes(self, i):
+        return self.mapped[self.string_base + self.string_offsets[i]:self.string_base + self.string_offsets[i + 1]]
+
+    # Function to get a string by id, None for no_string
+    def string(self, i):
+        return None if i == no_string else self.string_bytes(i).decode("utf-8")
+
+    # Function to find the records of a table with the given key, as the positions of their first field.
+    # key is one or more string ids followed by the bytes of a code, compared with the record fields
+    # (fields, by default the first ones) in the sort order of the table: ids as numbers, codes as bytes.
+    # order gives the records in key order when the table is sorted by other fields.
+    def find(self, records, width, key, fields=None, order=None):
+        fields = fields or range(len(key))
+        *ids, code = key
+        *id_fields, code_field = fields
+        id_pairs = list(zip(id_fields, ids))
+        count = len(records) // width
+
+        # -1, 0 or 1 as the record at position i sorts before, with or after the key
+        def compare(i):
+            base = (order[i] if order is not None else i) * width
+            for field, value in id_pairs:
+                if records[base + field] != value:
+                    return -1 if records[base + field] < value else 1
+            record_code = self.string_bytes(records[base + code_field])
+            return (record_code > code) - (record_code < code)
+
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if compare(middle) < 0:
+                low = middle + 1
+            else:
+                high = middle
+        found = []
+        while low < count and compare(low) == 0:
+            found.append((order[low] if order is not None else low) * width)
+            low += 1
+        return found
+
+    # Function to get the translations of a code, or with reverse the codes that map to it, as Match tuples
+    # (without the map scopes, that are not in the index)
+    def matches(self, system, code, reverse=False):
+        if system not in self.system_ids:
+            return []
+        records = self.translations
+        key = (self.system_ids[system], code_key(code).encode("utf-8"))
+        matches = []
+        if reverse:
+            for base in self.find(records, 7, key, (2, 3), self.reverse_order):
+                match_system, match_code = self.string(records[base]), self.string(records[base + 1])
+                # the records keep the target display, the display of a source code is in the display table
+                matches.append(Match(match_system, match_code, self.display(match_system, match_code),
+                                     self.string(records[base + 5]), self.string(records[base + 6]), None, None))
+        else:
+            for base in self.find(records, 7, key):
+                matches.append(Match(self.string(records[base + 2]), self.string(records[base + 3]), self.string(records[base + 4]),
+                                     self.string(records[base + 5]), self.string(records[base + 6]), None, None))
+        return matches
+
+    # Function to get the display of a code of a system, None when the code is not in the index
+    def display(self, system, code):
+        if system not in self.system_ids:
+            return None
+        found = self.find(self.display_records, 3, (self.system_ids[system], code_key(code).encode("utf-8")))
+        return self.string(self.display_records[found[0] + 2]) if found else None
+
+    # Function to get the members of a ValueSet as a list of (system, code, display), sorted by system and code
+    def members(self, url):
+        if url not in self.value_set_ids:
+            raise OperationError(f"ValueSet {url} not found", 404, "not-found")
+        records, count, value_set = self.member_records, len(self.member_records) // 4, self.value_set_ids[url]
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if records[4 * middle] < value_set:
+                low = middle + 1
+            else:
+                high = middle
+        members = []
+        while low < count and records[4 * low] == value_set:
+            members.append((self.string(records[4 * low + 1]), self.string(records[4 * low + 2]), self.string(records[4 * low + 3])))
+            low += 1
+        return members
+
+    # Function to check that a code of a system is in a ValueSet
+    def contains(self, url, system, code):
+        if url not in self.value_set_ids or system not in self.system_ids:
+            return False
+        key = (self.value_set_ids[url], self.system_ids[system], code_key(code).encode("utf-8"))
+        return bool(self.find(self.member_records, 4, key))
+
+    # Function to get the url and name of every CodeSystem, enough to resolve the system aliases
+    def code_systems(self):
+        return self.meta["code_systems"]
+
+
+# Function to get the operation parameters of a request: the query string, and for POST the Parameters body.
+# A valueCoding parameter (coding) gives its system and code.
+def request_parameters(query, body=b""):
+    parameters = {name: values[0] for name, values in parse_qs(query, keep_blank_values=True).items()}
+    if body:
+        try:
+            document = json.loads(body)
+        except ValueError:
+            raise OperationError("The request body is not JSON")
+        if not isinstance(document, dict) or document.get("resourceType") != "Parameters" or not isinstance(document.get("parameter", []), list):
+            raise OperationError("The request body must be a Parameters resource")
+        for parameter in document.get("parameter", []):
+            if not isinstance(parameter, dict) or not isinstance(parameter.get("name"), str):
+                raise OperationError("Every parameter of the request body needs a name")
+            if isinstance(parameter.get("valueCoding"), dict):
+                parameters.setdefault("system", parameter["valueCoding"].get("system"))
+                parameters.setdefault("code", parameter["valueCoding"].get("code"))
+                continue
+            for key, value in parameter.items():
+                if key.startswith("value"):
+                    parameters[parameter["name"]] = value if isinstance(value, str) else json.dumps(value)
+    return parameters
+
+# Function to parse an integer parameter
+def integer_parameter(parameters, name, default=None):
+    value = parameters.get(name)
+    if value in (None, ""):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise OperationError(f"{name} must be an integer")
+
+# Function to load a package uploaded as to the load-package of Snowstorm: a multipart form with the package
+# in file and the canonical urls to load in resourceUrls (comma separated, * for all)
+def load_uploaded_package(engine, body, content_type):
+    if not content_type or not content_type.startswith("multipart/form-data"):
+        raise OperationError("load-package needs a multipart/form-data body")
+    form = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body)
+    fields = {part.get_param("name", header="content-disposition"): part for part in form.iter_parts()}
+    if "file" not in fields:
+        raise OperationError("load-package needs the package in the file field")
+    resource_urls = fields["resourceUrls"].get_content().strip() if "resourceUrls" in fields else "*"
+    wanted = None if resource_urls == "*" else {url.strip() for url in resource_urls.split(",")}
+
+    # read_package_resources reads a file, the package is written to a temporary one
+    with tempfile.NamedTemporaryFile(suffix=".tgz", delete=False) as f:
+        f.write(fields["file"].get_payload(decode=True))
+    try:
+        resources = [resource for resource in read_package_resources(f.name) if wanted is None or resource["url"] in wanted]
+    except (OSError, EOFError, tarfile.TarError, ValueError) as e:
+        raise OperationError(f"The uploaded file is not a FHIR package: {e}")
+    finally:
+        os.remove(f.name)
+    engine.load(resources)
+    return {"resourceType": "OperationOutcome", "issue": [{"severity": "information", "code": "informational", "diagnostics": f"Loaded {len(resources)} resources"}]}
+
+# Function to apply a FHIR transaction Bundle of conditional updates (PUT CodeSystem?url=...), as written by the
+# converter with --bundles, replacing the resources with the same canonical url as a FHIR server would.
+# Returns the transaction-response Bundle
+def process_transaction(engine, body):
+    try:
+        bundle = json.loads(body)
+    except ValueError as e:
+        raise OperationError(f"The body is not JSON: {e}")
+    if not isinstance(bundle, dict) or bundle.get("resourceType") != "Bundle" or bundle.get("type") != "transaction":
+        raise OperationError("Only transaction Bundles can be posted to the base url")
+    resources, entries = [], []
+    for entry in bundle.get("entry", []):
+        resource = entry.get("resource", {})
+        request = entry.get("request", {})
+        resource_type = resource.get("resourceType")
+        if request.get("method") != "PUT" or resource_type not in RESOURCE_TYPES or "url" not in resource:
+            raise OperationError(f"Unsupported entry {request.get('method')} {request.get('url')}, only conditional updates of {', '.join(RESOURCE_TYPES)} are accepted")
+        existing = engine.resources[resource_type].get(resource["url"])
+        resources.append(resource)
+        entries.append({"response": {
+            "status": "200 OK" if existing is not None else "201 Created",
+            "location": f"{resource_type}/{resource.get('id', '')}/_history/1",
+        }})
+    engine.load(resources)
+    return {"resourceType": "Bundle", "type": "transaction-response", "entry": entries}
+
+# Function to answer a request with the engine (see answer_request). Any other error than an OperationError is
+# answered with a 500 OperationOutcome, so the client always gets a response. Returns the HTTP status and the JSON document
+def handle_request(engine, method, target, body=b"", content_type=None):
+    try:
+        return answer_request(engine, method, target, body, content_type)
+    except Exception as e:
+        return 500, OperationError(f"{type(e).__name__}: {e}", 500, "exception").outcome()
+
+# Function to answer a request with the engine, paths as in connectathon-swagger.yaml with or without the /fhir prefix,
+# and the load-package of Snowstorm, so the server can stand in for it when testing the upload of a package.
+# A transaction Bundle posted to the base url is applied with process_transaction, as on HAPI FHIR.
+# Returns the HTTP status and the JSON document
+def answer_request(engine, method, target, body=b"", content_type=None):
+    parts = urlsplit(target)
+    path = parts.path.rstrip("/")
+    if path == load_package_path:
+        if method != "POST":
+            return 405, OperationError(f"Method {method} not allowed", 405, "not-supported").outcome()
+        try:
+            return 200, load_uploaded_package(engine, body, content_type)
+        except OperationError as e:
+            return e.status, e.outcome()
+    if path.startswith("/fhir"):
+        path = path[len("/fhir"):]
+    segments = [segment for segment in path.split("/") if segment]
+    try:
+        if method not in ("GET", "POST"):
+            raise OperationError(f"Method {method} not allowed", 405, "not-supported")
+        if not segments and method == "POST":
+            return 200, process_transaction(engine, body)
+        if not segments or segments[0] not in RESOURCE_TYPES or len(segments) > 2:
+            raise OperationError(f"Unknown path {parts.path}", 404, "not-found")
+        parameters = request_parameters(parts.query, body if method == "POST" else b"")
+        resource_type = segments[0]
+        operation = segments[1] if len(segments) == 2 else None
+
+        if operation == "$translate" and resource_type == "ConceptMap":
+            return 200, engine.translate(
+                parameters.get("code"), parameters.get("system"), parameters.get("targetsystem"), parameters.get("url"),
+                parameters.get("source"), parameters.get("target"), parameters.get("reverse", "false").lower() == "true")
+        if operation == "$validate-code" and resource_type == "ValueSet":
+            return 200, engine.validate_code(parameters.get("url"), parameters.get("code"), parameters.get("system"), parameters.get("display"))
+        if operation == "$expand" and resource_type == "ValueSet":
+            return 200, engine.expand(parameters.get("url"), parameters.get("filter"), integer_parameter(parameters, "offset", 0), integer_parameter(parameters, "count"))
+        if operation == "$lookup" and resource_type == "CodeSystem":
+            return 200, engine.lookup(parameters.get("system"), parameters.get("code"))
+        if operation is None and method == "GET":
+            return 200, engine.search(resource_type, parameters.get("url"))
+        if operation and not operation.startswith("$") and method == "GET":
+            return 200, engine.read(resource_type, operation)
+        raise OperationError(f"Operation {operation} not supported on {resource_type}", 404, "not-supported")
+    except OperationError as e:
+        return e.status, e.outcome()
+
+# Function to serve one HTTP/1.1 connection, with keep-alive, until the client closes it
+async def handle_connection(engine, reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+
+            try:
+                method, target, version = request_line.decode("latin-1").split()
+            except ValueError:
+                method, target, version = None, None, "HTTP/1.0"
+            if method == "OPTIONS":
+                status, payload = 204, b""
+            elif method is None:
+                status, payload = 400, json.dumps(OperationError("Malformed request line").outcome()).encode("utf-8")
+            else:
+                status, document = handle_request(engine, method, target, body, headers.get("content-type"))
+                payload = json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            response_headers = [
+                f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}",
+                f"Content-Type: {fhir_json}",
+                f"Content-Length: {len(payload)}",
+                "Access-Control-Allow-Origin: *",
+                "Access-Control-Allow-Methods: GET, POST, OPTIONS",
+                "Access-Control-Allow-Headers: Content-Type, Authorization",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}",
+            ]
+            writer.write(("\r\n".join(response_headers) + "\r\n\r\n").encode("latin-1") + payload)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+# Function to run the HTTP server until interrupted
+async def serve(engine, host=default_host, port=default_port):
+    server = await asyncio.start_server(lambda reader, writer: handle_connection(engine, reader, writer), host, port)
+    print(f"Serving the terminology on http://{host}:{port}/fhir")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer $translate, $validate-code, $expand and $lookup from FHIR packages built by racsel-convert-xlsx-to-fhir.py, without Snowstorm.")
+    parser.add_argument("packages", nargs="*", help="The FHIR packages to load (racsel_fhir_package.tgz), more can be uploaded to /fhir-admin/load-package")
+    parser.add_argument("--host", default=default_host, help=f"Address to listen on (default: {default_host})")
+    parser.add_argument("--port", type=int, default=default_port, help=f"Port to listen on (default: {default_port})")
+
+    args = parser.parse_args()
+
+    engine = TerminologyEngine.from_packages(args.packages)
+    counts = ", ".join(f"{len(engine.resources[resource_type])} {resource_type}s" for resource_type in RESOURCE_TYPES)
+    print(f"Loaded {counts} from {', '.join(args.packages) or 'no packages'}")
+    try:
+        asyncio.run(serve(engine, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
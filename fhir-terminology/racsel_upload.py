@@ -0,0 +1,432 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import ssl
+import sys
+import time
+import uuid
+from collections import namedtuple
+from urllib.parse import urlsplit, urlencode
+
+from racsel_terminology import TerminologyEngine, OperationError, read_package_resources, code_key
+
+
+# Constants
+default_concurrency = 16
+default_sample = 200
+default_timeout = 300
+default_request_timeout = 30
+default_retries = 3
+default_load_timeout = 30
+poll_interval = 1.0
+retry_backoff = 0.5
+load_package_path = "/fhir-admin/load-package"
+
+# Statuses of a busy or restarting server, the request is sent again
+RETRY_STATUSES = {502, 503, 504}
+
+# Resource types polled after the upload, searched by canonical url
+POLLED_TYPES = ["CodeSystem", "ValueSet", "ConceptMap"]
+
+HttpResponse = namedtuple("HttpResponse", ["status", "headers", "body"])
+
+# One check of the loaded terminology: the operation, its parameters and what the answer must contain
+Check = namedtuple("Check", ["operation", "parameters", "expected"])
+
+
+# Error of a request that failed after every retry, or of an upload the server did not accept
+class UploadError(Exception):
+    pass
+
+
+# Pool of keep-alive HTTP/1.1 connections to one server, for asyncio. At most size requests are sent at once,
+# idle connections are reused, and requests failing with a connection error, a timeout or a 502/503/504
+# are retried with exponential backoff (a reused connection the server already closed fails on the first try).
+# The time on the wire of every answered request is kept in latencies, without the wait for a free connection.
+class ConnectionPool:
+    def __init__(self, base_url, size=default_concurrency, timeout=default_request_timeout, retries=default_retries):
+        parts = urlsplit(base_url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"{base_url} is not an http(s) url")
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == "https" else None
+        # the base url is the server root, given with or without the /fhir of the FHIR endpoint
+        self.root = parts.path.rstrip("/")
+        if self.root.endswith("/fhir"):
+            self.root = self.root[:-len("/fhir")]
+        self.timeout = timeout
+        self.retries = retries
+        self.idle = []
+        self.semaphore = asyncio.Semaphore(size)
+        self.latencies = []
+
+    # Function to send a request and read the whole response, retrying failed attempts
+    async def request(self, method, path, body=b"", headers=None, timeout=None):
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    start = time.perf_counter()
+                    response = await asyncio.wait_for(self.send(method, path, body, headers or {}), timeout or self.timeout)
+                    self.latencies.append(time.perf_counter() - start)
+                if response.status not in RETRY_STATUSES:
+                    return response
+                error = f"HTTP {response.status}"
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                error = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+            if attempt < self.retries:
+                await asyncio.sleep(retry_backoff * 2 ** attempt)
+        raise UploadError(f"{method} {path} failed after {self.retries + 1} attempts: {error}")
+
+    # Function to send a request on an idle or new connection
+    async def send(self, method, path, body, headers):
+        reader, writer = self.idle.pop() if self.idle else await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+        try:
+            head = [f"{method} {self.root}{path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(body)}", "Accept: application/fhir+json, application/json"]
+            head.extend(f"{name}: {value}" for name, value in headers.items())
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+            await writer.drain()
+            response, keep_alive = await read_response(reader, method)
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+        return response
+
+    # Function to close the idle connections
+    async def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+# Function to read an HTTP/1.1 response, with a Content-Length, chunked or until the connection closes.
+# Returns the response and whether the connection can be reused
+async def read_response(reader, method):
+    status_line = await reader.readline()
+    if not status_line:
+        raise asyncio.IncompleteReadError(b"", None)
+    version, status = status_line.decode("latin-1").split(None, 2)[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    status = int(status)
+    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+    if method == "HEAD" or status in (204, 304):
+        body = b""
+    elif headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # trailers end with an empty line
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body, keep_alive = await reader.read(), False
+    return HttpResponse(status, headers, body), keep_alive
+
+# Function to decode a JSON response body, None when it is not JSON
+def response_json(response):
+    try:
+        return json.loads(response.body)
+    except ValueError:
+        return None
+
+# Function to build the multipart form of load-package, as curl --form file=@package --form resourceUrls="*"
+def load_package_form(package_path, resource_urls="*"):
+    boundary = uuid.uuid4().hex
+    with open(package_path, "rb") as f:
+        package = f.read()
+    filename = package_path.replace("\\", "/").rsplit("/", 1)[-1]
+    body = b"".join([
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\nContent-Type: application/gzip\r\n\r\n'.encode("utf-8"),
+        package,
+        f'\r\n--{boundary}\r\nContent-Disposition: form-data; name="resourceUrls"\r\n\r\n{resource_urls}\r\n--{boundary}--\r\n'.encode("utf-8"),
+    ])
+    return body, f"multipart/form-data; boundary={boundary}"
+
+# Function to upload a package to load-package
+async def upload_package(pool, package_path, resource_urls="*", timeout=default_timeout):
+    body, content_type = load_package_form(package_path, resource_urls)
+    response = await pool.request("POST", load_package_path, body, {"Content-Type": content_type}, timeout)
+    if response.status >= 300:
+        raise UploadError(f"load-package answered HTTP {response.status}: {response.body[:500].decode('utf-8', 'replace')}")
+
+# Function to check that a resource is on the server, searching it by canonical url.
+# Returns None when the server can not search that resource type
+async def resource_loaded(pool, resource_type, url):
+    response = await pool.request("GET", f"/fhir/{resource_type}?" + urlencode({"url": url}))
+    if response.status in (400, 404, 405, 501):
+        return None
+    bundle = response_json(response) or {}
+    return response.status == 200 and bool(bundle.get("total") or bundle.get("entry"))
+
+# Function to poll the server until every resource of the package can be found or load_timeout seconds pass.
+# Returns the (type, url) of the resources still missing, and of those that could not be searched
+async def wait_for_resources(pool, resources, load_timeout=default_load_timeout):
+    pending = [(resource["resourceType"], resource["url"]) for resource in resources if resource["resourceType"] in POLLED_TYPES]
+    unsearchable = []
+    deadline = time.monotonic() + load_timeout
+    while pending:
+        found = await asyncio.gather(*(resource_loaded(pool, resource_type, url) for resource_type, url in pending))
+        unsearchable += [key for key, present in zip(pending, found) if present is None]
+        pending = [key for key, present in zip(pending, found) if present is False]
+        if not pending or time.monotonic() > deadline:
+            break
+        await asyncio.sleep(poll_interval)
+    return pending, unsearchable
+
+# Function to list the checks of a package: the $validate-code of every ValueSet member and the $translate of
+# every ConceptMap target, or a random sample of sample of each (None for all), the same for the same seed.
+# ValueSets that can not be expanded from the package alone are not checked
+def package_checks(resources, sample=default_sample, seed=0):
+    engine = TerminologyEngine()
+    for resource in resources:
+        engine.add_resource(resource)
+
+    concepts = []
+    for url in engine.resources["ValueSet"]:
+        try:
+            members = engine.members(url)
+        except OperationError:
+            # a delta package may hold a parent ValueSet without its unchanged parts
+            continue
+        for (system, code), display in members.items():
+            concepts.append(Check("validate-code", {"url": url, "system": system, "code": code}, display))
+    mappings = []
+    for url, concept_map in engine.resources["ConceptMap"].items():
+        for group in concept_map.get("group", []):
+            for element in group.get("element", []):
+                for target in element.get("target", []):
+                    parameters = {"url": url, "system": group["source"], "code": code_key(element["code"]), "targetsystem": group["target"]}
+                    mappings.append(Check("translate", parameters, code_key(target["code"])))
+
+    rng = random.Random(seed)
+    if sample is not None:
+        concepts = rng.sample(concepts, min(sample, len(concepts)))
+        mappings = rng.sample(mappings, min(sample, len(mappings)))
+    return concepts + mappings
+
+# Function to run a check against the server. Returns the failure message, None when it passes
+async def run_check(pool, check):
+    path = "/fhir/ValueSet/$validate-code?" if check.operation == "validate-code" else "/fhir/ConceptMap/$translate?"
+    response = await pool.request("GET", path + urlencode(check.parameters))
+    described = f"${check.operation} {check.parameters.get('system')}|{check.parameters['code']} ({check.parameters['url']})"
+    result = response_json(response)
+    if response.status != 200 or not isinstance(result, dict):
+        return f"{described}: HTTP {response.status}"
+    parameters = result.get("parameter", [])
+    if not any(parameter.get("name") == "result" and parameter.get("valueBoolean") for parameter in parameters):
+        message = next((parameter.get("valueString") for parameter in parameters if parameter.get("name") == "message"), "result false")
+        return f"{described}: {message}"
+    if check.operation == "translate":
+        codes = {
+            code_key(part["valueCoding"].get("code"))
+            for parameter in parameters if parameter.get("name") == "match"
+            for part in parameter.get("part", []) if part.get("name") == "concept"
+        }
+        if check.expected not in codes:
+            return f"{described}: {check.expected} not among the matches {sorted(codes)}"
+    return None
+
+# Function to upload a package, wait until it is loaded and check its concepts and maps on the server.
+# Returns the report: timings, missing resources, checks run and failures
+async def upload_and_verify(package_path, base_url, sample=default_sample, concurrency=default_concurrency, timeout=default_timeout,
+                            request_timeout=default_request_timeout, retries=default_retries, load_timeout=default_load_timeout):
+    resources = list(read_package_resources(package_path))
+    pool = ConnectionPool(base_url, concurrency, request_timeout, retries)
+    report = {"package": package_path, "server": base_url, "resources": len(resources)}
+    try:
+        start = time.perf_counter()
+        await upload_package(pool, package_path, timeout=timeout)
+        report["upload_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        missing, unsearchable = await wait_for_resources(pool, resources, load_timeout)
+        report["load_seconds"] = time.perf_counter() - start
+        report["missing"] = [f"{resource_type}/{url}" for resource_type, url in missing]
+        report["unsearchable"] = sorted({resource_type for resource_type, url in unsearchable})
+
+        checks = package_checks(resources, sample)
+
+        async def checked(check):
+            try:
+                return await run_check(pool, check)
+            except UploadError as e:
+                return str(e)
+
+        pool.latencies = []
+        start = time.perf_counter()
+        failures = await asyncio.gather(*(checked(check) for check in checks))
+        report["check_seconds"] = time.perf_counter() - start
+        report["checks"] = {operation: sum(check.operation == operation for check in checks) for operation in ("validate-code", "translate")}
+        report["failures"] = [failure for failure in failures if failure]
+        latencies = sorted(pool.latencies)
+        report["latency_ms"] = {
+            "p50": latencies[len(latencies) // 2] * 1000 if latencies else None,
+            "p95": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else None,
+        }
+    finally:
+        await pool.close()
+    return report
+
+# Function to print the report of upload_and_verify. Returns True when the package loaded completely and every check passed
+def print_report(report, shown=10):
+    print(f"Uploaded {report['package']} to {report['server']} in {report['upload_seconds']:.1f}s")
+    loaded = report["resources"] - len(report["missing"])
+    print(f"{loaded} of {report['resources']} resources found after {report['load_seconds']:.1f}s")
+    for missing in report["missing"][:shown]:
+        print(f"  missing {missing}")
+    if len(report["missing"]) > shown:
+        print(f"  ... and {len(report['missing']) - shown} more")
+    if report["unsearchable"]:
+        print(f"  the server can not search {', '.join(report['unsearchable'])} by url, checked through the operations only")
+
+    checks = report["checks"]
+    latency = report["latency_ms"]
+    timing = f", p50 {latency['p50']:.0f} ms, p95 {latency['p95']:.0f} ms" if latency["p50"] is not None else ""
+    print(f"Ran {checks['validate-code']} $validate-code and {checks['translate']} $translate checks in {report['check_seconds']:.1f}s{timing}: {len(report['failures'])} failed")
+    for failure in report["failures"][:shown]:
+        print(f"  {failure}")
+    if len(report["failures"]) > shown:
+        print(f"  ... and {len(report['failures']) - shown} more")
+    return not report["missing"] and not report["failures"]
+
+# Function to list the transaction Bundles written by the converter with --bundles in a directory, in name order
+def bundle_files(bundle_dir):
+    return sorted(glob.glob(os.path.join(bundle_dir, "bundle-*.json")))
+
+# Function to post a transaction Bundle file to the base url of a FHIR server.
+# Returns the status of each of its entries ("201 Created", "200 OK"...)
+async def post_bundle(pool, bundle_path, timeout=default_timeout):
+    with open(bundle_path, "rb") as f:
+        body = f.read()
+    response = await pool.request("POST", "/fhir", body, {"Content-Type": "application/fhir+json"}, timeout)
+    result = response_json(response)
+    if response.status >= 300 or not isinstance(result, dict):
+        raise UploadError(f"{bundle_path}: HTTP {response.status}: {response.body[:500].decode('utf-8', 'replace')}")
+    return [entry.get("response", {}).get("status", "") for entry in result.get("entry", [])]
+
+# Function to post the transaction Bundles of the converter to a FHIR server such as HAPI FHIR, concurrency of them
+# at once through the keep-alive connections of the pool. Every entry updates its resource by canonical url, so
+# loading the same Bundles again leaves the server as it was. Returns the report: timings, entries and failures
+async def load_bundles(bundle_paths, base_url, concurrency=default_concurrency, timeout=default_timeout, retries=default_retries):
+    pool = ConnectionPool(base_url, concurrency, timeout, retries)
+    report = {"bundles": len(bundle_paths), "server": base_url}
+
+    async def posted(path):
+        try:
+            return await post_bundle(pool, path, timeout), None
+        except UploadError as e:
+            return [], str(e) if str(e).startswith(path) else f"{path}: {e}"
+
+    try:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(posted(path) for path in bundle_paths))
+        report["seconds"] = time.perf_counter() - start
+    finally:
+        await pool.close()
+    statuses = [status.split(" ", 1)[0] for entry_statuses, _ in results for status in entry_statuses]
+    report["entries"] = {"created": statuses.count("201"), "updated": statuses.count("200"), "other": sum(status not in ("200", "201") for status in statuses)}
+    report["failures"] = [error for _, error in results if error]
+    latencies = sorted(pool.latencies)
+    report["latency_ms"] = {
+        "p50": latencies[len(latencies) // 2] * 1000 if latencies else None,
+        "p95": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else None,
+    }
+    return report
+
+# Function to print the report of load_bundles. Returns True when every Bundle was accepted and applied
+def print_bundle_report(report, shown=10):
+    entries = report["entries"]
+    latency = report["latency_ms"]
+    timing = f", p50 {latency['p50']:.0f} ms, p95 {latency['p95']:.0f} ms" if latency["p50"] is not None else ""
+    print(f"Posted {report['bundles']} transaction Bundles to {report['server']} in {report['seconds']:.1f}s{timing}: "
+          f"{entries['created']} resources created, {entries['updated']} updated, {entries['other']} with another status, {len(report['failures'])} Bundles failed")
+    for failure in report["failures"][:shown]:
+        print(f"  {failure}")
+    if len(report["failures"]) > shown:
+        print(f"  ... and {len(report['failures']) - shown} more")
+    return not report["failures"] and not entries["other"]
+
+# Function to parse the sample size, a number of checks of each kind or all
+def parse_sample(value):
+    if value == "all":
+        return None
+    sample = int(value)
+    if sample < 0:
+        raise argparse.ArgumentTypeError("the sample size can not be negative")
+    return sample
+
+# Function to load the transaction Bundles of a directory from the converter, returns True when they were all applied
+def load(bundle_dir, base_url, concurrency=default_concurrency, timeout=default_timeout):
+    bundle_paths = bundle_files(bundle_dir)
+    if not bundle_paths:
+        print(f"No transaction Bundles in {bundle_dir}")
+        return False
+    return print_bundle_report(asyncio.run(load_bundles(bundle_paths, base_url, concurrency, timeout)))
+
+# Function to upload and verify a package from the converter, returns True when it passed
+def upload(package_path, base_url, sample=default_sample, concurrency=default_concurrency, timeout=default_timeout):
+    try:
+        report = asyncio.run(upload_and_verify(package_path, base_url, sample, concurrency, timeout))
+    except UploadError as e:
+        print(f"Upload of {package_path} failed: {e}")
+        return False
+    return print_report(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload a FHIR package to Snowstorm with load-package, wait until it is loaded and check its concepts and maps with $validate-code and $translate. Or post the transaction Bundles of the converter to a FHIR server such as HAPI FHIR.")
+    parser.add_argument("package", help="The FHIR package to upload (racsel_fhir_package.tgz), or the directory of transaction Bundles written with --bundles (racsel_fhir_package.bundles)")
+    parser.add_argument("server", help="Base url of the server, e.g. http://localhost:8080 (Snowstorm) or http://localhost:8080/fhir (HAPI FHIR)")
+    parser.add_argument("--sample", type=parse_sample, default=default_sample, help=f"ValueSet members and map targets checked, each, or all (default: {default_sample})")
+    parser.add_argument("--concurrency", type=int, default=default_concurrency, help=f"Requests sent at once (default: {default_concurrency})")
+    parser.add_argument("--timeout", type=float, default=default_timeout, help=f"Seconds allowed for the upload (default: {default_timeout})")
+    parser.add_argument("--request-timeout", type=float, default=default_request_timeout, help=f"Seconds allowed for each check (default: {default_request_timeout})")
+    parser.add_argument("--retries", type=int, default=default_retries, help=f"Retries of a failed request (default: {default_retries})")
+    parser.add_argument("--load-timeout", type=float, default=default_load_timeout, help=f"Seconds to wait for the resources to appear after the upload (default: {default_load_timeout})")
+    parser.add_argument("--report-json", metavar="FILE", default=None, help="Also write the report as JSON")
+
+    args = parser.parse_args()
+
+    if os.path.isdir(args.package):
+        bundle_paths = bundle_files(args.package)
+        if not bundle_paths:
+            sys.exit(f"No transaction Bundles (bundle-*.json) in {args.package}")
+        report = asyncio.run(load_bundles(bundle_paths, args.server, args.concurrency, args.timeout, args.retries))
+        passed = print_bundle_report(report)
+        if args.report_json:
+            with open(args.report_json, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        sys.exit(0 if passed else 1)
+
+    try:
+        report = asyncio.run(upload_and_verify(args.package, args.server, args.sample, args.concurrency, args.timeout, args.request_timeout, args.retries, args.load_timeout))
+    except UploadError as e:
+        sys.exit(f"Upload of {args.package} failed: {e}")
+    passed = print_report(report)
+    if args.report_json:
+        with open(args.report_json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__":
+    main()
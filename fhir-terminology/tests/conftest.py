@@ -0,0 +1,49 @@
+import asyncio
+import importlib.util
+import os
+import sys
+
+import pytest
+
+scripts_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, scripts_dir)
+
+
+# Function to import a script of the repository, their file names are not valid module names.
+# The module is registered under its name, so the build workers of the converter can find its functions
+def load_script(name):
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(scripts_dir, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def converter():
+    return load_script("racsel-convert-xlsx-to-fhir")
+
+
+# A small package converted from the test workbook, shared by the tests that load it in a server
+@pytest.fixture(scope="session")
+def package_path(converter, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("package") / "racsel_fhir_package.tgz")
+    converter.convert_to_fhir(os.path.join(scripts_dir, "Subsets_Conectathon_Test_Data.xlsx"), output_path=path)
+    return path
+
+
+# Function to run a coroutine function with the base url of a racsel_terminology server on a free local port,
+# started in the same event loop. Returns what the coroutine returns
+@pytest.fixture
+def with_server():
+    from racsel_terminology import TerminologyEngine, handle_connection
+
+    def run(work, engine=None):
+        engine = engine or TerminologyEngine()
+
+        async def serve():
+            server = await asyncio.start_server(lambda reader, writer: handle_connection(engine, reader, writer), "127.0.0.1", 0)
+            async with server:
+                return await work(f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}")
+        return asyncio.run(serve())
+    return run
@@ -0,0 +1,22 @@
+import os
+
+
+scripts_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKBOOK = os.path.join(scripts_dir, "Subsets_Conectathon_Test_Data.xlsx")
+
+
+def test_parallel_build_is_profiled_and_identical(converter, tmp_path):
+    packages = []
+    for build_jobs in (1, 2):
+        profiler = converter.Profiler(memory=False)
+        output_path = str(tmp_path / f"package-{build_jobs}.tgz")
+        converter.convert_to_fhir(WORKBOOK, output_path=output_path, profiler=profiler, index=False, json_encoder="json", build_jobs=build_jobs)
+        with open(output_path, "rb") as f:
+            packages.append(f.read())
+
+        assert profiler.build_workers == build_jobs
+        assert "build" in [stage["name"] for stage in profiler.stages]
+        assert profiler.resources and all(resource["bytes"] > 0 and resource["wall"] >= 0 for resource in profiler.resources)
+        # resources built in a worker are recorded with its pid, the others in this process
+        assert all(("worker" in resource) == (build_jobs > 1) for resource in profiler.resources)
+    assert packages[0] == packages[1]
@@ -0,0 +1,52 @@
+import glob
+import json
+import math
+import os
+from urllib.parse import quote
+
+from racsel_terminology import read_package_resources
+from racsel_upload import bundle_files, load_bundles
+
+
+scripts_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUNDLE_SIZE = 7
+
+
+def test_bundles_and_ndjson_load_twice(converter, with_server, tmp_path):
+    output_path = str(tmp_path / "racsel_fhir_package.tgz")
+    converter.convert_to_fhir(os.path.join(scripts_dir, "Subsets_Conectathon_Test_Data.xlsx"), output_path=output_path, bundle_size=BUNDLE_SIZE, ndjson=True)
+    resources = {resource["url"]: resource for resource in read_package_resources(output_path)}
+
+    # transaction Bundles of conditional updates by canonical url, every resource of the package once
+    paths = bundle_files(converter.bundles_path(output_path))
+    assert len(paths) == math.ceil(len(resources) / BUNDLE_SIZE) > 1
+    entries = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            bundle = json.load(f)
+        assert bundle["resourceType"] == "Bundle" and bundle["type"] == "transaction"
+        assert 0 < len(bundle["entry"]) <= BUNDLE_SIZE
+        entries.extend(bundle["entry"])
+    assert len(entries) == len(resources)
+    for entry in entries:
+        resource = entry["resource"]
+        assert entry["request"] == {"method": "PUT", "url": f"{resource['resourceType']}?url={quote(resource['url'], safe='')}"}
+        assert resource == resources[resource["url"]]
+
+    # one NDJSON file per resource type, one resource per line
+    ndjson = {}
+    for path in glob.glob(os.path.join(converter.ndjson_path(output_path), "*.ndjson")):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                resource = json.loads(line)
+                assert os.path.basename(path) == resource["resourceType"] + ".ndjson"
+                ndjson[resource["url"]] = resource
+    assert ndjson == resources
+
+    # loading the same Bundles again updates the resources instead of creating copies
+    async def load_twice(base_url):
+        return await load_bundles(paths, base_url), await load_bundles(paths, base_url)
+    first, second = with_server(load_twice)
+    assert first["failures"] == [] and second["failures"] == []
+    assert first["entries"] == {"created": len(resources), "updated": 0, "other": 0}
+    assert second["entries"] == {"created": 0, "updated": len(resources), "other": 0}
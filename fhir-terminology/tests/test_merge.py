@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from racsel_terminology import TerminologyEngine, read_package_resources
+
+
+scripts_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKBOOKS = ["Subsets_Conectathon_Test_Data.xlsx", "2025_ACME_Subsets_Conectaton.xlsx"]
+MAX_SIZE = 5
+
+
+# Function to get the members of every ValueSet of some packages that are not parts of another one
+def value_set_members(package_paths):
+    engine = TerminologyEngine.from_packages(package_paths)
+    return {url: set(engine.members(url)) for url in engine.resources["ValueSet"] if "-part-" not in url}
+
+
+def test_merged_split_packages_keep_the_size_limit(converter, tmp_path):
+    packages = []
+    for workbook in WORKBOOKS:
+        output_path = str(tmp_path / (os.path.splitext(workbook)[0] + ".tgz"))
+        converter.convert_to_fhir(os.path.join(scripts_dir, workbook), output_path=output_path, max_resource_size=MAX_SIZE, index=False)
+        packages.append((os.path.splitext(workbook)[0], output_path))
+    regional_path = str(tmp_path / "regional.tgz")
+    converter.merge_packages(packages, regional_path, max_group_size=MAX_SIZE, index=False)
+
+    resources = list(read_package_resources(regional_path))
+    value_sets = [resource for resource in resources if resource["resourceType"] == "ValueSet"]
+    assert any("-part-" in resource["url"] for resource in value_sets)
+    for resource in value_sets:
+        concepts = sum(len(include.get("concept", [])) for include in resource["compose"]["include"])
+        assert concepts <= MAX_SIZE, resource["url"]
+    assert len({resource["url"] for resource in resources}) == len(resources)
+
+    # every ValueSet still has the members of both workbooks
+    merged = value_set_members([regional_path])
+    for _, package_path in packages:
+        for url, members in value_set_members([package_path]).items():
+            assert members <= merged[url], url
+
+
+def test_split_chunks_rejects_a_size_below_one(converter):
+    assert converter.split_chunks([1, 2, 3], 2) == [[1, 2], [3]]
+    for max_size in (0, -1):
+        with pytest.raises(ValueError):
+            converter.split_chunks([1, 2, 3], max_size)
@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+from racsel_terminology import TerminologyEngine, handle_connection, handle_request
+
+
+TRANSLATE = "/fhir/ConceptMap/$translate"
+
+
+def post(engine, target, document):
+    return handle_request(engine, "POST", target, json.dumps(document).encode("utf-8"), "application/fhir+json")
+
+
+def test_body_not_parameters_is_bad_request():
+    status, outcome = post(TerminologyEngine(), TRANSLATE, [1])
+    assert status == 400
+    assert outcome["resourceType"] == "OperationOutcome"
+
+
+def test_parameter_without_name_is_bad_request():
+    status, outcome = post(TerminologyEngine(), TRANSLATE, {"resourceType": "Parameters", "parameter": [{"valueString": "46635009"}]})
+    assert status == 400
+    assert "name" in outcome["issue"][0]["diagnostics"]
+
+
+def test_unexpected_error_is_internal_server_error(monkeypatch):
+    engine = TerminologyEngine()
+
+    def fail(*args):
+        raise RuntimeError("broken engine")
+    monkeypatch.setattr(engine, "translate", fail)
+    status, outcome = handle_request(engine, "GET", TRANSLATE + "?system=http://snomed.info/sct&code=46635009")
+    assert status == 500
+    assert outcome["issue"][0]["code"] == "exception"
+
+
+def test_server_answers_invalid_body():
+    async def exchange():
+        server = await asyncio.start_server(lambda reader, writer: handle_connection(TerminologyEngine(), reader, writer), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            body = b"[1]"
+            writer.write(f"POST {TRANSLATE} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+        return response
+    response = asyncio.run(exchange())
+    assert response.startswith(b"HTTP/1.1 400 Bad Request")
@@ -0,0 +1,70 @@
+import pytest
+
+import racsel_terminology
+import racsel_upload
+from racsel_upload import package_checks, upload_and_verify, UploadError
+
+
+SYSTEM = "http://snomed.info/sct"
+PARENT_URL = "http://racsel.org/fhir/ValueSet/snomed-vs"
+
+
+def test_package_checks_skip_parent_without_parts():
+    # a delta package with the parent ValueSet of a split ValueSet but not its unchanged parts
+    resources = [
+        {"resourceType": "ValueSet", "id": "snomed-vs", "url": PARENT_URL, "compose": {"include": [{"valueSet": [PARENT_URL + "-part-1"]}]}},
+        {"resourceType": "ValueSet", "id": "other-vs", "url": "http://racsel.org/fhir/ValueSet/other-vs", "compose": {"include": [{"system": SYSTEM, "concept": [{"code": "46635009", "display": "Diabetes"}]}]}},
+    ]
+    checks = package_checks(resources, sample=None)
+    assert [check.parameters["url"] for check in checks] == ["http://racsel.org/fhir/ValueSet/other-vs"]
+    assert checks[0].parameters["code"] == "46635009"
+
+
+@pytest.fixture
+def no_wait(monkeypatch):
+    monkeypatch.setattr(racsel_upload, "retry_backoff", 0)
+    monkeypatch.setattr(racsel_upload, "poll_interval", 0.01)
+
+
+def test_upload_and_verify_against_the_stand_in(package_path, with_server, no_wait):
+    report = with_server(lambda base_url: upload_and_verify(package_path, base_url, sample=None, load_timeout=5))
+    assert report["resources"] > 0
+    assert report["missing"] == []
+    assert report["unsearchable"] == []
+    assert report["checks"]["validate-code"] > 0 and report["checks"]["translate"] > 0
+    assert report["failures"] == []
+
+
+def test_upload_and_verify_retries_and_reports_failures(package_path, with_server, no_wait, monkeypatch):
+    # every request is first answered 503, and $translate always fails
+    attempts = {}
+    handle_request = racsel_terminology.handle_request
+
+    def flaky(engine, method, target, body=b"", content_type=None):
+        attempts[method, target] = attempts.get((method, target), 0) + 1
+        if attempts[method, target] == 1:
+            return 503, {"resourceType": "OperationOutcome"}
+        if "$translate" in target:
+            return 500, {"resourceType": "OperationOutcome"}
+        return handle_request(engine, method, target, body, content_type)
+    monkeypatch.setattr(racsel_terminology, "handle_request", flaky)
+
+    report = with_server(lambda base_url: upload_and_verify(package_path, base_url, sample=None, retries=2, load_timeout=5))
+    assert attempts["POST", racsel_upload.load_package_path] == 2
+    assert all(count == 2 for (method, target), count in attempts.items() if "$translate" not in target)
+    assert report["missing"] == []
+    assert len(report["failures"]) == report["checks"]["translate"] > 0
+    assert all("$translate" in failure and "HTTP 500" in failure for failure in report["failures"])
+
+
+def test_upload_fails_when_the_server_stays_unavailable(package_path, with_server, no_wait, monkeypatch):
+    attempts = []
+
+    def unavailable(engine, method, target, body=b"", content_type=None):
+        attempts.append(target)
+        return 503, {"resourceType": "OperationOutcome"}
+    monkeypatch.setattr(racsel_terminology, "handle_request", unavailable)
+
+    with pytest.raises(UploadError, match="after 3 attempts: HTTP 503"):
+        with_server(lambda base_url: upload_and_verify(package_path, base_url, retries=2))
+    assert attempts == [racsel_upload.load_package_path] * 3
@@ -0,0 +1,20 @@
+import pandas as pd
+
+
+# Function to build stacked terms (see stack_terms) of one row of the Antecedentes sheet
+def row_terms(codes):
+    return pd.DataFrame(
+        [("Antecedentes", 3, system, code, f"{system} display") for system, code in codes.items()],
+        columns=["domain", "row", "system", "code", "display"],
+    )
+
+
+def test_int_local_code_is_numeric(converter):
+    defects = converter.validate_terms(row_terms({"racsel": "H1", "local": 123, "cie10": "E10.0", "snomed": 46635009}))
+    numeric = defects[defects["check"] == "numeric-code"]
+    assert numeric[["column", "code"]].values.tolist() == [["D", 123]]
+
+
+def test_decimal_snomed_code_is_numeric(converter):
+    defects = converter.validate_terms(row_terms({"racsel": "H1", "local": "0123", "snomed": 46635009.5}))
+    assert defects[defects["check"] == "numeric-code"]["code"].tolist() == [46635009.5]
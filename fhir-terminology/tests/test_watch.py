@@ -0,0 +1,75 @@
+import os
+import re
+import zipfile
+
+
+scripts_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKBOOK = os.path.join(scripts_dir, "Subsets_Conectathon_Test_Data.xlsx")
+SHARED_STRING = re.compile(rb'(<c [^>]*t="s"[^>]*><v>)(\d+)(</v>)')
+
+
+# Function to copy an .xlsx replacing some of its members, {name: function of the old bytes}
+def rewrite_workbook(source_path, output_path, rewrites):
+    with zipfile.ZipFile(source_path) as source, zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as output:
+        for info in source.infolist():
+            data = source.read(info.filename)
+            output.writestr(info, rewrites.get(info.filename, lambda data: data)(data))
+
+
+def test_text_edit_changes_only_its_sheet_fingerprint(converter, tmp_path):
+    # as Excel may do on save: a new display edited in the first sheet is the first shared string, every index moves
+    def shared_strings(data):
+        return re.sub(rb"(<sst [^>]*>)", rb"\1<si><t>A display edited in the first sheet</t></si>", data, count=1)
+
+    def shift(data):
+        return SHARED_STRING.sub(lambda match: match.group(1) + str(int(match.group(2)) + 1).encode() + match.group(3), data)
+
+    def edit_first_sheet(data):
+        data = shift(data)
+        row = data.index(b'<row r="4"')
+        match = SHARED_STRING.search(data, row)
+        return data[:match.start(2)] + b"0" + data[match.end(2):]
+
+    rewrites = {f"xl/worksheets/sheet{n}.xml": shift for n in range(2, 7)}
+    rewrites.update({"xl/sharedStrings.xml": shared_strings, "xl/worksheets/sheet1.xml": edit_first_sheet})
+    edited_path = str(tmp_path / "edited.xlsx")
+    rewrite_workbook(WORKBOOK, edited_path, rewrites)
+
+    before = converter.sheet_fingerprints(WORKBOOK)
+    after = converter.sheet_fingerprints(edited_path)
+    assert before.keys() == after.keys()
+    assert [name for name in before if before[name] != after[name]] == [list(before)[0]]
+    assert converter.sheet_fingerprints(WORKBOOK) == before
+
+
+def test_failed_rebuild_is_retried_on_the_next_save(converter, tmp_path, monkeypatch, capsys):
+    workbook_path = str(tmp_path / "workbook.xlsx")
+    rewrite_workbook(WORKBOOK, workbook_path, {})
+    builds = []
+
+    def convert_to_fhir(file_path, **options):
+        builds.append(sorted(options["sheets"]))
+        if len(builds) == 1:
+            raise RuntimeError("unexpected build error")
+    monkeypatch.setattr(converter, "convert_to_fhir", convert_to_fhir)
+
+    saved = []
+
+    def sleep(seconds):
+        if len(builds) == 1 and not saved:
+            # saved again after the failed build
+            stat = os.stat(workbook_path)
+            os.utime(workbook_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+            saved.append(True)
+        elif len(builds) == 2:
+            raise KeyboardInterrupt
+    monkeypatch.setattr(converter.time, "sleep", sleep)
+
+    converter.watch_workbook(workbook_path, output_path=str(tmp_path / "racsel_fhir_package.tgz"), interval=0)
+    output = capsys.readouterr().out
+    assert "Could not rebuild from" in output and "RuntimeError: unexpected build error" in output
+    assert len(builds) == 2
+    # the fingerprints were not kept after the failure, so every sheet is parsed again
+    sheet_count = len(converter.SHEET_NAMES)
+    assert output.count(f"parsed {sheet_count} of {sheet_count} sheets") == 2
+    assert output.strip().endswith("Stopped watching")